@@ -4,9 +4,25 @@ import config
 import thread
 import control
 import overlay
+import sheet
+import persist
+import shared
+import metrics
+import audio
+import journal
+
+
+def start_leader():
+    """Starts the sheet sync, the runner and the streams for delayed overlays.
+    Called on the one worker that is elected leader."""
+    sheet.start_sync()
+    persist.restore()
+    journal.restore_streams()
+
 
 if __name__ == '__main__':
     config.logger.info("Running")
-    thread.cycle()
-    config.socketio.run(config.app, host="0.0.0.0", port=80)
+    sheet.follow()
+    shared.elect(start_leader)
+    config.socketio.run(config.app, host="0.0.0.0", port=config.PORT)
     config.logger.info("Done")
\ No newline at end of file
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+# This module serves static files that are fetched once and then cached, such as the audio cues (see audio.py)
+# and the overlay's table templates (see table.py).
+#
+# Each file's URL includes a hash of its content, so browsers can cache it indefinitely: a changed file gets a new URL.
+
+import hashlib
+import os
+
+from flask import send_from_directory
+
+# How long browsers may cache the files, in seconds.
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+
+def static_manifest(directory, url_prefix, filenames=None):
+    """Returns the URL of each file in a directory, including a hash of its content.
+
+    Args:
+        directory: Directory holding the files.
+        url_prefix: Path they are served under, e.g. "/audio".
+        filenames: Files to include.  None for every file in the directory.
+
+    Returns:
+        urls: dict of URLs, by file name, e.g. "/audio/beep.mp3?v=0123456789ab".
+    """
+    if filenames is None:
+        filenames = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+    urls = {}
+    for filename in filenames:
+        with open(os.path.join(directory, filename), 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        urls[filename] = f"{url_prefix}/{filename}?v={digest}"
+    return urls
+
+
+def cached_file(directory, filename):
+    """Returns a response serving a file from a directory, with an ETag and headers allowing it to be cached
+    for a long time.  For the routes serving the URLs from static_manifest()."""
+    response = send_from_directory(directory, filename, conditional=True, cache_timeout=CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# This module describes the audio cues to the overlays, and serves the audio files.
+#
+# When an overlay connects, it is sent a manifest of the cues: the URL of each file and the gain (volume) to play
+# them at.  It fetches and decodes every cue in advance, so that a cue starts the moment it is due.
+# Each URL includes a hash of the file's content, so files can be cached indefinitely (see assets.py).
+
+import os
+
+import assets
+import config
+
+AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'audio')
+
+
+def build_manifest():
+    """Returns the cues in config.AUDIO_CUES with the URL of each, as a dict of dicts with field url, by cue name."""
+    urls = assets.static_manifest(AUDIO_DIR, '/audio', config.AUDIO_CUES.values())
+    return {name: dict(url=urls[filename]) for name, filename in config.AUDIO_CUES.items()}
+
+
+# Cues are read once, at import.
+cues = build_manifest()
+
+
+def manifest_for(role):
+    """Returns the manifest sent to an overlay.
+
+    Args:
+        role: Role of the overlay, from its "role" URL parameter, e.g. "preview" for the control interface's iframe.
+            Roles not in config.AUDIO_GAIN get the default gain.
+
+    Returns:
+        manifest: dict with fields cues (as for build_manifest()) and gain (0 for muted, 1 for full volume).
+    """
+    return dict(cues=cues, gain=config.AUDIO_GAIN.get(role, config.AUDIO_GAIN['default']))
+
+
+@config.app.route('/audio/<path:filename>')
+def serve_audio(filename):
+    """Serves an audio file, with an ETag and headers allowing it to be cached for a long time."""
+    return assets.cached_file(AUDIO_DIR, filename)
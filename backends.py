@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# This module provides the backends that sheet.py reads the matches and teams from, selected by config.BACKEND:
+# * "sheets": The Google spreadsheet (the default), through sheetsapi.
+# * "sqlite": A local SQLite file, with a table for each kind ("matches" and "teams") whose columns are the usual
+#   headers.  One way to make it is from CSV files:  sqlite3 event.db ".import --csv matches.csv matches"
+# * "csv": A directory holding matches.csv and teams.csv, each with a header row.
+# The local backends need no credentials or network, so suit offline events, test rigs and load tests.
+#
+# Every backend returns each kind of record as the Sheets API does: a list of rows, each a list of strings, with the
+# header row first.  So parsing, snapshots and change detection (see sheet.py) are the same whatever the source.
+# The local backends also report a data version, which changes whenever the data might have, so the sync worker
+# can poll them often and only read them again when something has changed.
+
+import csv
+import os.path
+import re
+import sqlite3
+import threading
+
+import config
+
+# If modifying these scopes, delete the file token.pickle.
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+
+# Note: the sheets backend won't work without a "service-credentials.json" file,
+# for a Google Service account that has read access to the spreadsheet.
+# For security reasons, this file is not included in the github repo.
+SECRET_FILE = os.path.join(os.getcwd(), 'service-credentials.json')
+
+
+class Backend:
+    """Source of the rows of each kind of record (a key of config.SHEET_RANGES: "matches" or "teams").
+
+    Attributes:
+        name: Name used in config.BACKEND.
+        sync_interval: Seconds between refreshes by the sync worker.
+    """
+    name = None
+    sync_interval = 15
+
+    def read(self, kinds):
+        """Reads every row of several kinds of record, at once if possible.
+
+        Returns:
+            values: Dict of lists of rows, by kind.  Each row is a list of strings, and the first is the header row.
+                A kind with no data has an empty list.
+        """
+        raise NotImplementedError
+
+    def read_row(self, kind, row):
+        """Reads one row of a kind of record, e.g. to watch one match.
+
+        Args:
+            kind: "matches" or "teams".
+            row: Row number, as in Record.row (the header row is row 1).
+
+        Returns:
+            row: List of strings (empty if the row is blank or past the end), or None if this backend can't read
+                a single row, in which case the caller should read everything.
+        """
+        return None
+
+    def data_version(self):
+        """Returns a value that changes whenever the data might have changed, or None if that can't be known
+        without reading it."""
+        return None
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+
+def row_range(range_name, row):
+    """Returns the A1 notation for one row of a range, e.g. "Matches!A7:Z7" for row 7 of "Matches!A1:Z".
+    Returns None if the range doesn't name its columns (e.g. just "Matches"), so can't be narrowed to a row."""
+    sheet_name, bang, cells = range_name.rpartition('!')
+    m = re.fullmatch(r'([A-Za-z]+)\d*:([A-Za-z]+)\d*', cells)
+    if m is None:
+        return None
+    return f"{sheet_name}{bang}{m.group(1)}{row}:{m.group(2)}{row}"
+
+
+class SheetsBackend(Backend):
+    """Reads the ranges in config.SHEET_RANGES from the Google spreadsheet config.SPREADSHEET_ID.
+    If config.SHEETS_ENDPOINT is set, the API is used there instead, which allows testing against a local stand-in.
+    Credentials are optional in that case.
+    """
+    name = 'sheets'
+
+    def __init__(self, client=None):
+        """
+        Args:
+            client: Object with the batch_get() method of sheetsapi.SheetsClient.  None to open the API.
+        """
+        if client is None:
+            # Imported here, so that starting the server doesn't wait for it.
+            import sheetsapi
+
+            endpoint = config.SHEETS_ENDPOINT or sheetsapi.GOOGLE_ENDPOINT
+            credentials_file = SECRET_FILE
+            if config.SHEETS_ENDPOINT and not os.path.exists(SECRET_FILE):
+                credentials_file = None
+            config.logger.info(f"Getting spreadsheets from {endpoint}")
+            client = sheetsapi.SheetsClient(endpoint, credentials_file, SCOPES, timeout=config.SHEETS_TIMEOUT)
+        self.client = client
+
+    def read(self, kinds):
+        kinds = list(kinds)
+        result = self.client.batch_get(config.SPREADSHEET_ID, [config.SHEET_RANGES[kind] for kind in kinds])
+        value_ranges = result.get('valueRanges', [])
+        values = {kind: [] for kind in kinds}
+        values.update({kind: value_range.get('values', []) for kind, value_range in zip(kinds, value_ranges)})
+        return values
+
+    def read_row(self, kind, row):
+        range_name = row_range(config.SHEET_RANGES[kind], row)
+        if range_name is None:
+            return None
+        value_ranges = self.client.batch_get(config.SPREADSHEET_ID, [range_name]).get('valueRanges', [])
+        values = value_ranges[0].get('values', []) if value_ranges else []
+        return values[0] if values else []
+
+
+def cell_text(value):
+    """Returns a database value as the Sheets API would show it: "" for NULL, and whole floats without ".0"."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class SQLiteBackend(Backend):
+    """Reads a table for each kind ("matches" and "teams") from a SQLite file, in rowid order.
+    Changes made by any other connection (e.g. the sqlite3 shell, or a scoring app) are seen through SQLite's
+    data version, so polling costs one query while nothing changes."""
+    name = 'sqlite'
+    sync_interval = 1
+
+    def __init__(self, path):
+        """
+        Args:
+            path: The SQLite file, or ":memory:" for a private database (filled with write()).
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self._writes = 0 # Writes through this connection, which SQLite's data version doesn't count.
+
+    def _rows(self, sql, *params):
+        cursor = self.connection.execute(sql, params)
+        header = [d[0] for d in cursor.description]
+        return header, [[cell_text(v) for v in row] for row in cursor]
+
+    def _has_table(self, kind):
+        return self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (kind,)).fetchone() is not None
+
+    def read(self, kinds):
+        values = {}
+        with self.lock:
+            # One read transaction, so every kind comes from the same version of the data.
+            self.connection.execute("BEGIN")
+            try:
+                for kind in kinds:
+                    if not self._has_table(kind):
+                        values[kind] = []
+                        continue
+                    header, rows = self._rows(f'SELECT * FROM "{kind}" ORDER BY rowid')
+                    values[kind] = [header] + rows
+            finally:
+                self.connection.execute("COMMIT")
+        return values
+
+    def read_row(self, kind, row):
+        with self.lock:
+            if not self._has_table(kind):
+                return []
+            header, rows = self._rows(f'SELECT * FROM "{kind}" ORDER BY rowid LIMIT 1 OFFSET ?', row - 2)
+        return rows[0] if rows else []
+
+    def data_version(self):
+        with self.lock:
+            return (self.connection.execute("PRAGMA data_version").fetchone()[0], self._writes)
+
+    def write(self, kind, values):
+        """Replaces the table for a kind of record, e.g. to set up a test or a simulation.
+
+        Args:
+            kind: "matches" or "teams".
+            values: List of rows, each a list of values, with the header row first.
+        """
+        header, rows = values[0], values[1:]
+        columns = ", ".join('"{}"'.format(name.replace('"', '""')) for name in header)
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute(f'DROP TABLE IF EXISTS "{kind}"')
+                self.connection.execute(f'CREATE TABLE "{kind}" ({columns})')
+                self.connection.executemany(f'INSERT INTO "{kind}" VALUES ({", ".join("?" * len(header))})',
+                                            [list(row) + [None] * (len(header) - len(row)) for row in rows])
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            self._writes += 1
+
+    def __repr__(self):
+        return f"<SQLiteBackend {self.path}>"
+
+
+class CSVBackend(Backend):
+    """Reads a CSV file for each kind (matches.csv and teams.csv) from a directory.
+    A file is only read again when its size or modification time changes."""
+    name = 'csv'
+    sync_interval = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def file(self, kind):
+        return os.path.join(self.directory, f"{kind}.csv")
+
+    def _read_file(self, kind):
+        try:
+            with open(self.file(kind), newline='', encoding='utf-8-sig') as f:
+                return list(csv.reader(f))
+        except FileNotFoundError:
+            return []
+
+    def read(self, kinds):
+        return {kind: self._read_file(kind) for kind in kinds}
+
+    def read_row(self, kind, row):
+        rows = self._read_file(kind)
+        return rows[row - 1] if row <= len(rows) else []
+
+    def data_version(self):
+        version = []
+        for kind in config.SHEET_RANGES:
+            try:
+                stat = os.stat(self.file(kind))
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def __repr__(self):
+        return f"<CSVBackend {self.directory}>"
+
+
+def open_backend(name, path=None):
+    """Returns the backend called name (as for config.BACKEND), reading from path (as for config.DATA_PATH)."""
+    if name == 'sheets':
+        return SheetsBackend()
+    if name in ('sqlite', 'csv'):
+        if not path:
+            raise ValueError(f"The {name} backend needs a path (ANTHILL_DATA_PATH)")
+        return SQLiteBackend(path) if name == 'sqlite' else CSVBackend(path)
+    raise ValueError(f"Unknown backend {name}")
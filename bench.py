@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# This script measures how the server behaves as overlay clients are added.
+#
+# For each number of clients, it starts the server (app.py) against a local stand-in for the Sheets API
+# (tests/sheets_standin.py),
+# connects that many simulated overlays to /overlay and one control interface to /control,
+# and drives complete match cycles (next match, start, game over, show scores, back to cycling).
+# It reports the latency from each patch being sent to each overlay receiving it, the jitter of the
+# per-second time updates (when the server runs the clock), and the CPU time and memory used by the server.
+#
+# Results are appended to a JSON file in bench_results/, tagged with the git commit, and compared with the
+# previous run so that regressions between versions stand out.  (The directory is left out of git.)
+#
+# Usage: ./bench.py [--clients 1,10,50] [--matches 2] [--server-clock]
+# Requires the socket.io client: pip install "python-socketio[client]<5"
+# CPU and memory are read from /proc, so are only reported on Linux.
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import socketio
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+SHEETS_STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'sheets_standin.py')
+
+
+def percentile(samples, p):
+    """Returns the p'th percentile (0-100) of a list of numbers, or None if empty."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def proc_usage(pid):
+    """Returns CPU seconds (user + system) and resident memory in MB of a process, or (None, None) without /proc."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) / 1024
+        return cpu, rss
+    except (OSError, StopIteration):
+        return None, None
+
+
+class Overlay:
+    """Simulated overlay, recording when each patch arrives."""
+
+    def __init__(self, url):
+        self.latencies = [] # Seconds from patch sent to received.
+        self.ticks = [] # Arrival times of per-second time updates.
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('patch', self.on_patch, namespace='/overlay')
+        self.client.connect(url, namespaces=['/overlay'])
+
+    def on_patch(self, data):
+        now = time.monotonic()
+        self.latencies.append(now - data['ts'])
+        if 'time' in data.get('text', {}):
+            self.ticks.append(now)
+
+    def tick_jitter(self):
+        """Returns how far apart consecutive runs of per-second updates were from one second."""
+        gaps = [b - a for a, b in zip(self.ticks, self.ticks[1:])]
+        return [abs(gap - 1) for gap in gaps if gap < 1.5]
+
+    def close(self):
+        self.client.disconnect()
+
+
+class Control:
+    """Simulated control interface, which presses the buttons to run a match."""
+
+    def __init__(self, url):
+        self.buttons = []
+        self.changed = threading.Condition()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('set_buttons', self.on_set_buttons, namespace='/control')
+        self.client.on('patch_buttons', self.on_patch_buttons, namespace='/control')
+        self.client.connect(url, namespaces=['/control'])
+
+    def on_set_buttons(self, data):
+        with self.changed:
+            self.buttons = data['buttons']
+            self.changed.notify_all()
+
+    def on_patch_buttons(self, data):
+        with self.changed:
+            buttons = [b for b in self.buttons if b['key'] not in data['remove']]
+            for button in data['put']:
+                buttons = [b for b in buttons if b['key'] != button['key']]
+                after = [b['key'] for b in buttons].index(button['after']) + 1 if button['after'] else 0
+                buttons.insert(after, button)
+            self.buttons = buttons
+            self.changed.notify_all()
+
+    def press(self, event, timeout=120):
+        """Waits for a button for an event to be offered, then presses it."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                button = next((b for b in self.buttons if b['event'] == event), None)
+                if button is not None:
+                    break
+                if not self.changed.wait(deadline - time.monotonic()):
+                    raise TimeoutError(f"No {event} button within {timeout} seconds")
+        self.client.emit(event, button['arg'], namespace='/control')
+        return button['arg']
+
+    def run_match(self):
+        match_id = self.press('next_match')
+        self.press('start_match')
+        self.press('show_match_scores')
+        self.press('abort_match')
+        return match_id
+
+    def close(self):
+        self.client.disconnect()
+
+
+def wait_for(url, process, what):
+    """Waits for a process to answer requests for a URL."""
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{what} did not start")
+
+
+def start_sheets(port, n_matches):
+    """Starts the stand-in for the Sheets API, serving an event with a number of matches."""
+    sheets = subprocess.Popen([sys.executable, SHEETS_STANDIN, str(port), '--matches', str(n_matches)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for(f'http://127.0.0.1:{port}/requests', sheets, "Sheets stand-in")
+    return sheets
+
+
+def start_server(port, sheets_port, client_clock):
+    env = dict(os.environ,
+               ANTHILL_PORT=str(port),
+               ANTHILL_SHEETS_ENDPOINT=f'http://127.0.0.1:{sheets_port}',
+               ANTHILL_STATE_FILE='',
+               ANTHILL_IMPATIENT='1',
+               ANTHILL_CLIENT_CLOCK='1' if client_clock else '0')
+    server = subprocess.Popen([sys.executable, 'app.py'], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    wait_for(url + '/status', server, "Server")
+    return server, url
+
+
+def run(n_clients, n_matches, port, sheets_port, client_clock):
+    """Runs matches with a number of overlay clients connected, and returns the measurements."""
+    server, url = start_server(port, sheets_port, client_clock)
+    try:
+        overlays = [Overlay(url) for i in range(n_clients)]
+        control = Control(url)
+        cpu_before, rss_before = proc_usage(server.pid)
+        start = time.monotonic()
+        for i in range(n_matches):
+            control.run_match()
+        wall = time.monotonic() - start
+        cpu_after, rss_after = proc_usage(server.pid)
+        control.close()
+        for o in overlays:
+            o.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = [x for o in overlays for x in o.latencies]
+    jitter = [x for o in overlays for x in o.tick_jitter()]
+    ms = lambda x: None if x is None else round(x * 1000, 2)
+    return dict(
+        clients=n_clients,
+        matches=n_matches,
+        patches=len(latencies),
+        latency_p50_ms=ms(percentile(latencies, 50)),
+        latency_p95_ms=ms(percentile(latencies, 95)),
+        latency_p99_ms=ms(percentile(latencies, 99)),
+        latency_max_ms=ms(percentile(latencies, 100)),
+        tick_jitter_p95_ms=ms(percentile(jitter, 95)),
+        tick_jitter_max_ms=ms(percentile(jitter, 100)),
+        cpu_percent=None if cpu_before is None else round(100 * (cpu_after - cpu_before) / wall, 1),
+        rss_mb=None if rss_after is None else round(rss_after, 1),
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """Prints the change in each measurement since the previous run with the same number of clients."""
+    before = {r['clients']: r for r in previous['results']}
+    for result in current['results']:
+        old = before.get(result['clients'])
+        if old is None:
+            continue
+        changes = []
+        for key, value in result.items():
+            if key.endswith(('_ms', '_percent', '_mb')) and value is not None and old.get(key):
+                changes.append(f"{key} {100 * (value - old[key]) / old[key]:+.0f}%")
+        print(f"  {result['clients']} clients vs {previous['commit']}: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure overlay fan-out as clients are added.")
+    parser.add_argument('--clients', default='1,10,50', help="Comma-separated numbers of overlay clients")
+    parser.add_argument('--matches', type=int, default=1, help="Matches to run for each number of clients")
+    parser.add_argument('--event-size', type=int, default=10, help="Number of matches in the fake event")
+    parser.add_argument('--server-clock', action='store_true', help="Send the time every second from the server")
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--sheets-port', type=int, default=8099)
+    args = parser.parse_args()
+
+    sheets = start_sheets(args.sheets_port, args.event_size)
+    report = dict(
+        commit=git_commit(),
+        time=datetime.datetime.now().isoformat(timespec='seconds'),
+        client_clock=not args.server_clock,
+        event_size=args.event_size,
+        results=[],
+    )
+    try:
+        for n in [int(n) for n in args.clients.split(',')]:
+            result = run(n, args.matches, args.port, args.sheets_port, not args.server_clock)
+            print(json.dumps(result))
+            report['results'].append(result)
+    finally:
+        sheets.kill()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = 'server_clock.json' if args.server_clock else 'client_clock.json'
+    path = os.path.join(RESULTS_DIR, name)
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    if history:
+        compare(history[-1], report)
+    history.append(report)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1)
+    print(f"Saved to {path}")
+
+
+if __name__ == '__main__':
+    main()
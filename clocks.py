@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# This module is the match runner's source of time.  The schedulers, the match clock, the overlay patches, the
+# journal and the saved state all ask the current clock, rather than the time module, so that a simulation
+# (see simulate.py) can run the whole runner in virtual time: a tournament in seconds rather than hours.
+#
+# The real clock is used unless another is installed with install(), before anything is scheduled.
+#
+# Some timings deliberately stay in real time, on the time module: how long work takes (time.perf_counter(), for the
+# metrics), deadlines for requests to the Sheets API (sheetsapi.py), the leader's lease in Redis (shared.py) and the
+# interval between reads of the spreadsheet by the sheet sync worker, which a simulation doesn't run.
+
+import time
+
+
+class Clock:
+    """The real clock.
+
+    Attributes:
+        virtual: True if time only passes when a simulation says so.  Schedulers don't start their greenthreads
+            under a virtual clock, since the simulation runs their timers itself (see Scheduler.run_due()).
+    """
+    virtual = False
+
+    def now(self):
+        """Returns the server time in seconds.  Monotonic, so unaffected by NTP adjustments."""
+        return time.monotonic()
+
+    def wall(self):
+        """Returns the wall clock time, as for time.time()."""
+        return time.time()
+
+    def wait(self, event, timeout=None):
+        """Sleeps until an event is set, or for timeout seconds (None for no limit).  Returns True if it was set."""
+        return event.wait(timeout)
+
+
+class VirtualClock(Clock):
+    """A clock that stands still until it is moved on, for simulations.  Only the simulation's own thread may move it.
+    Sleeping moves it on, since there is nothing else to wait for."""
+    virtual = True
+
+    def __init__(self, start=0.0, epoch=None):
+        """
+        Args:
+            start: Server time at which the clock starts.
+            epoch: Wall clock time at server time 0.  Defaults to the real time now, less start.
+        """
+        self.t = start
+        self.epoch = time.time() - start if epoch is None else epoch
+
+    def now(self):
+        return self.t
+
+    def wall(self):
+        return self.epoch + self.t
+
+    def advance_to(self, t):
+        """Moves the clock on to server time t, unless it is already later."""
+        self.t = max(self.t, t)
+
+    def wait(self, event, timeout=None):
+        if not event.is_set() and timeout is not None:
+            self.t += timeout
+        return event.is_set()
+
+
+# The clock in use.
+clock = Clock()
+
+
+def install(new_clock):
+    """Makes new_clock the clock in use, e.g. a VirtualClock for a simulation.  Returns it."""
+    global clock
+    clock = new_clock
+    return clock
+
+
+def now():
+    """Returns the server time from the clock in use, as for Clock.now()."""
+    return clock.now()
+
+
+def wall():
+    """Returns the wall clock time from the clock in use, as for Clock.wall()."""
+    return clock.wall()
+
+
+def wait(event, timeout=None):
+    """Sleeps on the clock in use, as for Clock.wait()."""
+    return clock.wait(event, timeout)
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import atexit
 import logging
+import logging.handlers
+import os
 
 from flask import Flask
 from flask_socketio import SocketIO
@@ -8,17 +11,114 @@ import jinja2
 import eventlet
 eventlet.monkey_patch() # Changes the behaviour of "import time"
 
-# Note: this module won't work without a "service-credentials.json" file, 
-# for a Google Service account that has read access to the spreadsheet.
-# For security reasons, this file is not included in the github repo.
-import sheet
-
 # If set to true, this reduces the time of various things like running the match and showing a table.
 # This makes it easier to test and debug.  Set it to false for actual competition.
-impatient = False 
+# (Setting the ANTHILL_IMPATIENT environment variable to 1 has the same effect.)
+impatient = os.environ.get('ANTHILL_IMPATIENT') == '1'
+
+# If set to true, the overlays run the match clock themselves from a single message sent at the start of the match,
+# and play the audio cues on time.  If false, the server sends the time and audio cues every second.
+client_clock = os.environ.get('ANTHILL_CLIENT_CLOCK', '1') == '1'
+
+# Port for the web server.  Docker maps this to 8081 (see run.sh).
+PORT = int(os.environ.get('ANTHILL_PORT', '80'))
+
+# Where the matches and teams are read from (see backends.py): "sheets" for the Google spreadsheet below,
+# "sqlite" for a local SQLite file, or "csv" for a local directory holding matches.csv and teams.csv.
+BACKEND = os.environ.get('ANTHILL_BACKEND', 'sheets')
+# The SQLite file or CSV directory, for those backends.
+DATA_PATH = os.environ.get('ANTHILL_DATA_PATH') or None
+# The Google spreadsheet with the matches and teams.  If you re-use this, create your own spreadsheet.
+SPREADSHEET_ID = os.environ.get('ANTHILL_SPREADSHEET_ID', '1i9qLuN4PvYHannhivg4ZGla0Yh7DTqdWOUIADFNxZAQ')
+# Ranges to read from the spreadsheet, by kind.  All are fetched together in one request.
+# The first row of each range is a header row.  Other backends read every kind listed here.
+SHEET_RANGES = dict(
+    matches='Matches!A1:Z',
+    teams='Teams!A1:Z',
+)
+# Column names used in the code and templates (e.g. "Red Score"), mapped to the header used in the spreadsheet, by kind.
+# Only needed where the spreadsheet uses a different header, e.g. matches={'Red Score': 'Red Total'}.
+SHEET_HEADERS = dict(
+    matches={},
+    teams={},
+)
+# Rounds whose matches count towards the standings (see standings.py), e.g. ("R",) to leave out the playoffs.
+# None to count every round.
+STANDINGS_ROUNDS = None
+# Columns of the matches range that must all hold numbers before a match's scores count as entered (see watcher.py).
+SCORE_COLUMNS = ('Red Score', 'Blue Score')
+# If set to true, the scores of a match are shown as soon as they have been entered, without pressing the button.
+# (Setting the ANTHILL_AUTO_SHOW_SCORES environment variable to 1 has the same effect.)
+AUTO_SHOW_SCORES = os.environ.get('ANTHILL_AUTO_SHOW_SCORES') == '1'
+# Names of the fields (arenas) run by this server, each with its own overlays, control interface, match clock and
+# table rotation.  Overlays and control interfaces choose one with their "arena" URL parameter, or get the first.
+# Set ANTHILL_ARENAS to a comma-separated list, e.g. "1,2", to run several fields.
+ARENAS = os.environ.get('ANTHILL_ARENAS', 'main').split(',')
+# Rows per table on the overlay: the match and team tables are shown a screen at a time.
+MATCHES_PER_SCREEN = 10
+TEAMS_PER_SCREEN = 10
+# If set to true, tables are sent to the overlays as rows of data (or just the rows that changed), which they show
+# with templates from static/tables.  If false, they are sent as HTML rendered from the templates in template/.
+# (Setting the ANTHILL_TABLE_DATA environment variable to 0 turns this off.)
+TABLE_DATA = os.environ.get('ANTHILL_TABLE_DATA', '1') == '1'
+# Screens of matches shown in each rotation of the tables, starting with the screen holding the next match to play.
+MATCH_SCREENS = 2
+# Matches per page in the control interface's match browser.
+BROWSER_PAGE_SIZE = 20
+# File in which to keep the runner's state, so that it can be restarted without losing the match in progress.
+# Set ANTHILL_STATE_FILE to an empty string to disable.
+STATE_FILE = os.environ.get('ANTHILL_STATE_FILE', 'state.json.gz') or None
+# Root URL of the Sheets API, e.g. "http://localhost:8099" to test against a local fake.  None for Google.
+SHEETS_ENDPOINT = os.environ.get('ANTHILL_SHEETS_ENDPOINT')
+# Deadline for each request to the Sheets API, in seconds.
+SHEETS_TIMEOUT = 10
+# Redis URL (e.g. "redis://localhost:6379/0") through which several server processes share clients and state.
+# None to run a single process.  See shared.py.
+MESSAGE_QUEUE = os.environ.get('ANTHILL_MESSAGE_QUEUE') or None
+# If set to true, timings and counts from the hot paths are collected and served at /metrics (see metrics.py).
+# Setting ANTHILL_METRICS to 0 disables this, so recording costs nothing.
+METRICS = os.environ.get('ANTHILL_METRICS', '1') == '1'
+# Audio cues played by the overlays, mapped to files in static/audio.
+AUDIO_CUES = dict(
+    countdown='beep-02.mp3',
+    start='match_start.wav',
+    warning='train-whistle-01.mp3',
+    end='ENDMATCH.mp3',
+)
+# Gain (volume) of the audio cues, from 0 (muted) to 1 (as recorded), by overlay role (its "role" URL parameter).
+# The control interface shows the overlay with role "preview", muted so it doesn't compete with the real overlay.
+# An overlay can override this with its "gain" URL parameter.
+AUDIO_GAIN = dict(
+    default=0.5,
+    preview=0,
+)
+# Longest delay, in seconds, that an overlay can ask for with its "delay" URL parameter (see journal.py).
+MAX_DELAY = 60
+# Number of events kept in each arena's journal, for overlays with a delay.  This must cover MAX_DELAY seconds.
+JOURNAL_SIZE = 2000
+# File to which every event sent to the overlays is appended, as a line of JSON, for replay after the event, or None.
+JOURNAL_FILE = os.environ.get('ANTHILL_JOURNAL_FILE') or None
+# File to which every patch, emit, render, sheet fetch and match tick is appended as a line of JSON, or None.
+TRACE_FILE = os.environ.get('ANTHILL_TRACE_FILE') or None
 
+# Log records are put on a queue and written out by a background thread, so logging never blocks the caller
+# (e.g. a match clock tick) on writing to the console.
+class _LogListener(logging.handlers.QueueListener):
+    """Writes out the queued records on a real OS thread, from a queue that isn't monkey patched.
+    A green thread would write on the hub's thread, so a slow console would still stall every green thread."""
+    def start(self):
+        self._thread = eventlet.patcher.original('threading').Thread(target=self._monitor, name="Log writer",
+                                                                     daemon=True)
+        self._thread.start()
+
+
+_log_queue = eventlet.patcher.original('queue').Queue()
+logging.basicConfig(handlers=[logging.handlers.QueueHandler(_log_queue)])
+# basicConfig() gives the queue handler the usual format, so records arrive at the listener already formatted.
+_log_listener = _LogListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
-logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
 # Serve files from local static folder
@@ -26,11 +126,18 @@ app = Flask(__name__, static_url_path='', static_folder='static')
 
 app.config['SECRET_KEY'] = 'secret!'
 #app.config['DEBUG'] = True
-socketio = SocketIO(app, always_connect=True)
+socketio = SocketIO(app, always_connect=True, message_queue=MESSAGE_QUEUE)
 # Note that there are two namespaces in use here:
 # * overlay: This is output-only and is used as an overlay over the video feed.
 # * control: This is an interface that consists of buttons that change behaviour.
 
 # Load Jinja2 templates from template folder
-_loader = jinja2.FileSystemLoader('template')
-env = jinja2.Environment(loader=_loader, autoescape=False)
\ No newline at end of file
+_loader = jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template'))
+# Blank cells are read as None, which should render as nothing rather than "None".
+env = jinja2.Environment(loader=_loader, autoescape=False, finalize=lambda value: "" if value is None else value)
+
+# Note: the sheets backend won't work without a "service-credentials.json" file,
+# for a Google Service account that has read access to the spreadsheet.
+# For security reasons, this file is not included in the github repo.
+# Imported last, since sheet (and the modules it imports) use the settings above.
+import sheet
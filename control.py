@@ -2,106 +2,350 @@
 
 # This module provides the handlers for messages from the control interface 
 # and the primitives for communicating to the control interface.
+#
+# Commands that change the runner's state are marked with shared.leader_command, so that they run on the leader
+# whichever worker the control interface is connected to.
+#
+# Log messages are kept in a fixed-size ring buffer (in the shared store), and sent to the control interface
+# in batches.  Recording a message never waits for the network, so it can be done from a match clock tick.
+# A control interface that (re)connects asks for the backlog, a page at a time.
+#
+# Buttons have stable keys, and only the buttons that changed are sent.  Matches are chosen from a match browser
+# that asks the server for one page of matches at a time, so messages stay the same size however big the event.
+#
+# Each field (arena) has its own buttons, and its control interfaces join a room named after it.  Commands
+# apply to the arena of the control interface that sent them.  The log is shared, with each message tagged
+# with its arena, if any.
 
+import logging
+import threading
+
+from flask import request
+from flask_socketio import join_room
+
+import clocks
 import config
 import sheet
 import thread
 import overlay
+import persist
+import shared
+
+
+def get_buttons(arena):
+    """Returns the buttons last sent to an arena, from the shared store.  They are resent on a "connect" message."""
+    return shared.store.get(f'buttons:{arena}', [])
+
+
+# Number of log messages kept for control interfaces that reconnect.
+LOG_SIZE = 1000
+# Seconds to collect log messages before sending them together.
+LOG_BATCH_DELAY = 0.1
+# Number of log messages sent at a time from the backlog.
+LOG_PAGE_SIZE = 100
+
+# Log messages waiting to be sent, and whether a send is scheduled.
+_pending_log = []
+_log_flush_scheduled = False
 
-# These globals store the last value sent on various parts of the overlay
-# We need to resend these if we get a "connect" message.
-# Note: Not thread-safe, but doesn't seem to matter.
-current_buttons = [] # list of button dicts
 
-def log_message(message):
+def log_message(message, level="info", arena=None):
     """This sends a log message to the control interface.
-    This is printed on-screen and also sent to log.
+    This is shown on-screen and also sent to log.
+    The message is queued and sent shortly afterwards, together with any others, so this never blocks.
+
+    Args:
+        message: Text of message.
+        level: "info", "warning" or "error".
+        arena: Name of the arena the message is about, or None.
+    """
+    global _log_flush_scheduled
+    config.logger.log(getattr(logging, level.upper(), logging.INFO), "%s%s", "" if arena is None else f"{arena}: ",
+                      message)
+    _pending_log.append(dict(t=clocks.wall(), level=level, message=message, arena=arena))
+    if not _log_flush_scheduled:
+        _log_flush_scheduled = True
+        threading.Thread(target=_flush_log, name="Log flush", daemon=True).start()
+
+
+def _flush_log():
+    """Stores and sends the pending log messages, after waiting for more to arrive."""
+    global _pending_log, _log_flush_scheduled
+    config.socketio.sleep(LOG_BATCH_DELAY)
+    batch, _pending_log = _pending_log, []
+    _log_flush_scheduled = False
+    try:
+        last = shared.store.increment('log_id', len(batch))
+        for i, entry in enumerate(batch):
+            entry['id'] = last - len(batch) + 1 + i
+        shared.store.append('log', batch, LOG_SIZE)
+        config.socketio.emit('log_messages', batch, namespace="/control")
+    except Exception:
+        config.logger.exception("Error sending log messages")
+
+
+def get_log_page(before=None, limit=LOG_PAGE_SIZE):
+    """Returns a page of the log backlog.
+
+    Args:
+        before: ID of the oldest message already shown, to get the page before it, or None for the latest page.
+        limit: Maximum number of messages.
+
+    Returns:
+        page: dict with "entries", a list of dicts with id, t (time), level, message and arena, oldest first,
+            and "more", true if there are older messages still.
+    """
+    first = shared.store.slice('log', 0, 1)
+    if not first:
+        return dict(entries=[], more=False)
+    first_id = first[0]['id']
+    if before is None:
+        entries = shared.store.slice('log', -limit)
+    else:
+        stop = max(0, before - first_id)
+        entries = [e for e in shared.store.slice('log', max(0, stop - limit), stop) if e['id'] < before]
+    return dict(entries=entries, more=bool(entries) and entries[0]['id'] > first_id)
+
+
+def show_clients(worker, clients):
+    """Shows the measured latency of the overlays connected to a worker.
+
+    Args:
+        worker: ID of the worker the overlays are connected to.
+        clients: List of dicts, as for overlay.describe_clients().
+    """
+    config.socketio.emit('set_clients', dict(worker=worker, clients=clients), namespace="/control")
+
+
+def button_key(button):
+    """Returns the key that identifies a button across updates: its "key" field, or its event and argument."""
+    return button.get('key') or f"{button['event']}:{button['arg']}"
+
+
+def diff_buttons(old, new):
+    """Works out how to change one list of buttons into another.
+
+    Args:
+        old, new: Lists of buttons, each with a key.
+
+    Returns:
+        patch: dict with fields:
+            remove: List of keys of buttons to remove.
+            put: List of buttons to add or replace, in order, each with an "after" field: the key of the button
+                it follows, or None to go first.  Buttons that are unchanged are left out, as long as they and
+                every button before them still follow the same button, so are already in the right place.
     """
-    config.socketio.emit('log_message', message, namespace="/control")
-    config.socketio.sleep(0)
-    print(message)
+    new_keys = {b['key'] for b in new}
+    old_buttons = {b['key']: b for b in old}
+    kept = [b['key'] for b in old if b['key'] in new_keys]
+    old_after = dict(zip(kept, [None] + kept[:-1]))
+    put = []
+    after = None
+    # The client moves each button put on its own, so a button only stays in place if those before it do too.
+    in_place = True
+    for button in new:
+        key = button['key']
+        in_place = in_place and old_after.get(key, 0) == after
+        if not in_place or old_buttons.get(key) != button:
+            put.append(dict(button, after=after))
+        after = key
+    return dict(remove=[b['key'] for b in old if b['key'] not in new_keys], put=put)
 
 
-def set_buttons(buttons, clear=True):
-    """Sets the buttons in the interface.
+def set_buttons(arena, buttons, clear=True):
+    """Sets the buttons in an arena's control interfaces.
+    Only the buttons that changed are sent (see diff_buttons()).
     TODO: Add button colours, sections.
     
     Args:
+        arena: Name of the arena.
         buttons: List of dicts with fields:
             event: Event to invoke on the websocket.
             label: Text for button.
             arg: Argument to send in event.
+            key: Optional key identifying the button, if the event and argument don't.
         clear: If set to false, then new buttons are appended to existing ones.
     """
             
-    config.logger.info("Setting buttons: %r", buttons)
-    global current_buttons
-    current_buttons = buttons
-    config.socketio.emit('set_buttons', dict(buttons=buttons, clear=clear), namespace="/control")
+    config.logger.info("Setting buttons in %s: %r", arena, buttons)
+    old = get_buttons(arena)
+    new = [dict(b, key=button_key(b)) for b in buttons]
+    if not clear:
+        new = old + [b for b in new if b['key'] not in {o['key'] for o in old}]
+    patch = diff_buttons(old, new)
+    shared.store.set(f'buttons:{arena}', new)
+    if patch['remove'] or patch['put']:
+        config.socketio.emit('patch_buttons', patch, room=arena, namespace="/control")
+    persist.mark_dirty()
     
     
-@config.socketio.on('next_match', namespace="/control")
-def next_match(match_id):
+def _log_sheet_change(kind):
+    """Returns a sheet subscriber that tells the control interface what changed."""
+    def callback(snapshot, changed):
+        log_message(f"Spreadsheet {kind} changed (version {snapshot.version}): {', '.join(sorted(map(str, changed)))}")
+    return callback
+
+
+def _matches_changed(snapshot, changed):
+    """Tells the control interfaces that the matches changed, so they refresh their match browsers."""
+    config.socketio.emit('matches_changed', dict(version=snapshot.version), namespace="/control")
+
+
+sheet.subscribe('matches', _log_sheet_change('matches'))
+sheet.subscribe('matches', _matches_changed)
+sheet.subscribe('teams', _log_sheet_change('teams'))
+
+
+def command(event):
+    """Decorator for handlers of commands from the control interface, which change the state of an arena.
+    The handler is called on the leader (see shared.leader_command()), with the name of the arena of the control
+    interface that sent the command, followed by the command's argument."""
+    def decorator(handler):
+        run = shared.leader_command(handler)
+
+        def on_event(*args):
+            return run(overlay.request_arena(), *args)
+
+        on_event.__name__ = f"on_{event}"
+        config.socketio.on(event, namespace="/control")(on_event)
+        return run
+
+    return decorator
+
+
+@command('next_match')
+def next_match(arena, match_id):
     """Display a message in the overlay about which match is starting next.
     Changes buttons to start and cancel.
     
     Args:
+        arena: Name of the arena.
         match_id: E.g. "R1"
     """
-    thread.set_thread()
     match = sheet.get_match(match_id);
     assert match
-    log_message(f"Next match {match_id}")
-    overlay.update_text(
-        redteam=match["Red Competitors"],
-        blueteam=match["Blue Competitors"],
-        middle=f"Next match<br/>{match_id}<br/>Starting soon")
-    set_buttons([
-        dict(event="start_match", arg=match_id, label=f"Start match {match_id}"),
-        dict(event="abort_match", arg="", label=f"Cancel next match {match_id}"),
-    ])
+    if match_id in thread.busy_matches(arena):
+        log_message(f"Match {match_id} is already taken by another arena", level="warning", arena=arena)
+        return
+    log_message(f"Next match {match_id}", arena=arena)
+    thread.set_state(arena, thread.NextMatchState(match_id))
     
     
-@config.socketio.on('abort_match', namespace="/control")
-def abort_match(match_id):
+@command('abort_match')
+def abort_match(arena, match_id):
     """Returns to cycling, whatever is happening.  Can be used as a general abort on a specific match regardless of state.
     
     Args:
+        arena: Name of the arena.
         match_id: Identifer for match being aborted.  Used only for logging.
     """
-    log_message(f"Aborting match {match_id}")
-    thread.cycle()
+    log_message(f"Aborting match {match_id}", arena=arena)
+    thread.cycle(arena)
     
    
-@config.socketio.on('start_match', namespace="/control")
-def start_match(match_id):
+@command('start_match')
+def start_match(arena, match_id):
     """Starts the runner for a match.
     The button for this will only be available when this match is next.
     
     Args:
+        arena: Name of the arena.
         match_id: Identifier like "R1".
     """
-    overlay.update_text(middle=f"Starting Match {match_id}")
-    thread.set_thread(thread.MatchThread(match_id))
+    if match_id in thread.busy_matches(arena):
+        log_message(f"Match {match_id} is already taken by another arena", level="warning", arena=arena)
+        return
+    overlay.update_text(arena, middle=f"Starting Match {match_id}")
+    thread.set_state(arena, thread.MatchState(match_id))
     
     
-@config.socketio.on('show_match_scores', namespace="/control")
-def show_match_scores(match_id):
+@command('show_match_scores')
+def show_match_scores(arena, match_id):
     """Show scores for a specific match.
     Button only available after match has run to completion."""
-    thread.set_thread(thread.MatchScoreThread(match_id))
+    # If the score watcher has already read and rendered the scores, there is no need to read them again.
+    state = thread.arenas[arena].current_state
+    ready = isinstance(state, thread.MatchState) and state.match_id == match_id and state.scores_ready
+    thread.set_state(arena, thread.MatchScoreState(match_id, flush=not ready))
+    
+    
+@config.socketio.on('get_log', namespace="/control")
+def get_log(query=None):
+    """Returns a page of the log backlog, as for get_log_page(), as the acknowledgement.
+
+    Args:
+        query: dict with optional fields before and limit, as for get_log_page().
+    """
+    query = query or {}
+    return get_log_page(query.get('before'), min(int(query.get('limit', LOG_PAGE_SIZE)), LOG_SIZE))
+
+
+@config.socketio.on('browse_matches', namespace="/control")
+def browse_matches(query=None):
+    """Returns a page of matches for the match browser, as the acknowledgement.
+
+    Args:
+        query: dict with optional fields:
+            status: "played", "unplayed", or anything else for all matches.
+            round: Round, e.g. "R", or empty for all.
+            team: Competitors (or part of a label), or empty for all.
+            page: Page number, from 0.
+            version: Version of the sheet snapshot to show, if known (from a "matches_changed" event).
+
+    Returns:
+        page: dict with fields:
+            matches: List of dicts with id, round, red, blue, red_score, blue_score and played.
+            page: Page number returned, which is the last page if the one asked for is past the end.
+            pages: Number of pages.
+            total: Number of matches found.
+            rounds: List of all rounds, for the round filter.
+            next: ID of the first match not yet played, or None.
+    """
+    query = query or {}
+    snapshot = sheet.get_snapshot(query.get('version'))
+    played = dict(played=True, unplayed=False).get(query.get('status'))
+    matches = snapshot.find_matches(played=played, round=query.get('round') or None, team=query.get('team') or None)
+    size = config.BROWSER_PAGE_SIZE
+    pages = max(1, -(-len(matches) // size))
+    page = min(max(0, int(query.get('page') or 0)), pages - 1)
+    next_match = snapshot.next_match()
+    return dict(
+        matches=[dict(id=m.id, round=m.round, red=m.red, blue=m.blue, red_score=m.red_score, blue_score=m.blue_score,
+                      played=m.played) for m in matches[page * size:(page + 1) * size]],
+        page=page,
+        pages=pages,
+        total=len(matches),
+        rounds=list(snapshot.matches_by_round),
+        next=None if next_match is None else next_match.id,
+    )
+
+
+@config.socketio.on('get_status', namespace="/control")
+def get_status():
+    """Returns the current state and pending timers, as for thread.describe(), as the acknowledgement.
+    Only the leader has a state, so on other workers this just says which worker is the leader."""
+    return thread.describe()
     
     
 @config.socketio.on('connect', namespace="/control")
 def handle_control_connect():
     """Invoked when the control interface connects.
-    Sends current buttons.
-    Should only be one of these at a time.
+    Joins the room of its arena (see overlay.request_arena()), and sends the arena's current buttons,
+    to the new control interface only.
+    Should only be one of these at a time for each arena.
     """
-    config.logger.info("Connect control")
-    log_message("Connected")
-    global current_buttons
-    set_buttons(current_buttons)
+    arena = overlay.request_arena()
+    config.logger.info("Connect control to %s", arena)
+    overlay.CLIENTS.inc('/control')
+    join_room(arena)
+    log_message("Connected", arena=arena)
+    config.socketio.emit('set_buttons', dict(buttons=get_buttons(arena), clear=True, arena=arena), room=request.sid,
+                         namespace="/control")
     config.logger.info("Connect control done")
     if config.impatient:
-        log_message("Warning: Impatient mode is set, so many times are much shorter than they should be")
\ No newline at end of file
+        log_message("Warning: Impatient mode is set, so many times are much shorter than they should be", level="warning")
+
+
+@config.socketio.on('disconnect', namespace="/control")
+def handle_control_disconnect():
+    overlay.CLIENTS.dec('/control')
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# This module keeps a journal of the events sent to the overlays, and replays it to overlays that show a delayed
+# video feed (those with a "delay" URL parameter).
+#
+# Every patch and audio cue sent to an arena's overlays is appended to the arena's journal, with the wall clock
+# time at which it was sent.  Each patch entry also has the state of the overlay after it, without the table HTML.
+# The journal is kept in the shared store (see shared.py), bounded to config.JOURNAL_SIZE entries per arena.
+#
+# A delayed overlay joins the room for its arena and delay, rather than the arena's room, and the leader runs a
+# Stream for each such room.  The stream sends each event from the journal shortly before it is due, so an overlay
+# only holds the next few events rather than every event in the last delay seconds.  An overlay that connects
+# (or reloads) is sent the state from the journal as of delay seconds ago, so it shows the right thing at once.
+#
+# If config.JOURNAL_FILE is set, every entry is also appended to that file, for replay after the event.
+# Each line is JSON with fields arena, id, t, event and data.  The HTML (or data) of each table is only written the
+# first time.
+
+import json
+import math
+import threading
+
+import clocks
+import config
+import overlay
+import shared
+
+# Seconds before an event is due that a stream sends it, so it reaches the overlay in time.
+STREAM_AHEAD = 1
+
+# Delays are rounded down to a multiple of this, in seconds, so overlays with nearly the same delay share a stream.
+DELAY_STEP = 0.1
+
+# Streams run by this worker (the leader), by room.
+streams = {}
+
+_file = None
+_file_lock = threading.Lock()
+_written_fragments = set()
+
+
+def stream_delay(delay):
+    """Returns the delay of the stream for an overlay's "delay" URL parameter (in seconds, as a string or number):
+    rounded down to a multiple of DELAY_STEP, and at most config.MAX_DELAY.  0 for no delay (or a bad value)."""
+    try:
+        delay = float(delay or 0)
+    except ValueError:
+        return 0
+    if not 0 < delay < float('inf'):
+        return 0
+    # Rounded before flooring, since e.g. 2 / 0.1 is not exactly 20.
+    return round(math.floor(round(min(delay, config.MAX_DELAY) / DELAY_STEP, 6)) * DELAY_STEP, 3)
+
+
+def room(arena, delay):
+    """Returns the name of the room for overlays showing an arena with a delay (as from stream_delay())."""
+    return arena if not delay else f"{arena}@{delay:g}"
+
+
+def record(arena, event, data, state=None):
+    """Appends an event to an arena's journal, and wakes the arena's streams.
+
+    Args:
+        arena: Name of the arena.
+        event: Name of the event, e.g. "patch".
+        data: The event's data, as sent to the overlays.
+        state: For a patch, the overlay state after it, as for overlay.get_state().
+    """
+    entry = dict(id=shared.store.increment(f'journal_id:{arena}'), t=clocks.wall(), event=event, data=data)
+    if state is not None:
+        name, content, fragment_id = state['table']
+        entry['state'] = dict(seq=state['seq'], text=state['text'], table=[name, None, fragment_id],
+                              clock=state['clock'])
+    shared.store.append(f'journal:{arena}', [entry], config.JOURNAL_SIZE)
+    for stream in list(streams.values()):
+        if stream.arena == arena:
+            stream.wakeup.set()
+    if config.JOURNAL_FILE is not None:
+        _spill(arena, entry)
+
+
+def _spill(arena, entry):
+    """Appends an entry to config.JOURNAL_FILE, leaving out table HTML (or data) that has already been written."""
+    global _file
+    data = entry['data']
+    table = data.get('table')
+    if table is not None and ('html' in table or 'data' in table):
+        if table['id'] in _written_fragments:
+            data = dict(data, table=dict(id=table['id']))
+        else:
+            _written_fragments.add(table['id'])
+    line = json.dumps(dict(arena=arena, id=entry['id'], t=round(entry['t'], 6), event=entry['event'], data=data),
+                      separators=(',', ':')) + "\n"
+    with _file_lock:
+        try:
+            if _file is None:
+                _file = open(config.JOURNAL_FILE, 'a', buffering=1)
+            _file.write(line)
+        except OSError:
+            config.logger.exception(f"Error writing journal to {config.JOURNAL_FILE}")
+
+
+def is_sent(entry, delay, now):
+    """Returns True if a stream with a delay has sent an entry by a wall clock time."""
+    return entry['t'] + delay - STREAM_AHEAD <= now
+
+
+def state_at(arena, delay):
+    """Returns the overlay state that an arena's stream with a delay has sent, as for overlay.get_state() but with no
+    table HTML, or None if the journal is empty.
+    If even the oldest entry has not been sent (as just after a restart), its state is returned, a little early."""
+    entries = shared.store.slice(f'journal:{arena}', 0)
+    now = clocks.wall()
+    states = [e for e in entries if 'state' in e]
+    if not states:
+        return None
+    sent = [e for e in states if is_sent(e, delay, now)]
+    return (sent[-1] if sent else states[0])['state']
+
+
+class Stream:
+    """Sends the events in an arena's journal to the room of the overlays with a delay, as each falls due.
+    Runs on a greenthread on the leader."""
+
+    def __init__(self, arena, delay):
+        self.arena = arena
+        self.delay = delay
+        self.room = room(arena, delay)
+        self.wakeup = threading.Event()
+        self.last_id = None # ID of the last entry sent.
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"Stream {self.room}", daemon=True).start()
+
+    def _pending(self):
+        """Returns the journal entries not yet sent, oldest first."""
+        if self.last_id is None:
+            # Start with the entries not yet due, since overlays that join are sent a snapshot of the rest.
+            now = clocks.wall()
+            entries = shared.store.slice(f'journal:{self.arena}', 0)
+            sent = [e for e in entries if is_sent(e, self.delay, now)]
+            self.last_id = sent[-1]['id'] if sent else (entries[0]['id'] - 1 if entries else 0)
+        n_new = shared.store.get(f'journal_id:{self.arena}', 0) - self.last_id
+        if n_new <= 0:
+            return []
+        return [e for e in shared.store.slice(f'journal:{self.arena}', -n_new) if e['id'] > self.last_id]
+
+    def _run(self):
+        while True:
+            # Clear before looking at the journal, so an entry added meanwhile still wakes us.
+            self.wakeup.clear()
+            wait = None
+            try:
+                for entry in self._pending():
+                    now = clocks.wall()
+                    if not is_sent(entry, self.delay, now):
+                        wait = entry['t'] + self.delay - STREAM_AHEAD - now
+                        break
+                    # Stamped with the time it is actually sent, which overlays use to estimate their clock offset.
+                    data = dict(entry['data'], ts=overlay.server_time())
+                    config.socketio.emit(entry['event'], data, room=self.room, namespace="/overlay")
+                    self.last_id = entry['id']
+            except Exception:
+                config.logger.exception(f"Error in stream {self.room}")
+                wait = 1
+            self.wakeup.wait(wait)
+
+
+@shared.leader_command
+def open_stream(arena, delay):
+    """Starts the stream for overlays with a delay in an arena, if not already running.
+    Called when such an overlay connects, on whichever worker, and runs on the leader."""
+    name = room(arena, delay)
+    if name in streams:
+        return
+    config.logger.info(f"Starting stream {name}")
+    streams[name] = stream = Stream(arena, delay)
+    stream.start()
+    # Remember the streams, so that a worker that takes over as leader starts them too.
+    shared.store.set('streams', [[s.arena, s.delay] for s in streams.values()])
+
+
+def restore_streams():
+    """Starts the streams that the previous leader was running.  Called when this worker becomes the leader."""
+    for arena, delay in shared.store.get('streams', []):
+        if arena in config.ARENAS:
+            open_stream(arena, delay)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# This module collects counters, gauges and timings from the hot paths of the server, and serves them
+# in the Prometheus text format at /metrics.  It can also write a trace: one JSON line per event.
+#
+# Metrics are declared once, at import, by the module that records them.  Recording is a dict lookup and an
+# addition, and does nothing at all when config.METRICS is false.  Each process (worker) has its own metrics.
+#
+# Example:
+#     FETCH_SECONDS = metrics.histogram('sheet_fetch_seconds', "Time to read the spreadsheet")
+#     with metrics.timed(FETCH_SECONDS):
+#         ...
+
+import bisect
+import json
+import threading
+import time
+
+import clocks
+import config
+
+# Upper bounds of histogram buckets, in seconds, unless a metric is declared with its own.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric, by name, in the order declared.
+registry = {}
+
+# File that trace events are written to, when config.TRACE_FILE is set.
+_trace_file = None
+_trace_lock = threading.Lock()
+
+
+class Metric:
+    """A named metric, with a value for each combination of label values.
+
+    Args:
+        name: Name in the Prometheus format, e.g. "patches_total".
+        help: One line description.
+        labels: Names of labels, e.g. ("template",).  Values are passed positionally when recording.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry[name] = self
+
+    def samples(self):
+        """Yields (suffix, label string, value) for each sample to expose."""
+        for key, value in sorted(self.values.items()):
+            yield "", format_labels(self.labels, key), value
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not config.METRICS: return
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the number of connected clients."""
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        if not config.METRICS: return
+        self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        if not config.METRICS: return
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Distribution of observations (usually durations, in seconds) in fixed buckets."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if not config.METRICS: return
+        entry = self.values.get(labels)
+        if entry is None:
+            # Count in each bucket (not cumulative), then count and sum of all observations.
+            entry = self.values[labels] = [[0] * len(self.buckets), 0, 0.0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    def samples(self):
+        for key, (counts, count, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield "_bucket", format_labels(self.labels + ('le',), key + (f"{bound:g}",)), cumulative
+            yield "_bucket", format_labels(self.labels + ('le',), key + ("+Inf",)), count
+            yield "_count", format_labels(self.labels, key), count
+            yield "_sum", format_labels(self.labels, key), total
+
+
+def counter(name, help, labels=()):
+    return Counter(name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return Gauge(name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return Histogram(name, help, labels, buckets)
+
+
+class _Timed:
+    """Context manager that observes its duration in a histogram."""
+    __slots__ = ('metric', 'labels', 'start')
+
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metric.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class _NotTimed:
+    """Context manager that does nothing, used when metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_not_timed = _NotTimed()
+
+
+def timed(metric, *labels):
+    """Returns a context manager that records how long its body takes in a histogram.
+
+    Args:
+        metric: Histogram to record in.
+        *labels: Label values, if the histogram has labels.
+    """
+    if not config.METRICS:
+        return _not_timed
+    return _Timed(metric, labels)
+
+
+def format_labels(names, values):
+    """Returns labels in the Prometheus format, e.g. '{template="match.html"}', or "" if there are none."""
+    if not names:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def exposition():
+    """Returns every metric in the Prometheus text format."""
+    lines = []
+    for metric in list(registry.values()):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, value in list(metric.samples()):
+            lines.append(f"{metric.name}{suffix}{labels} {value:g}" if isinstance(value, float)
+                         else f"{metric.name}{suffix}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def trace(event, **fields):
+    """Writes an event to the trace file (config.TRACE_FILE), if set, as one line of JSON with the wall clock time
+    (from clocks.wall(), so a simulation's trace is in virtual time).
+
+    Args:
+        event: Name of the event, e.g. "patch".
+        **fields: Details of the event.  Values that aren't JSON-compatible are written as strings.
+    """
+    global _trace_file
+    if config.TRACE_FILE is None:
+        return
+    line = json.dumps(dict(t=round(clocks.wall(), 6), event=event, **fields), default=str) + "\n"
+    with _trace_lock:
+        if _trace_file is None:
+            _trace_file = open(config.TRACE_FILE, 'a', buffering=1)
+        _trace_file.write(line)
+
+
+@config.app.route('/metrics')
+def serve_metrics():
+    """Serves the metrics for Prometheus to scrape."""
+    return exposition(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
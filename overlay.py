@@ -2,74 +2,467 @@
 
 # Ths module provides the primitives that communicate to the overlay interface
 # and the handlers that handle messages from it.
+#
+# The state of the overlay (its text areas, table and match clock) is versioned by a sequence number.
+# Each change is broadcast as a "patch" carrying only what changed and the new sequence number.
+# An overlay that sees a gap in the sequence asks for a "resync", and gets a complete snapshot of the state.
+# A newly connected overlay is sent a snapshot, addressed only to itself.
+#
+# The state is kept in the shared store (see shared.py), so that any worker can send a snapshot.
+# Only the leader changes it.
+#
+# Each overlay is pinged regularly, and its acknowledgement gives the round trip time and the offset between
+# its clock and the server's.  Every patch and audio cue is stamped with a target display time ("at", in server
+# time), far enough ahead for the slowest overlay to have received it.  Overlays queue events and apply them in
+# order at that time, so they all change together, and a slow table can't overtake the text sent after it.
+#
+# Each field (arena, see config.ARENAS) has its own overlay state, and its overlays join a room named after it,
+# so every primitive here takes the arena it applies to.  HTML fragments are shared by every arena.
+#
+# A table is either an HTML fragment or, if config.TABLE_DATA is set, a table of data (see table.py) that the
+# overlays fill into their own copy of a template.  Both are kept and sent the same way, by fragment ID.  When a
+# table of data replaces an earlier version of the same table, overlays are sent only the rows that changed.
+#
+# Overlays with a "delay" URL parameter join a room for their arena and delay instead, and are sent the events
+# from the journal as they fall due (see journal.py).
 
+import collections
+import functools
+import hashlib
+import json
+import threading
+
+from flask import request
+from flask_socketio import join_room
+
+import audio
+import clocks
 import config
 import control
+import journal
+import metrics
+import persist
+import shared
+import table as tables
+
+# Number of recent HTML fragments (and tables of data) kept, so overlays that missed one can fetch it by ID.
+FRAGMENT_CACHE_SIZE = 32
+
+# Value of every text area when cleared.
+BLANK_TEXT = dict(redteam="", blueteam="", middle="", time="", match="")
+
+# State of the overlay before anything has been shown.  See get_state().
+INITIAL_STATE = dict(seq=0, text=BLANK_TEXT, table=["", None, None], clock=None)
+
+EMIT_SECONDS = metrics.histogram('overlay_emit_seconds', "Time to emit a message to the overlays", ('event',))
+PATCHES = metrics.counter('overlay_patches_total', "Patches sent to the overlays, by part of the state", ('part',))
+CLIENTS = metrics.gauge('connected_clients', "Connected clients", ('namespace',))
+CLIENT_RTT = metrics.histogram('overlay_rtt_seconds', "Round trip time of pings to overlays")
+
+# Seconds between pings to each overlay.
+PING_INTERVAL = 5
+# Number of recent pings used to estimate latency and clock offset.  The ping with the shortest round trip is used.
+PING_SAMPLES = 8
+# Bounds, in seconds, on how far ahead of sending an event its target display time is set.
+MIN_LEAD = 0.05
+MAX_LEAD = 0.5
+
+# Latency and clock offset of each overlay connected to this worker, by session ID: dicts as for describe_clients().
+clients = {}
+_pinging = False
+
+# Recent HTML fragments by fragment ID, oldest first.  Copied to the shared store when it is shared by several workers.
+fragments = collections.OrderedDict()
+
+# Fragment ID of the last version of each table of data sent to each arena, by arena and table key.
+table_versions = {}
+
+
+def request_arena():
+    """Returns the arena of the client whose message is being handled: its "arena" URL parameter,
+    or the first arena if it didn't give one (or gave one that doesn't exist)."""
+    arena = request.args.get('arena')
+    return arena if arena in config.ARENAS else config.ARENAS[0]
+
+
+def request_delay():
+    """Returns the delay of the stream for the overlay whose message is being handled, as for journal.stream_delay()."""
+    return journal.stream_delay(request.args.get('delay'))
+
+
+def get_state(arena):
+    """Returns the current state of an arena's overlay, which is sent as a snapshot on "connect" or "resync".
+    The result must not be modified.
+
+    Args:
+        arena: Name of the arena.
+
+    Returns:
+        state: dict with fields:
+            seq: Sequence number of the last patch sent.
+            text: dict of small text areas.
+            table: List of name, HTML fragment (or table of data) and fragment ID.  Name is for debugging only.
+            clock: Match clock, as for set_clock(), or None.
+    """
+    return shared.store.get(f'overlay:{arena}') or INITIAL_STATE
+
+
+def hash_fragment(content):
+    """Returns an ID for an HTML fragment (or table of data), derived from its content."""
+    if isinstance(content, dict):
+        content = json.dumps(content, separators=(',', ':'))
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+
+def diff_table_data(old, new):
+    """Returns the changes from one version of a table of data (see table.py) to another with the same fields.
+
+    Returns:
+        diff: dict with fields:
+            put: Rows that are new or have changed.
+            remove: IDs of the rows that are no longer in the table.
+            order: IDs of every row, in order.  Only present if that isn't the order of the old rows (less those
+                removed) followed by the new rows.
+    """
+    old_rows = {row[0]: row for row in old['rows']}
+    new_ids = [row[0] for row in new['rows']]
+    kept = set(new_ids)
+    put = [row for row in new['rows'] if old_rows.get(row[0]) != row]
+    diff = dict(put=put, remove=[row_id for row_id in old_rows if row_id not in kept])
+    if [row_id for row_id in old_rows if row_id in kept] + [row[0] for row in put if row[0] not in old_rows] != new_ids:
+        diff['order'] = new_ids
+    return diff
+
+
+def send_patch(arena, state, **patch):
+    """Stores a change to an arena's overlay state, and broadcasts it to the arena's overlays with the next
+    sequence number and the server time at which it was sent.
+
+    Args:
+        arena: Name of the arena.
+        state: dict of fields of the state that changed, as for get_state().
+        **patch: Parts of the state that changed, as sent to overlays:
+            text: dict of text areas that changed.
+            table: Table data, as for show_table().
+            clock: Match clock, as for set_clock().
+    """
+    new_state = {**get_state(arena), **state}
+    new_state['seq'] += 1
+    shared.store.set(f'overlay:{arena}', new_state)
+    now = server_time()
+    data = dict(seq=new_state['seq'], ts=now, at=now + display_lead(arena), **patch)
+    with metrics.timed(EMIT_SECONDS, 'patch'):
+        config.socketio.emit('patch', data, room=arena, namespace="/overlay")
+    journal.record(arena, 'patch', data, new_state)
+    for part in patch:
+        PATCHES.inc(part)
+    metrics.trace('patch', arena=arena, seq=new_state['seq'], parts=list(patch))
+    persist.mark_dirty()
+
+
+def display_lead(arena):
+    """Returns how far ahead, in seconds, to set the target display time of an event in an arena:
+    long enough for it to reach the arena's slowest overlay, but no longer than MAX_LEAD."""
+    latency = max((c['rtt'] / 2 for c in clients.values() if c['rtt'] is not None and c['arena'] == arena),
+                  default=0)
+    return min(MAX_LEAD, max(MIN_LEAD, 1.5 * latency))
+
+
+def get_snapshot(arena, delay=0):
+    """Returns the complete overlay state of an arena, with the HTML (or data) for the current table.
+
+    Args:
+        arena: Name of the arena.
+        delay: Delay of the overlay, as for journal.stream_delay(), to get the state it has been sent so far.
+    """
+    state = (delay and journal.state_at(arena, delay)) or get_state(arena)
+    name, content, fragment_id = state['table']
+    if content is None and fragment_id is not None:
+        content = get_fragment(fragment_id)
+    if fragment_id is None:
+        table = None
+    elif isinstance(content, dict):
+        table = dict(id=fragment_id, data=content)
+    else:
+        table = dict(id=fragment_id, html=content)
+    return dict(seq=state['seq'], text=state['text'], table=table, clock=clock_data(state['clock']))
 
-# These globals store the last value sent on various parts of the overlay
-# We need to resend these if we get a "connect" message.
-# Note: Not thread-safe, but doesn't seem to matter.
-current_text = {} # dict of small text areas
-current_table = ("", None) # id and HTML fragment.  Id is for debugging only.
 
-def show_table(name="", content=None):
-    """Shows arbitrary HTML fragment (usually a table) over full overlay screen."""
-    config.socketio.emit('show_table', content, namespace="/overlay")
-    global current_table
-    current_table = (name, content)
-    control.log_message(f"Show table {name}")
+def dump_state(arena):
+    """Returns an arena's text and table as a dict of JSON-compatible values, for persist.py.
+    The match clock is not included, since it is restarted by the match."""
+    state = get_state(arena)
+    return dict(text=state['text'], table=list(state['table']))
 
+
+def load_state(arena, data):
+    """Restores an arena's text and table saved by dump_state().
+    Nothing is sent, since no overlays are connected yet."""
+    state = get_state(arena)
+    table = list(data['table'])
+    shared.store.set(f'overlay:{arena}', dict(state, text={**BLANK_TEXT, **data['text']}, table=table, clock=None))
+    name, content, fragment_id = table
+    if content is not None:
+        remember_fragment(fragment_id, content)
+
+
+def remember_fragment(fragment_id, content):
+    """Adds an HTML fragment (or table of data) to the recent fragments, dropping the oldest if there are too many."""
+    fragments[fragment_id] = content
+    while len(fragments) > FRAGMENT_CACHE_SIZE:
+        fragments.popitem(last=False)
+    if shared.store.shared:
+        shared.store.set('fragments', dict(fragments))
+
+
+def server_time():
+    """Returns the server's clock, as used by the match clock.  This is monotonic, so unaffected by NTP adjustments."""
+    return clocks.now()
+
+
+def clock_data(clock):
+    """Returns the match clock as sent to overlays, stamped with the current server time so they can work out their offset."""
+    return None if clock is None else dict(clock, now=server_time())
+
+
+def set_clock(arena, clock):
+    """Starts, corrects or stops the match clock in an arena's overlays.
+    While a clock is set, overlays show the time remaining and play the audio cues themselves, instead of
+    being sent every second.  Sending the same clock again corrects overlays that have drifted.
     
-def play_audio(name):
-    """Play an audio file in the overlay."""
-    config.logger.info("Play audio: %s", name)
-    config.socketio.emit('play_audio', name, namespace="/overlay")
-    control.log_message(f"Play audio: {name}")
+    Args:
+        arena: Name of the arena.
+        clock: None to stop the clock, or dict with fields:
+            match: Match ID.
+            start: Server time (see server_time()) at which the match was started.
+            phases: List of dicts, each with "name" (one of "countdown", "play", "endgame", "end") and
+                "at" (server time at which the phase starts), in order.  Phases all start on whole seconds after start.
+                Countdown and play phases also have "seconds", their length.
+    """
+    if clock is None and get_state(arena)['clock'] is None:
+        return
+    send_patch(arena, dict(clock=clock), clock=clock_data(clock))
+
+
+def show_table(arena, name="", content=None, fragment_id=None):
+    """Shows arbitrary HTML fragment (usually a table) over an arena's full overlay screen.
+    Does nothing if the same fragment is already showing.
+    The HTML is only sent the first time a fragment is shown; after that, overlays are just sent its ID.
+    A table of data is sent the same way, except that a new version of a table already sent to the arena is sent
+    as the rows that changed since (see diff_table_data()).
+
+    Args:
+        arena: Name of the arena.
+        name: Name of table, for logging only.
+        content: HTML fragment, table of data (see table.py), or None to hide the table.
+        fragment_id: ID for the fragment, if already known.  Computed from content otherwise.
+    """
+    if content is not None and fragment_id is None:
+        fragment_id = hash_fragment(content)
+    if get_state(arena)['table'][2] == fragment_id:
+        return
+
+    if content is None:
+        table = None
+    elif fragment_id in fragments:
+        fragments.move_to_end(fragment_id)
+        table = dict(id=fragment_id)
+    elif isinstance(content, dict):
+        base_id = table_versions.get((arena, content['key']))
+        base = None if base_id is None else get_fragment(base_id)
+        remember_fragment(fragment_id, content)
+        table = dict(id=fragment_id, data=content)
+        if base is not None and base['fields'] == content['fields']:
+            diff = diff_table_data(base, content)
+            if len(diff['put']) < len(content['rows']):
+                table = dict(id=fragment_id, base=base_id, diff=diff)
+    else:
+        remember_fragment(fragment_id, content)
+        table = dict(id=fragment_id, html=content)
+    if isinstance(content, dict):
+        table_versions[arena, content['key']] = fragment_id
+    send_patch(arena, dict(table=[name, content, fragment_id]), table=table)
+    control.log_message(f"Show table {name}", arena=arena)
+
+
+def play_audio(arena, name):
+    """Play an audio file in an arena's overlays."""
+    config.logger.info("Play audio in %s: %s", arena, name)
+    now = server_time()
+    data = dict(name=name, ts=now, at=now + display_lead(arena))
+    with metrics.timed(EMIT_SECONDS, 'play_audio'):
+        config.socketio.emit('play_audio', data, room=arena, namespace="/overlay")
+    journal.record(arena, 'play_audio', data)
+    metrics.trace('play_audio', arena=arena, name=name)
+    control.log_message(f"Play audio: {name}", arena=arena)
     config.socketio.sleep(0)
-    
 
-def update_text(clear=True, **d):
-    """Update text in the overlay.  
-    
+
+def update_text(arena, clear=True, **d):
+    """Update text in an arena's overlays.
+    Only the text areas that actually change are sent.
+
     Args:
+        arena: Name of the arena.
         clear: If set to false, existing text fields remain unchanged.   This is mainly used when setting the time.
         **d: Remaining keyword arguments are sent to the overlay interface.
-        
+
     The overlay has five text areas, reflected in the additional keyword arguments:
         redteam: Top middle, styled in red, used for showing the name of the red competitor.
         blueteam: Bottom middle, styled in blue, used for showing the name of the blue competitor
         match: Middle left, neutral colour.  Used to show match number.
         middle: Middle middle, neutral colour.  Used to show important text when match not actually in progress.
         time: Middle right, neutral colour.  Used to show time remaining in match and countdown.
-    
+
     TODO: Support swapping red and blue, and think about whether it should label the drive team or the anthill.
     """
-    config.logger.info("Update text: %r", d)
-    if clear:
-        d = {**(dict(redteam="", blueteam="", middle="", time="", match="")), **d}
-    global current_text
-    current_text = {**current_text, **d}
-    config.socketio.emit('update_text', d, namespace="/overlay")
+    config.logger.info("Update text in %s: %r", arena, d)
+    current_text = get_state(arena)['text']
+    text = {**(BLANK_TEXT if clear else current_text), **d}
+    changed = {k: v for k, v in text.items() if current_text.get(k) != v}
+    if not changed:
+        return
+    send_patch(arena, dict(text=text), text=changed)
     config.socketio.sleep(0)
-        
-    
+
+
 @config.socketio.on('connect', namespace="/overlay")
 def handle_overlay_connect():
     """Invoked when an overlay connects.  There will generally be three overlay connections during an event:
     * The overlay fetched by OBS to be used in the video stream.
     * The screen shown to competitors.
-    * The iframe included in the control interface.  Note that this is muted to avoid competing noises.
-    
-    On connection, the current text and table (if any) are fetched from the globals and resent.
+    * The iframe included in the control interface.  Note that this is muted to avoid competing noises
+      (see config.AUDIO_GAIN).
+
+    With several fields, there are overlays like these for each arena (see request_arena()).
+    The overlay joins its arena's room (or the room for its delay, see journal.py), and is sent the audio cue
+    manifest, the table templates (if tables are sent as data) and a snapshot of the arena's text and table
+    (if any), to the new overlay only.
     """
+
+    arena = request_arena()
+    delay = request_delay()
+    config.logger.info("Connect overlay to %s, delay %s", arena, delay)
+    CLIENTS.inc('/overlay')
+    join_room(journal.room(arena, delay))
+    if delay:
+        journal.open_stream(arena, delay)
+    config.socketio.emit('audio_manifest', audio.manifest_for(request.args.get('role')), room=request.sid,
+                         namespace="/overlay")
+    if config.TABLE_DATA:
+        config.socketio.emit('table_templates', tables.client_templates, room=request.sid, namespace="/overlay")
+    config.socketio.emit('snapshot', get_snapshot(arena, delay), room=request.sid, namespace="/overlay")
+    clients[request.sid] = dict(sid=request.sid, arena=arena, rtt=None, offset=None, delay=delay, samples=[])
+    ping(request.sid)
+    global _pinging
+    if not _pinging:
+        _pinging = True
+        threading.Thread(target=_ping_loop, name="Overlay pings", daemon=True).start()
+    config.logger.info("Connect overlay done")
+
+
+@config.socketio.on('disconnect', namespace="/overlay")
+def handle_overlay_disconnect():
+    CLIENTS.dec('/overlay')
+    clients.pop(request.sid, None)
+
+
+def ping(sid):
+    """Sends a ping to one overlay.  It acknowledges with its own clock, from which handle_pong() works out the
+    round trip time and clock offset."""
+    sent = server_time()
+    # Flask-SocketIO's emit() only takes a callback inside a request, so this goes to the Socket.IO server directly.
+    config.socketio.server.emit('ping_clock', sent, room=sid, namespace="/overlay",
+                                callback=functools.partial(handle_pong, sid, sent))
+
+
+def handle_pong(sid, sent, reply=None):
+    """Invoked with an overlay's acknowledgement of a ping.
+    The offset is estimated assuming the ping took as long each way, so is most accurate for the shortest round trip.
+    The estimate is sent back to the overlay, which uses it to convert target display times to its own clock.
+
+    Args:
+        sid: Session ID of the overlay.
+        sent: Server time at which the ping was sent.
+        reply: dict with fields:
+            time: The overlay's clock when it received the ping, in seconds.
+            delay: Extra delay the overlay adds to every event, in seconds (its "delay" URL parameter).
+            None if the client acknowledged without a reply, as a client that doesn't sync its clock does.
+    """
+    # With a message queue, this runs on the queue's listener thread, so it must not raise.
+    client = clients.get(sid)
+    if client is None or not isinstance(reply, dict) or not isinstance(reply.get('time'), (int, float)):
+        return
+    received = server_time()
+    rtt = received - sent
+    CLIENT_RTT.observe(rtt)
+    client['samples'] = (client['samples'] + [(rtt, (sent + received) / 2 - reply['time'])])[-PING_SAMPLES:]
+    client['rtt'], client['offset'] = min(client['samples'])
+    client['delay'] = reply.get('delay') or 0
+    config.socketio.emit('clock_sync', dict(offset=client['offset'], rtt=client['rtt']), room=sid,
+                         namespace="/overlay")
+
+
+def _ping_loop():
+    """Pings every overlay connected to this worker every PING_INTERVAL seconds, and sends the results to the
+    control interface."""
+    while True:
+        config.socketio.sleep(PING_INTERVAL)
+        for sid in list(clients):
+            ping(sid)
+        control.show_clients(shared.worker_id, describe_clients())
+
+
+def describe_clients():
+    """Returns a list of dicts describing the overlays connected to this worker, with fields:
+        sid: Session ID.
+        arena: Name of the arena the overlay shows.
+        rtt: Round trip time of pings, in seconds, or None if not yet measured.
+        offset: Server time minus the overlay's clock, in seconds, or None.
+        delay: Extra delay added by the overlay, in seconds.
+    """
+    return [dict(sid=c['sid'], arena=c['arena'], rtt=c['rtt'], offset=c['offset'], delay=c['delay'])
+            for c in clients.values()]
+
+
+@config.socketio.on('resync', namespace="/overlay")
+def handle_resync():
+    """Invoked when an overlay has missed a patch.
+
+    Returns:
+        snapshot: Complete overlay state of its arena, as for get_snapshot(), sent as the acknowledgement.
+    """
+    snapshot = get_snapshot(request_arena(), request_delay())
+    config.logger.info("Resync overlay %s at %d", request.sid, snapshot['seq'])
+    return snapshot
+
+
+@config.socketio.on('clock_stats', namespace="/overlay")
+def handle_clock_stats(stats):
+    """Invoked when an overlay finishes running a match clock, with the jitter of its local ticks.
     
-    config.logger.info("Connect overlay")
-    #update_text(redteam="Red", blueteam="Blue", match="R1", time="0:00", middle="Starting soon")
-    
-    #for i in range(30):
-        #gevent.spawn_later(31-i, update_text, time="{min:02d}:{sec:02d}".format(min=i // 60, sec=i % 60))
-    global current_text
-    update_text(clear=False, **current_text)
-    global current_table
-    show_table(*current_table)
-    config.logger.info("Connect overlay done")
\ No newline at end of file
+    Args:
+        stats: dict with fields match, ticks, and mean_ms/p95_ms/max_ms for how late ticks were.
+    """
+    control.log_message(f"Overlay tick jitter for match {stats.get('match')}: n={stats.get('ticks')}, "
+                        f"mean={stats.get('mean_ms')}ms, p95={stats.get('p95_ms')}ms, max={stats.get('max_ms')}ms",
+                        arena=request_arena())
+
+
+def get_fragment(fragment_id):
+    """Returns the HTML (or table of data) of a recent fragment, or None if no longer known."""
+    if fragment_id in fragments or not shared.store.shared:
+        return fragments.get(fragment_id)
+    # Another worker is the leader, so has the fragments.
+    return shared.store.get('fragments', {}).get(fragment_id)
+
+
+@config.socketio.on('get_fragment', namespace="/overlay")
+def handle_get_fragment(fragment_id):
+    """Invoked when an overlay has been told to show a fragment that it doesn't have (e.g. because it connected later).
+
+    Returns:
+        html: HTML fragment (or table of data), sent to the overlay as the acknowledgement, or None if no longer
+            known.
+    """
+    return get_fragment(fragment_id)
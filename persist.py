@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# This module saves the runner's state to a local file, so a restart can carry on where it left off.
+#
+# The file holds, for each arena, the overlay text and table, the control buttons and the match in progress.
+# The last sheet snapshot, which is much bigger, is kept in a file of its own next to it (see sheet_file()),
+# and only written when the spreadsheet changes, rather than on every change to an overlay.
+# Each file is written shortly after anything in it changes, and atomically (to a temporary file, flushed to disk,
+# which then replaces the old one), so a crash can never leave a half-written file.  On startup, restore() serves from the file straight away,
+# while the sheet sync worker refreshes from the spreadsheet in the background.
+#
+# With several workers, the state is also kept in the shared store, so that if the leader dies,
+# the worker that takes over resumes from it (see shared.py).
+
+import gzip
+import json
+import os
+import time
+
+import clocks
+import config
+import sheet
+import overlay
+import control
+import thread
+import shared
+
+# Version of the file format.  Files with a different version are ignored.
+FORMAT = 3
+
+# Seconds to wait after a change before saving, so a burst of changes is saved once.
+SAVE_DELAY = 1
+
+# The pending save, if any.
+_save_timer = None
+# Version of the sheet snapshot last saved (or restored).
+_sheet_version = None
+
+
+def mark_dirty():
+    """Arranges for the state to be saved soon.  Cheap, so can be called on every change."""
+    global _save_timer
+    if (config.STATE_FILE is None and not shared.store.shared) or _save_timer is not None or not shared.is_leader():
+        return
+    thread.scheduler.start()
+    _save_timer = thread.scheduler.call_later(SAVE_DELAY, save)
+
+
+def sheet_file(path):
+    """Returns the file that the sheet snapshot is saved in, for a state file, e.g. "state.sheet.json.gz"."""
+    name, dot, extension = os.path.basename(path).partition('.')
+    return os.path.join(os.path.dirname(path), f"{name}.sheet{dot}{extension}")
+
+
+def dump_arena(arena):
+    """Returns the state of one arena to save, as a dict of JSON-compatible values."""
+    state = arena.current_state
+    match = None
+    if isinstance(state, thread.MatchState) and state.start is not None:
+        # The server clock is monotonic, so doesn't survive a restart.  Save the wall clock time instead.
+        match = dict(match_id=state.match_id, started=clocks.wall() - (overlay.server_time() - state.start))
+    return dict(
+        overlay=overlay.dump_state(arena.name),
+        buttons=control.get_buttons(arena.name),
+        match=match,
+    )
+
+
+def dump():
+    """Returns the state of the arenas to save, as a dict of JSON-compatible values."""
+    return dict(
+        format=FORMAT,
+        saved=clocks.wall(),
+        arenas={name: dump_arena(arena) for name, arena in thread.arenas.items()},
+    )
+
+
+def dump_sheet():
+    """Returns the sheet snapshot to save, as a dict of JSON-compatible values."""
+    return dict(format=FORMAT, saved=clocks.wall(), sheet=sheet.dump_snapshot())
+
+
+def write_file(path, value):
+    """Writes a value to a file as gzipped JSON, atomically: to a temporary file, flushed to disk once complete
+    (including the gzip trailer), which then replaces the file."""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            f.write(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, path)
+
+
+def save():
+    """Writes the state to config.STATE_FILE, and the sheet snapshot to its own file if it has changed, atomically.
+    Both are also written to the shared store if there are several workers."""
+    global _save_timer, _sheet_version
+    _save_timer = None
+    saves = [('state', config.STATE_FILE, dump())]
+    current = sheet.snapshot
+    if current is not None and current.version != _sheet_version:
+        _sheet_version = current.version
+        saves.append(('state:sheet', config.STATE_FILE and sheet_file(config.STATE_FILE), dump_sheet()))
+    for key, path, value in saves:
+        if shared.store.shared:
+            try:
+                shared.store.set(key, value)
+            except Exception:
+                config.logger.exception(f"Error saving {key} to the shared store")
+        if path is None:
+            continue
+        try:
+            write_file(path, value)
+        except Exception:
+            config.logger.exception(f"Error saving state to {path}")
+
+
+def read_latest(path, key):
+    """Reads a dict saved by save() from a file, or from the shared store if that was saved more recently
+    (as when another worker was the leader).
+
+    Args:
+        path: File it was saved to, or None.
+        key: Key it was saved under in the shared store.
+
+    Returns:
+        state: The dict, or None if nothing usable was saved.
+    """
+    candidates = []
+    if path is not None and os.path.exists(path):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                candidates.append(json.load(f))
+        except Exception:
+            config.logger.exception(f"Error reading state from {path}")
+    if shared.store.shared:
+        candidates.append(shared.store.get(key))
+    states = []
+    for state in candidates:
+        if state is None:
+            continue
+        if state.get('format') != FORMAT:
+            config.logger.warning(f"Ignoring saved state with format {state.get('format')}")
+            continue
+        states.append(state)
+    return max(states, key=lambda state: state['saved'], default=None)
+
+
+def load():
+    """Reads the state saved by save().
+
+    Returns:
+        state: dict as returned by dump(), with field sheet added: the snapshot from dump_sheet() (or None).
+            None if no state was saved.
+    """
+    path = config.STATE_FILE
+    state = read_latest(path, 'state')
+    if state is None:
+        return None
+    sheet_state = read_latest(path and sheet_file(path), 'state:sheet')
+    return dict(state, sheet=sheet_state and sheet_state['sheet'])
+
+
+def restore_arena(arena, state):
+    """Restores one arena from the state saved by dump_arena(), or starts it cycling if state is None."""
+    if state is None:
+        thread.cycle(arena)
+        return
+    overlay.load_state(arena, state['overlay'])
+    shared.store.set(f'buttons:{arena}', state['buttons'])
+
+    match = state['match']
+    if match is not None and sheet.get_match(match['match_id']) is not None:
+        elapsed = clocks.wall() - match['started']
+        control.log_message(f"Resuming match {match['match_id']}, {elapsed:.0f} seconds after it started", arena=arena)
+        thread.set_state(arena, thread.MatchState(match['match_id'], start=overlay.server_time() - elapsed))
+    else:
+        thread.cycle(arena)
+
+
+def restore():
+    """Restores the state saved by the previous run, if any, and enters the appropriate state in each arena.
+    A match that was in progress resumes on its original clock.  Otherwise, the arena starts cycling.
+    Arenas that weren't saved (e.g. newly configured) start cycling.
+    This does not wait for the spreadsheet if the file has a snapshot of it.
+    """
+    global _sheet_version
+    state = load()
+    if state is None:
+        for arena in thread.arenas:
+            thread.cycle(arena)
+        return
+    config.logger.info(f"Restoring state saved at {time.ctime(state['saved'])}")
+    if state['sheet'] is not None and sheet.snapshot is None:
+        _sheet_version = sheet.load_snapshot(state['sheet']).version
+    for arena in thread.arenas:
+        restore_arena(arena, state['arenas'].get(arena))
+
+
+# Save whenever the spreadsheet changes, too.  Only then is the snapshot saved again (see save()).
+sheet.subscribe('matches', lambda snapshot, changed: mark_dirty())
+sheet.subscribe('teams', lambda snapshot, changed: mark_dirty())
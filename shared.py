@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# This module holds the state that every server process (worker) needs to see, and decides which worker is in charge.
+#
+# With a single process (the default), the store is an in-process dict and this process is always the leader.
+# With config.MESSAGE_QUEUE set to a Redis URL, several workers can run behind a load balancer with sticky sessions:
+# * Flask-SocketIO uses the queue, so an emit from any worker reaches the clients of every worker.
+# * The overlay and control state live in Redis, so any worker can send a snapshot to a client that connects to it.
+# * Exactly one worker, the leader, holds a lease in Redis.  Only the leader runs the scheduler and sheet sync.
+#   Other workers forward commands from the control interface to it.
+# * If the leader dies, its lease expires and another worker takes over, resuming from the saved state.
+
+import collections
+import functools
+import json
+import os
+import socket
+import threading
+import time
+
+import config
+
+# Seconds before an unrenewed lease expires, and how often the leader renews it.
+LEASE_TTL = 10
+LEASE_RENEW = 3
+
+# Identifies this worker in the lease.
+worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+# Handlers that must run on the leader, by name.  See leader_command().
+_commands = {}
+
+_leader = False
+
+
+class MemoryStore:
+    """Store for a single process.  Values are kept as they are, so callers must not modify what they get.
+    There is no publish() or subscribe(), since a single process is always the leader, so never forwards commands."""
+    shared = False
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def increment(self, key, amount=1):
+        """Adds to a counter (initially 0), and returns the new value."""
+        self._values[key] = self._values.get(key, 0) + amount
+        return self._values[key]
+
+    def append(self, key, values, limit):
+        """Appends values to a list, dropping the oldest values beyond limit."""
+        items = self._values.get(key)
+        if items is None:
+            items = self._values[key] = collections.deque(maxlen=limit)
+        items.extend(values)
+
+    def slice(self, key, start, stop=None):
+        """Returns part of a list, with the same meaning of start and stop as Python slices."""
+        return list(self._values.get(key, ()))[start:stop]
+
+    def acquire_lease(self, name, owner, ttl):
+        return True
+
+    def lease_owner(self, name):
+        return worker_id
+
+
+# Lua script that takes a lease (KEYS[1]) for an owner (ARGV[1]) for ARGV[2] milliseconds if nobody holds it,
+# or renews it if the owner does.  Returns 1 if the owner holds it.  Run as a script, so that nothing can happen
+# between checking the owner and renewing, such as the lease expiring and another worker taking it.
+ACQUIRE_LEASE_SCRIPT = """
+local owner = redis.call('get', KEYS[1])
+if owner == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+if not owner then
+    redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class RedisStore:
+    """Store shared by every worker, in Redis.  Values are stored as JSON."""
+    shared = True
+
+    def __init__(self, url, prefix="anthill:", client=None):
+        """
+        Args:
+            url: Redis URL, as for config.MESSAGE_QUEUE.
+            prefix: Prepended to every key.
+            client: Redis client to use instead of connecting to url, e.g. for tests.
+        """
+        if client is None:
+            # Imported here, since redis is only needed for multiple workers.
+            import redis
+            client = redis.Redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self._acquire_lease = self.redis.register_script(ACQUIRE_LEASE_SCRIPT)
+
+    def get(self, key, default=None):
+        value = self.redis.get(self.prefix + key)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.redis.set(self.prefix + key, json.dumps(value, separators=(',', ':')))
+
+    def increment(self, key, amount=1):
+        return self.redis.incrby(self.prefix + key, amount)
+
+    def append(self, key, values, limit):
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(self.prefix + key, *[json.dumps(v, separators=(',', ':')) for v in values])
+        pipeline.ltrim(self.prefix + key, -limit, -1)
+        pipeline.execute()
+
+    def slice(self, key, start, stop=None):
+        if stop == 0:
+            return []
+        values = self.redis.lrange(self.prefix + key, start, -1 if stop is None else stop - 1)
+        return [json.loads(v) for v in values]
+
+    def acquire_lease(self, name, owner, ttl):
+        """Takes the lease if nobody holds it, or renews it if we do.  Returns True if we hold it."""
+        return self._acquire_lease(keys=[self.prefix + "lease:" + name], args=[owner, int(ttl * 1000)]) == 1
+
+    def lease_owner(self, name):
+        owner = self.redis.get(self.prefix + "lease:" + name)
+        return None if owner is None else owner.decode()
+
+    def publish(self, channel, message):
+        self.redis.publish(self.prefix + channel, json.dumps(message))
+
+    def subscribe(self, channel, callback):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.prefix + channel)
+
+        def listen():
+            for message in pubsub.listen():
+                try:
+                    callback(json.loads(message['data']))
+                except Exception:
+                    config.logger.exception(f"Error handling message on {channel}")
+
+        threading.Thread(target=listen, name=f"Subscriber {channel}", daemon=True).start()
+
+
+def open_store(url):
+    """Returns the store for a message queue URL: RedisStore for a redis:// URL, or MemoryStore for None."""
+    if url is None:
+        return MemoryStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError(f"Shared state needs a Redis message queue, not {url}")
+
+
+store = open_store(config.MESSAGE_QUEUE)
+
+
+def is_leader():
+    """Returns True if this worker runs the scheduler.  Always True with a single process."""
+    return _leader or not store.shared
+
+
+def leader_command(handler):
+    """Decorator for socket.io handlers that change the state of the runner.
+    On the leader, the handler runs as usual.  On any other worker, the command is forwarded to the leader."""
+    name = handler.__name__
+    _commands[name] = handler
+
+    @functools.wraps(handler)
+    def wrapper(*args):
+        if is_leader():
+            return handler(*args)
+        config.logger.info(f"Forwarding {name}{args} to the leader")
+        store.publish('commands', dict(name=name, args=list(args)))
+
+    return wrapper
+
+
+def _run_command(message):
+    if not is_leader():
+        return
+    handler = _commands.get(message['name'])
+    if handler is None:
+        config.logger.warning(f"Unknown command {message}")
+        return
+    handler(*message['args'])
+
+
+def _campaign_round(on_elected):
+    """Takes or renews the lease, and acts on the outcome.  See elect().
+
+    Returns:
+        delay: Seconds to wait before the next round.
+    """
+    global _leader
+    try:
+        held = store.acquire_lease('scheduler', worker_id, LEASE_TTL)
+    except Exception:
+        config.logger.exception("Error renewing lease")
+        held = False
+    if held and not _leader:
+        config.logger.info(f"Worker {worker_id} is now the leader")
+        _leader = True
+        # Started on a thread of its own, since it can take longer than the lease lasts (e.g. the first read of
+        # the spreadsheet), and the lease must be renewed meanwhile.
+        threading.Thread(target=on_elected, name="Leader startup", daemon=True).start()
+    elif _leader and not held:
+        # Another worker may already have taken over, so carrying on could run the scheduler twice.
+        # Exit, and let the supervisor restart us as a follower.
+        config.logger.critical(f"Worker {worker_id} lost the lease, exiting")
+        os._exit(1)
+    return LEASE_RENEW if _leader else LEASE_TTL / 2
+
+
+def elect(on_elected):
+    """Starts competing to be the leader.  Returns straight away.
+
+    Args:
+        on_elected: Called (once, on a thread of its own) when this worker becomes the leader.
+            With a single process, it is called before this returns.
+    """
+    global _leader
+    if not store.shared:
+        _leader = True
+        on_elected()
+        return
+
+    store.subscribe('commands', _run_command)
+
+    def campaign():
+        while True:
+            time.sleep(_campaign_round(on_elected))
+
+    threading.Thread(target=campaign, name="Election", daemon=True).start()
+
+
+def describe():
+    """Returns dict describing this worker and the leader, for inspection."""
+    return dict(worker=worker_id, leader=is_leader(), leader_worker=store.lease_owner('scheduler'))
@@ -1,128 +1,583 @@
-# This module provides read access to the Google spreadsheet.
+# This module provides read access to the Google spreadsheet, or whichever backend config.BACKEND selects
+# (see backends.py).
 # As a design choice, we do not provide an interface to update scores in the match runner interface.
 # The Google spreadsheet interface works perfectly well for this purpose.
-# This means that the match runner can be restarted without losing much state (except the current match).
+# This means that the match runner can be restarted without losing much state (and persist.py keeps the rest).
+#
+# The spreadsheet is read by a background sync worker (see start_sync()) rather than on demand.
+# Each successful read that changes anything publishes a new, versioned Snapshot.
+# Readers always get the latest snapshot immediately, even while a refresh is in progress,
+# and can subscribe to be told when matches or teams change.
+#
+# With several workers (see shared.py), only the leader runs the sync worker.  It puts each new snapshot in the shared
+# store before telling anyone about it, and the other workers load it from there (see follow()) rather than reading
+# the spreadsheet themselves.
 
-import pickle
-import os.path
 import logging
+import threading
+import time
 
-from apiclient import discovery
-from google.oauth2 import service_account
+import backends
+import config
+import metrics
+import shared
 
-# If modifying these scopes, delete the file token.pickle.
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+# The backend, the spreadsheet ID, the ranges to read and the mapping from spreadsheet headers to the column names
+# used throughout the code and in templates are set in config.py.
 
-# Note: this module won't work without a "service-credentials.json" file, 
-# for a Google Service account that has read access to the spreadsheet.
-# For security reasons, this file is not included in the github repo.
-SECRET_FILE = os.path.join(os.getcwd(), 'service-credentials.json')
+# Columns that hold whole numbers.  These are parsed to ints once, when the spreadsheet is read.
+MATCH_INT_COLUMNS = {
+    'Red Score', 'Blue Score',
+    'Red Common Balls', 'Blue Common Balls',
+    'Red Special Balls', 'Blue Special Balls',
+    'Red Parking', 'Blue Parking',
+    'Fouls by Red', 'Fouls by Blue',
+}
+TEAM_INT_COLUMNS = {'Rank', 'Played', 'Wins', 'Draws', 'Losses', 'Score'}
 
-# If you re-use this, create your own spreadsheet.
-# TODO: Should probably read these values from a config file.
-# Note that the header row in the spreadsheet must match the values used throughout the code, and in templates.
-# TODO: Provide config to allow header keys mapping?
-SPREADSHEET_ID = '1i9qLuN4PvYHannhivg4ZGla0Yh7DTqdWOUIADFNxZAQ'
-MATCHES_RANGE_NAME = 'Matches!A1:Z'
-TEAMS_RANGE_NAME = 'Teams!A1:Z'
+FETCH_SECONDS = metrics.histogram('sheet_fetch_seconds', "Time to read and parse the spreadsheet")
+FETCH_ERRORS = metrics.counter('sheet_fetch_errors_total', "Failed reads of the spreadsheet")
+ROW_FETCH_SECONDS = metrics.histogram('sheet_row_fetch_seconds', "Time to read one match's row of the spreadsheet")
+SNAPSHOT_VERSION = metrics.gauge('sheet_snapshot_version', "Version of the latest sheet snapshot")
 
-sheet = None
-matches = None
-teams = None
+backend = None # The backends.Backend that records are read from, once opened.
+snapshot = None # Latest Snapshot.  Replaced as a whole, never modified in place.
+_data_version = None # Backend's data version as of the latest snapshot, see Backend.data_version().
+
+# Callbacks registered with subscribe(), by kind.
+_subscribers = dict(matches=[], teams=[])
+
+# Only one refresh talks to the spreadsheet at a time.  Readers never take this lock.
+_refresh_lock = threading.Lock()
+_sync_thread = None
+# Set once the sync worker has finished its first refresh, whether or not it succeeded.
+_first_sync = threading.Event()
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
-def init():
-    """Open sheet API and get initial teams and matches."""
+
+def parse_int(value):
+    """Parses a cell that should hold a whole number.
+    
+    Returns:
+        value: int, None for a blank cell, or the original string if it isn't a number.
+    """
+    value = value.strip()
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return int(float(value))
+        except (ValueError, OverflowError):
+            return value
+
+
+class Record:
+    """One row of a range in the spreadsheet.
+    Records can be subscripted with header names, like the dicts they replace, so templates can use match['Red Score'].
+    All records from one range share a single columns dict, and store their cells in a tuple.
+    
+    Attributes:
+        id: Value of the identifying column.
+        row: Row number within the sheet (1-based, as in the Sheets UI).
+    """
+    __slots__ = ('id', 'row', 'columns', 'values')
+    
+    # Header of the column that identifies a record, and the set of columns to parse as ints.
+    id_column = None
+    int_columns = frozenset()
+    
+    def __init__(self, columns, values, row=None):
+        self.columns = columns
+        self.values = values
+        self.row = row
+        self.id = self.get(self.id_column)
+        
+    @classmethod
+    def from_row(cls, columns, row, row_number=None):
+        """Builds a record from a list of strings, as returned by the Sheets API.
+        Short rows (the API omits trailing blank cells) are padded with blanks."""
+        row = list(row) + [""] * (len(columns) - len(row))
+        values = tuple(parse_int(cell) if header in cls.int_columns else cell
+                       for header, cell in zip(columns, row))
+        return cls(columns, values, row_number)
+        
+    def __getitem__(self, key):
+        return self.values[self.columns[key]]
+    
+    def get(self, key, default=None):
+        index = self.columns.get(key)
+        return default if index is None else self.values[index]
+    
+    def __contains__(self, key):
+        return key in self.columns
+    
+    def keys(self):
+        return self.columns.keys()
+    
+    def __eq__(self, other):
+        return (type(self) is type(other) and self.values == other.values
+                and (self.columns is other.columns or self.columns == other.columns))
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.id}>"
+
+    
+class Match(Record):
+    """A row from the matches range.
+    
+    Attributes:
+        round: Value of the "Round" column if there is one, otherwise the letters at the start of the match ID,
+            e.g. "R" for "R12" or "SF" for "SF1".
+        red, blue: Competitor labels for each alliance.
+        red_score, blue_score: Total scores, as int (or None if blank, or the text of a cell that isn't a number).
+        played: True once either score is non-zero.  (So a match cannot be recorded as a 0-0 draw.)
+    """
+    __slots__ = ('round', 'red', 'blue', 'red_score', 'blue_score', 'played')
+    id_column = 'Match'
+    int_columns = frozenset(MATCH_INT_COLUMNS)
+    
+    def __init__(self, columns, values, row=None):
+        super().__init__(columns, values, row)
+        self.round = self.get('Round') or str(self.id or "").rstrip('0123456789')
+        self.red = self.get('Red Competitors')
+        self.blue = self.get('Blue Competitors')
+        self.red_score = self.get('Red Score')
+        self.blue_score = self.get('Blue Score')
+        self.played = bool(self.red_score or self.blue_score)
+        
+        
+class Team(Record):
+    """A row from the teams range.
+    
+    Attributes:
+        rank: Rank from the spreadsheet, as int (or None if blank).
+        competitors: Label used for the team in the matches range.
+    """
+    __slots__ = ('rank', 'competitors')
+    id_column = 'Team'
+    int_columns = frozenset(TEAM_INT_COLUMNS)
+    
+    def __init__(self, columns, values, row=None):
+        super().__init__(columns, values, row)
+        self.rank = self.get('Rank')
+        self.competitors = self.get('Competitors')
+    
+
+class Snapshot:
+    """Immutable, indexed view of the spreadsheet at one point in time.
+    All lookups are dict lookups, so they are safe to use from the match clock and other hot paths.
+    
+    Attributes:
+        version: Starts at 1 and increases by one each time the matches or teams actually change.
+        matches: List of Match records, in spreadsheet order.
+        teams: List of Team records, in spreadsheet order.
+        changed_matches: Set of match IDs added, changed or removed since the previous version.
+        changed_teams: Set of team IDs added, changed or removed since the previous version.
+    """
+    
+    def __init__(self, version, matches, teams, changed_matches=frozenset(), changed_teams=frozenset()):
+        self.version = version
+        self.matches = matches
+        self.teams = teams
+        self.changed_matches = changed_matches
+        self.changed_teams = changed_teams
+        
+        self.match_index = {m.id: m for m in matches}
+        self.team_index = {t.id: t for t in teams}
+        self.matches_by_team = {}
+        self.matches_by_round = {}
+        for m in matches:
+            for label in {m.red, m.blue}:
+                if label:
+                    self.matches_by_team.setdefault(label, []).append(m)
+            self.matches_by_round.setdefault(m.round, []).append(m)
+            
+    def match(self, match_id):
+        """Returns the Match with this ID, or None."""
+        return self.match_index.get(match_id)
+    
+    def team(self, team_id):
+        """Returns the Team with this ID, or None."""
+        return self.team_index.get(team_id)
     
-    credentials = service_account.Credentials.from_service_account_file(SECRET_FILE, scopes=SCOPES)
-    service = discovery.build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+    def team_matches(self, competitors):
+        """Returns list of matches in which these competitors play, in spreadsheet order."""
+        return self.matches_by_team.get(competitors, [])
+    
+    def round_matches(self, round):
+        """Returns list of matches in a round, e.g. "R" or "SF", in spreadsheet order."""
+        return self.matches_by_round.get(round, [])
+        
+    def find_matches(self, played=None, round=None, team=None):
+        """Returns list of matches matching all of the given filters, in spreadsheet order.
+
+        Args:
+            played: True for matches that have been played, False for those that haven't, None for either.
+            round: Round, e.g. "R" or "SF", or None for any.
+            team: Competitors, or None for any.  An exact label is looked up in the index; otherwise this matches
+                any competitors whose label contains it, ignoring case.
+        """
+        exact = team in self.matches_by_team
+        if round is not None:
+            matches = self.round_matches(round)
+        elif exact:
+            matches = self.team_matches(team)
+        else:
+            matches = self.matches
+        if exact:
+            matches = [m for m in matches if team in (m.red, m.blue)]
+        elif team is not None:
+            needle = team.lower()
+            matches = [m for m in matches if needle in str(m.red or "").lower() or needle in str(m.blue or "").lower()]
+        if played is not None:
+            matches = [m for m in matches if m.played == played]
+        return matches
+
+    def next_match(self, exclude=()):
+        """Returns the first match that hasn't been played, in spreadsheet order, or None.
 
-    # Call the Sheets API
-    logger.info("Getting spreadsheets")
-    global sheet
-    sheet = service.spreadsheets()
-    get_matches()
-    get_teams()
+        Args:
+            exclude: IDs of matches to skip, e.g. those in progress on other fields.
+        """
+        return next((m for m in self.matches if not m.played and m.id not in exclude), None)
 
+    def __repr__(self):
+        return f"<Snapshot v{self.version}: {len(self.matches)} matches, {len(self.teams)} teams>"
     
-def read_header_row_into_dicts(sheet, spreadsheet_id, range_name):
-    """Reads a range from a spreadsheet.
-    First row is treated as a header row.
-    Subsequent rows are converted into dicts using header keys.
+    
+# Record class for each kind of range in config.SHEET_RANGES.
+RECORD_CLASSES = dict(matches=Match, teams=Team)
+
+def open_backend():
+    """Opens the backend selected by config.BACKEND, unless one is already open (e.g. installed by a test).
+    
+    Returns:
+        backend: The backends.Backend.
+    """
+    global backend
+    if backend is None:
+        backend = backends.open_backend(config.BACKEND, config.DATA_PATH)
+        logger.info("Reading from %r", backend)
+    return backend
+
+    
+def read_records(backend, kinds, headers={}):
+    """Reads several kinds of record from a backend, at once if it can.
+    In each kind, the first row is treated as a header row.
+    Subsequent rows are converted into records using header keys.
     
     Args:
-        sheet: Sheet object to use.
-        spreadsheet_id: ID string for spreadsheet.
-        range_name: Range to pull from spreadsheet in usual Sheet/Excel syntax.
+        backend: backends.Backend to use.
+        kinds: Kinds to read (keys of RECORD_CLASSES).
+        headers: Dict of header mappings, by kind.  Each maps column names used in the code to headers in the sheet.
     
     Returns:
-        results: List of dicts with keys from header row and values from each row.
+        results: Dict of lists of records, one for each row after the header, by kind.
     """
-    result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                range=range_name).execute()
-    values = result.get('values', [])
-    headers = values[0]
-    return [ dict(zip(headers, row)) for row in values[1:] ]
+    values = backend.read(kinds)
+    return {kind: parse_records(values[kind], RECORD_CLASSES[kind], headers.get(kind, {})) for kind in kinds}
 
 
-def get_matches(flush=False):
-    """Returns list of match objects.  
+def parse_records(values, record_class, header_map={}):
+    """Converts the cells of a range into records.
     
     Args:
-        flush: If set to true, then results will be fetched from the spreadsheet, otherwise a cache will be used.
+        values: List of rows, each a list of strings.  First row is the header row.
+        record_class: Match or Team.
+        header_map: Maps column names used in the code to headers in the sheet.  Unmapped headers are used as-is.
         
     Returns:
-        matches: List of match objects.  
-        
-    TODO: Cache timeout?
+        results: List of records, one for each row after the header.
     """
-    global matches
+    if not values:
+        return []
+    names = {sheet_header: name for name, sheet_header in header_map.items()}
+    columns = {names.get(header, header): i for i, header in enumerate(values[0])}
+    return [record_class.from_row(columns, row, row_number) 
+            for row_number, row in enumerate(values[1:], start=2)]
 
-    if flush:
-        matches = None
 
-    if matches is None:
-        if sheet is None: init()
-        matches = read_header_row_into_dicts(sheet, SPREADSHEET_ID, MATCHES_RANGE_NAME)
+def changed_keys(old_index, new_index):
+    """Compares two indexes of records.
+    
+    Args:
+        old_index: Dict of previous records by ID.
+        new_index: Dict of current records by ID.
+        
+    Returns:
+        keys: Set of IDs for records that were added, removed or changed.
+    """
+    return {k for k in old_index.keys() | new_index.keys() if old_index.get(k) != new_index.get(k)}
 
-    return matches
 
+def refresh():
+    """Reads matches and teams from the spreadsheet and publishes a new snapshot if anything changed.
+    This blocks the caller for the round trips to the spreadsheet, so should normally only be called by
+    the sync worker.  Readers continue to get the previous snapshot until the new one is published.
+    
+    Returns:
+        snapshot: The latest snapshot.
+    """
+    global snapshot, _data_version
+    with _refresh_lock:
+        open_backend()
+        start = time.perf_counter()
+        try:
+            # Taken before reading, so that a change made while reading is picked up next time.
+            version = backend.data_version()
+            if version is not None and version == _data_version and snapshot is not None:
+                return snapshot
+            records = read_records(backend, list(config.SHEET_RANGES), config.SHEET_HEADERS)
+        except Exception:
+            FETCH_ERRORS.inc()
+            raise
+        elapsed = time.perf_counter() - start
+        FETCH_SECONDS.observe(elapsed)
+        metrics.trace('sheet_fetch', seconds=round(elapsed, 6))
+        matches = records.get('matches', [])
+        teams = records.get('teams', [])
+        _data_version = version
+        
+        old = snapshot
+        if old is None:
+            snapshot = Snapshot(1, matches, teams)
+            SNAPSHOT_VERSION.set(snapshot.version)
+            logger.info("Loaded %r", snapshot)
+            _share()
+            return snapshot
+        
+        new = Snapshot(old.version + 1, matches, teams)
+        changed_matches = changed_keys(old.match_index, new.match_index)
+        changed_teams = changed_keys(old.team_index, new.team_index)
+        if not changed_matches and not changed_teams:
+            return old
+        
+        new.changed_matches = frozenset(changed_matches)
+        new.changed_teams = frozenset(changed_teams)
+        snapshot = new
+        SNAPSHOT_VERSION.set(snapshot.version)
+        logger.info("Updated to %r, changed matches %s, changed teams %s",
+                    snapshot, sorted(map(str, changed_matches)), sorted(map(str, changed_teams)))
+        _share()
+        
+    # Notify outside the lock, so a slow subscriber cannot hold up the next refresh.
+    if changed_matches:
+        _notify('matches', snapshot, snapshot.changed_matches)
+    if changed_teams:
+        _notify('teams', snapshot, snapshot.changed_teams)
+    return snapshot
 
-def get_match(match_id, flush=False):
-    """Returns object for specific match.
+
+def refresh_match(match_id):
+    """Reads just one match's row from the spreadsheet, and publishes a new snapshot if it changed.
+    This is much cheaper than refresh() for watching a single match, e.g. while its scores are being entered.
+    The new snapshot differs from the previous one only in that match, so the standings are updated incrementally.
+    Falls back to refresh() if the match's row isn't known, no longer holds the match (rows were moved), or the
+    backend can't read a single row.
     
-    Args:
-        match_id: Identifier for specific match, e.g. "R!"
-        flush: As for get_matches()
+    Returns:
+        match: The latest Match record, or None if there is no such match.
+    """
+    global snapshot
+    old = get_snapshot()
+    match = old.match(match_id)
+    if match is None or match.row is None:
+        return refresh().match(match_id)
+    
+    with _refresh_lock:
+        open_backend()
+        start = time.perf_counter()
+        try:
+            row = backend.read_row('matches', match.row)
+        except Exception:
+            FETCH_ERRORS.inc()
+            raise
+        elapsed = time.perf_counter() - start
+        ROW_FETCH_SECONDS.observe(elapsed)
+        metrics.trace('sheet_row_fetch', match=match_id, seconds=round(elapsed, 6))
+        new_match = None if row is None else Match.from_row(match.columns, row, match.row)
         
+        # A refresh may have published a newer snapshot while we were waiting for the lock.
+        old = snapshot
+        current = old.match(match_id)
+        if new_match is None or new_match.id != match_id or current is None or current.row != match.row:
+            new_match = None
+        elif new_match == current:
+            return current
+        else:
+            matches = [new_match if m is current else m for m in old.matches]
+            snapshot = Snapshot(old.version + 1, matches, old.teams, changed_matches=frozenset([match_id]))
+            SNAPSHOT_VERSION.set(snapshot.version)
+            logger.info("Updated to %r from the row of match %s", snapshot, match_id)
+            _share()
+        
+    if new_match is None:
+        return refresh().match(match_id)
+    _notify('matches', snapshot, snapshot.changed_matches)
+    return new_match
+
+
+def dump_snapshot():
+    """Returns the latest snapshot as a dict of JSON-compatible values, for persist.py, or None if nothing is loaded."""
+    current = snapshot
+    if current is None:
+        return None
+    
+    def dump(records):
+        if not records:
+            return dict(columns=[], rows=[])
+        columns = records[0].columns
+        return dict(columns=sorted(columns, key=columns.get),
+                    rows=[[r.row, *r.values] for r in records])
+    
+    return dict(version=current.version, matches=dump(current.matches), teams=dump(current.teams))
+
+
+def parse_snapshot(data):
+    """Returns the Snapshot saved by dump_snapshot()."""
+    def load(kind):
+        columns = {name: i for i, name in enumerate(data[kind]['columns'])}
+        return [RECORD_CLASSES[kind](columns, tuple(values), row) for row, *values in data[kind]['rows']]
+    
+    return Snapshot(data['version'], load('matches'), load('teams'))
+
+
+def load_snapshot(data):
+    """Installs a snapshot saved by dump_snapshot(), unless one has already been read from the spreadsheet.
+    The next refresh compares against it as usual, so subscribers hear about anything that changed while we were down.
+    
     Returns:
-        match: dict for specific match or raise StopIteration exception.
+        snapshot: The latest snapshot.
     """
+    global snapshot
+    # Don't wait for a refresh in progress: the point is to have something to serve while it runs.
+    if snapshot is None:
+        snapshot = parse_snapshot(data)
+        logger.info("Restored %r", snapshot)
+    return snapshot
+
+
+def _share():
+    """Puts the latest snapshot in the shared store for the other workers, and tells them about it.
+    Called by the leader with the refresh lock held, so the snapshots are shared in order,
+    and before subscribers are notified, so a worker told of a change by a subscriber can already load it."""
+    if not shared.store.shared or not shared.is_leader():
+        return
+    try:
+        shared.store.set('sheet', dump_snapshot())
+        shared.store.publish('sheet', snapshot.version)
+    except Exception:
+        logger.exception("Error sharing %r", snapshot)
+
+
+def load_shared(version=None):
+    """On a worker that isn't the leader, installs the snapshot that the leader last shared, if it's a different one.
+    Subscribers aren't notified: the leader acts on changes, and the standings and rendered tables notice the new
+    version when next used.
+    
+    Args:
+        version: Version of the snapshot wanted, e.g. from a "matches_changed" event, or None to check the store.
+            Nothing is read from the store if we already have it.
     
-    return next(m for m in get_matches(flush=flush) if m['Match'] == match_id)
+    Returns:
+        snapshot: The latest snapshot, or None if nothing has been loaded or shared.
+    """
+    global snapshot
+    if not shared.store.shared or shared.is_leader() or (snapshot is not None and snapshot.version == version):
+        return snapshot
+    data = shared.store.get('sheet')
+    if data is not None and (snapshot is None or data['version'] != snapshot.version):
+        snapshot = parse_snapshot(data)
+        SNAPSHOT_VERSION.set(snapshot.version)
+        logger.info("Loaded %r shared by the leader", snapshot)
+    return snapshot
+
+
+def follow():
+    """With several workers, keeps this worker's snapshot up to date with the one that the leader shares.
+    The leader ignores what it shares itself, so every worker can call this, whether or not it becomes the leader."""
+    if shared.store.shared:
+        shared.store.subscribe('sheet', load_shared)
 
 
-def get_teams(flush=False):
-    """Returns list of team objects.  
+def subscribe(kind, callback):
+    """Registers a callback for changes to the spreadsheet.
+    Callbacks run on the sync worker, so should be quick and must not call refresh().
     
     Args:
-        flush: If set to true, then results will be fetched from the spreadsheet, otherwise a cache will be used.
+        kind: "matches" or "teams".
+        callback: Called as callback(snapshot, changed_ids) after a new snapshot is published.
+    """
+    _subscribers[kind].append(callback)
+    
+    
+def _notify(kind, snapshot, changed):
+    for callback in list(_subscribers[kind]):
+        try:
+            callback(snapshot, changed)
+        except Exception:
+            logger.exception("Error in %s subscriber %r", kind, callback)
+
+
+def _sync_loop(interval):
+    while True:
+        try:
+            refresh()
+        except Exception:
+            # Keep serving the previous snapshot and try again later.
+            logger.exception("Error refreshing spreadsheet")
+        _first_sync.set()
+        time.sleep(interval)
         
-    Returns:
-        teams: List of team objects.
         
-    TODO: Cache timeout?
+def start_sync(interval=None):
+    """Starts the background sync worker, if not already running.
+    
+    Args:
+        interval: Seconds between refreshes.  None for the backend's usual interval.
     """
-    global teams
-
-    if flush:
-        teams = None
+    global _sync_thread
+    if _sync_thread is not None: return
+    if interval is None:
+        interval = open_backend().sync_interval
+    _sync_thread = threading.Thread(target=_sync_loop, args=(interval,), name="Sheet sync", daemon=True)
+    _sync_thread.start()
     
-    if teams is None:
-        if sheet is None: init()
-        teams = read_header_row_into_dicts(sheet, SPREADSHEET_ID, TEAMS_RANGE_NAME)
+    
+def get_snapshot(version=None):
+    """Returns the latest snapshot, blocking only if nothing has been loaded yet.
+    
+    Args:
+        version: Version that the caller has been told about, e.g. in a "matches_changed" event.  On a worker that isn't
+            the leader, a different version is loaded from the shared store first (see load_shared()).
+    """
+    if version is not None or (snapshot is None and _sync_thread is None):
+        load_shared(version)
+    if snapshot is None and _sync_thread is not None:
+        # Wait for the sync worker's first refresh rather than starting another.  It may not have begun yet,
+        # so waiting for the refresh lock isn't enough.
+        _first_sync.wait()
+    return snapshot or refresh()
 
-    return teams
\ No newline at end of file
+
+def get_match(match_id, flush=False):
+    """Returns object for specific match.
+    
+    Args:
+        match_id: Identifier for specific match, e.g. "R!"
+        flush: If set to true, then results will be fetched from the spreadsheet before returning.
+            Otherwise, the latest snapshot from the sync worker is used without blocking.
+        
+    Returns:
+        match: Match record, or None if there is no such match.
+    """
+    if flush:
+        return refresh().match(match_id)
+    return get_snapshot().match(match_id)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# This module is a minimal client for the values part of the Google Sheets API.
+#
+# It replaces googleapiclient, which builds the whole API from a discovery document on every start, and sends
+# each request through httplib2.  Here, connections are kept alive and reused, the access token is cached until
+# it expires, and every request has a deadline.  Only the standard library is used for requests; google.oauth2 is
+# imported the first time a token is needed.
+#
+# The endpoint can be any http or https URL, so the client can be tested against a local stand-in server.
+
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+GOOGLE_ENDPOINT = 'https://sheets.googleapis.com'
+
+# Number of idle connections kept open to each host.
+POOL_SIZE = 2
+
+
+class SheetsError(Exception):
+    """Raised when the API returns an error, with the HTTP status and the message from the response."""
+
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class Pool:
+    """Keep-alive connections to one host, reused across requests."""
+
+    def __init__(self, scheme, netloc, size=POOL_SIZE):
+        self.connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self.netloc = netloc
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers={}, deadline=None):
+        """Sends a request and reads the whole response.
+        A connection that has gone stale while idle is replaced and the request retried once, deadline permitting.
+
+        Args:
+            method: E.g. "GET".
+            path: Path and query string.
+            body: Request body as bytes, or None.
+            headers: dict of request headers.
+            deadline: time.monotonic() by which the response must have been read.  None for no deadline.
+
+        Returns:
+            response: Tuple of HTTP status, dict of headers and body as bytes.
+        """
+        for attempt in range(2):
+            connection, reused = self._get()
+            try:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Deadline passed for {method} {self.netloc}{path}")
+                    connection.timeout = remaining
+                    if connection.sock is not None:
+                        connection.sock.settimeout(remaining)
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._put(connection)
+            return response.status, dict(response.getheaders()), data
+
+    def _get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connection_class(self.netloc), False
+
+    def _put(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class _AuthResponse:
+    """Response, as google.auth expects from its transport."""
+
+    def __init__(self, status, headers, data):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+class _AuthRequest:
+    """Transport for google.auth to fetch tokens through our connection pools."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, url, method='GET', body=None, headers=None, timeout=None, **kwargs):
+        if isinstance(body, str):
+            body = body.encode()
+        deadline = time.monotonic() + (timeout or self.client.timeout)
+        return _AuthResponse(*self.client.fetch(method, url, body, headers or {}, deadline))
+
+
+class SheetsClient:
+    """Reads values from spreadsheets.
+
+    Args:
+        endpoint: Root URL of the API, e.g. GOOGLE_ENDPOINT or "http://localhost:8099".
+        credentials_file: Service account credentials file, or None to send requests without authorization
+            (only useful for a local stand-in).
+        scopes: OAuth scopes to request.
+        timeout: Deadline for each request, in seconds, including any retry.
+    """
+
+    def __init__(self, endpoint=GOOGLE_ENDPOINT, credentials_file=None, scopes=(), timeout=10):
+        self.endpoint = endpoint.rstrip('/')
+        self.credentials_file = credentials_file
+        self.scopes = list(scopes)
+        self.timeout = timeout
+        self._credentials = None
+        self._pools = {}
+        self._token_lock = threading.Lock()
+
+    def fetch(self, method, url, body=None, headers={}, deadline=None):
+        """Sends a request to any URL, using the pool for its host.  Returns as for Pool.request()."""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools.setdefault(key, Pool(parts.scheme, parts.netloc))
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        return pool.request(method, path, body, headers, deadline)
+
+    def token(self):
+        """Returns a valid access token, fetching a new one only if the cached one has expired, or None without credentials."""
+        if self.credentials_file is None:
+            return None
+        with self._token_lock:
+            if self._credentials is None:
+                from google.oauth2 import service_account
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    self.credentials_file, scopes=self.scopes)
+            if not self._credentials.valid:
+                self._credentials.refresh(_AuthRequest(self))
+            return self._credentials.token
+
+    def _get_json(self, path, query):
+        deadline = time.monotonic() + self.timeout
+        headers = {'Accept': 'application/json', 'Accept-Encoding': 'identity'}
+        token = self.token()
+        if token is not None:
+            headers['Authorization'] = 'Bearer ' + token
+        url = self.endpoint + path + '?' + urllib.parse.urlencode(query, doseq=True)
+        status, response_headers, data = self.fetch('GET', url, headers=headers, deadline=deadline)
+        if status != 200:
+            try:
+                message = json.loads(data)['error']['message']
+            except Exception:
+                message = data[:200].decode(errors='replace')
+            raise SheetsError(status, message)
+        return json.loads(data)
+
+    def get(self, spreadsheet_id, range_name):
+        """Reads one range, as for spreadsheets.values.get.
+
+        Returns:
+            result: dict with "range" and "values" (list of rows, each a list of strings; omitted if empty).
+        """
+        return self._get_json(f"/v4/spreadsheets/{urllib.parse.quote(spreadsheet_id)}/values/"
+                              f"{urllib.parse.quote(range_name, safe='')}", {})
+
+    def batch_get(self, spreadsheet_id, ranges):
+        """Reads several ranges in one request, as for spreadsheets.values.batchGet.
+
+        Returns:
+            result: dict with "valueRanges", a list of results as for get(), in the same order as ranges.
+        """
+        return self._get_json(f"/v4/spreadsheets/{urllib.parse.quote(spreadsheet_id)}/values:batchGet",
+                              dict(ranges=list(ranges)))
+
+    def close(self):
+        """Closes all idle connections."""
+        for pool in list(self._pools.values()):
+            pool.close()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# This script runs a whole tournament through the match runner in virtual time, to test it end to end in seconds.
+#
+# The runner is loaded in this process with a virtual clock (see clocks.py) and a private SQLite backend holding a
+# generated event.  Simulated officials press the buttons in each arena as they appear, after a reaction time:
+# next match, start match, then (once the scores have been entered into the backend) show scores, after which the
+# runner goes back to rotating the tables by itself.  Time jumps straight to the next timer, so a 100 match event
+# that would take a day runs in a few seconds.
+#
+# Every event sent to the overlays and control interfaces is recorded with the virtual time at which it was sent,
+# and checked against the timing the runner promises: patches in sequence, every match run exactly once, the
+# clock phases and audio cues on the right second, and game over on time.  The server CPU time per match is
+# reported too.  The exit status is 1 if any check fails.
+#
+# Usage: ./simulate.py [--matches 100] [--arenas 1] [--server-clock] [--events events.jsonl]
+# The score watcher (watcher.py) polls in real time, so isn't used: the officials enter and show the scores.
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+MATCH_COLUMNS = ['Match', 'Red Competitors', 'Blue Competitors', 'Red Score', 'Blue Score',
+                 'Red Common Balls', 'Blue Common Balls', 'Red Special Balls', 'Blue Special Balls',
+                 'Red Parking', 'Blue Parking', 'Fouls by Red', 'Fouls by Blue']
+TEAM_COLUMNS = ['Rank', 'Team', 'Competitors', 'Played', 'Wins', 'Draws', 'Losses', 'Score']
+
+# Button events the officials press, most urgent first.
+PRESSES = ('show_match_scores', 'start_match', 'next_match')
+
+# Events that measure the network rather than the runner, so run in real time and aren't recorded.
+UNRECORDED = {'ping_clock', 'clock_sync'}
+
+
+def load_runner():
+    """Imports the runner's modules, once the environment has been set up for them."""
+    global backends, clocks, config, control, sheet, thread
+    import backends, clocks, config, control, sheet, thread
+
+
+def generate_event(n_matches, n_teams, rng):
+    """Returns the rows of a generated event, as for SQLiteBackend.write(): the matches (unscored) and the teams."""
+    teams = [f"Team {i}" for i in range(1, n_teams + 1)]
+    matches = [MATCH_COLUMNS]
+    for i in range(1, n_matches + 1):
+        red, blue = rng.sample(teams, 2)
+        matches.append([f"R{i}", red, blue] + [None] * (len(MATCH_COLUMNS) - 3))
+    team_rows = [TEAM_COLUMNS] + [[None, str(i), label, 0, 0, 0, 0, 0] for i, label in enumerate(teams, 1)]
+    return matches, team_rows
+
+
+def random_scores(rng):
+    """Returns the score columns of a played match, by name.  Totals are never both 0 (see sheet.Match.played)."""
+    scores = {}
+    for side in ('Red', 'Blue'):
+        common, special, parking = rng.randint(0, 20), rng.choice((0, 6, 8, 10, 16, 18)), rng.choice((0, 5, 10))
+        scores.update({f'{side} Common Balls': common, f'{side} Special Balls': special, f'{side} Parking': parking,
+                       f'{side} Score': common + special + parking + 1})
+    scores.update({'Fouls by Red': 0, 'Fouls by Blue': 0})
+    return scores
+
+
+class Simulation:
+    """One tournament, run in virtual time.
+
+    Attributes:
+        events: Every event recorded, as dicts with fields t (virtual server time), arena, namespace, event, data.
+        runs: Every match started, as dicts with fields arena, match, started and (once shown) shown.
+    """
+
+    def __init__(self, n_matches, n_teams, seed, gap, setup, scoring):
+        """
+        Args:
+            n_matches, n_teams: Size of the event.
+            seed: Seed for the schedule and the scores.
+            gap: Seconds from the next match button appearing to it being pressed.
+            setup: Seconds from next match to start match.
+            scoring: Seconds from game over until the scores are entered and shown.
+        """
+        self.rng = random.Random(seed)
+        self.delays = dict(next_match=gap, start_match=setup, show_match_scores=scoring)
+        self.clock = clocks.install(clocks.VirtualClock())
+        self.matches, teams = generate_event(n_matches, n_teams, self.rng)
+        self.backend = sheet.backend = backends.SQLiteBackend(':memory:')
+        self.backend.write('matches', self.matches)
+        self.backend.write('teams', teams)
+        # The officials' presses are timers too, so they happen in virtual time with everything else.
+        self.officials = thread.Scheduler(name="Officials")
+        self.schedulers = [arena.scheduler for arena in thread.arenas.values()] + [thread.scheduler, self.officials]
+        self.pending = {} # Press scheduled in each arena: (event, arg, timer).
+        self.events = []
+        self.runs = []
+        self.overlays = {name: config.socketio.test_client(config.app, namespace='/overlay',
+                                                           query_string=f'arena={name}') for name in thread.arenas}
+        self.controls = {name: config.socketio.test_client(config.app, namespace='/control',
+                                                           query_string=f'arena={name}') for name in thread.arenas}
+
+    def record(self):
+        """Moves the events received by the clients so far into self.events."""
+        now = self.clock.now()
+        for i, name in enumerate(thread.arenas):
+            for namespace, client in (('/overlay', self.overlays[name]), ('/control', self.controls[name])):
+                for message in client.get_received(namespace):
+                    event = message['name']
+                    if event in UNRECORDED or (event == 'log_messages' and i > 0):
+                        # The log goes to every control interface, so is only recorded once.
+                        continue
+                    data = message['args'][0] if message['args'] else None
+                    t = now
+                    if event == 'log_messages':
+                        # Sent in batches on a greenthread, so stamped with the time each message was logged.
+                        t = min(entry['t'] for entry in data) - self.clock.epoch
+                    self.events.append(dict(t=round(t, 6), arena=name, namespace=namespace, event=event, data=data))
+
+    def react(self):
+        """Schedules the press of the most urgent button in each arena, if it isn't already scheduled."""
+        for name in thread.arenas:
+            buttons = {button['event']: button['arg'] for button in control.get_buttons(name)}
+            press = next(((event, buttons[event]) for event in PRESSES if event in buttons), None)
+            pending = self.pending.get(name)
+            if pending is not None and pending[:2] == press:
+                continue
+            if pending is not None:
+                pending[2].cancel()
+                del self.pending[name]
+            if press is not None:
+                timer = self.officials.call_later(self.delays[press[0]], self.press, name, *press)
+                self.pending[name] = (*press, timer)
+
+    def press(self, arena, event, arg):
+        del self.pending[arena]
+        now = self.clock.now()
+        if event == 'start_match':
+            self.runs.append(dict(arena=arena, match=arg, started=now, shown=None))
+        elif event == 'show_match_scores':
+            self.enter_scores(arg)
+            for run in self.runs:
+                if run['match'] == arg and run['shown'] is None:
+                    run['shown'] = now
+        self.controls[arena].emit(event, arg, namespace='/control')
+
+    def enter_scores(self, match_id):
+        """Enters random scores for a match into the backend, as the scorers would."""
+        row = next(row for row in self.matches[1:] if row[0] == match_id)
+        for column, value in random_scores(self.rng).items():
+            row[MATCH_COLUMNS.index(column)] = value
+        self.backend.write('matches', self.matches)
+
+    def finished(self):
+        return (sheet.get_snapshot().next_match() is None and not self.pending
+                and all(arena.match_id() is None for arena in thread.arenas.values()))
+
+    def run(self, limit):
+        """Runs the tournament until every match has been played and shown, or for limit seconds of virtual time."""
+        sheet.refresh()
+        for name in thread.arenas:
+            thread.cycle(name)
+        while True:
+            self.record()
+            self.react()
+            if self.finished():
+                break
+            scheduler = min((s for s in self.schedulers if s.next_deadline() is not None),
+                            key=lambda s: s.next_deadline(), default=None)
+            if scheduler is None or scheduler.next_deadline() > limit:
+                break
+            self.clock.advance_to(scheduler.next_deadline())
+            scheduler.run_due()
+        # Let the last batch of log messages go out.
+        config.socketio.sleep(2 * control.LOG_BATCH_DELAY)
+        self.record()
+
+
+def check(sim):
+    """Checks the recorded events against the runner's timing.  Returns a list of failures (empty if all is well)."""
+    failures = []
+    match_class = thread.MatchState
+    play_offset = match_class.count_down_delay + match_class.count_down
+    end_offset = play_offset + match_class.match_length
+
+    counts = collections.Counter(run['match'] for run in sim.runs)
+    for match_id, n in counts.items():
+        if n > 1:
+            failures.append(f"Match {match_id} was run {n} times")
+    for row in sim.matches[1:]:
+        if row[0] not in counts:
+            failures.append(f"Match {row[0]} was never run")
+
+    for name in thread.arenas:
+        events = [e for e in sim.events if e['arena'] == name and e['namespace'] == '/overlay']
+        patches = [e for e in events if e['event'] == 'patch']
+        for previous, patch in zip(patches, patches[1:]):
+            if patch['data']['seq'] != previous['data']['seq'] + 1:
+                failures.append(f"{name}: patch {patch['data']['seq']} followed {previous['data']['seq']}")
+            if patch['data']['ts'] < previous['data']['ts']:
+                failures.append(f"{name}: patch {patch['data']['seq']} sent at an earlier server time")
+        own = {run['match'] for run in sim.runs if run['arena'] == name}
+        for patch in patches:
+            shown = (patch['data'].get('text') or {}).get('match')
+            if shown and shown not in own:
+                failures.append(f"{name}: showed match {shown} from another arena")
+
+        for run in (run for run in sim.runs if run['arena'] == name):
+            start = run['started']
+            during = [e for e in events if start <= e['t'] <= start + end_offset + 1.5]
+            game_over = next((e['t'] for e in during if e['event'] == 'patch'
+                              and 'Scoring in Progress' in str((e['data'].get('text') or {}).get('middle'))), None)
+            if game_over is None or abs(game_over - (start + end_offset + 1)) > 1e-6:
+                failures.append(f"{name}: match {run['match']} game over at {game_over}, not {start + end_offset + 1}")
+            if config.client_clock:
+                clock = next((e['data']['clock'] for e in during if e['event'] == 'patch' and e['data'].get('clock')),
+                             None)
+                phases = {} if clock is None else {p['name']: p['at'] for p in clock['phases']}
+                if phases.get('play') != start + play_offset or phases.get('end') != start + end_offset:
+                    failures.append(f"{name}: match {run['match']} clock phases {phases}")
+            else:
+                cues = {e['data']['name']: e['t'] - start for e in during if e['event'] == 'play_audio'}
+                expected = dict(start=play_offset, warning=end_offset - match_class.end_game, end=end_offset)
+                for cue, offset in expected.items():
+                    if cue not in cues or abs(cues[cue] - offset) > 1e-6:
+                        failures.append(f"{name}: match {run['match']} {cue} cue at {cues.get(cue)}, not {offset}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a whole tournament through the match runner in virtual time.")
+    parser.add_argument('--matches', type=int, default=100, help="Number of matches in the event")
+    parser.add_argument('--teams', type=int, default=16, help="Number of teams in the event")
+    parser.add_argument('--arenas', type=int, default=1, help="Number of fields to run the matches on")
+    parser.add_argument('--server-clock', action='store_true', help="Send the time every second from the server")
+    parser.add_argument('--seed', type=int, default=2102, help="Seed for the schedule and scores")
+    parser.add_argument('--gap', type=float, default=60, help="Seconds before the officials call the next match")
+    parser.add_argument('--setup', type=float, default=45, help="Seconds from calling a match to starting it")
+    parser.add_argument('--scoring', type=float, default=90, help="Seconds from game over to showing the scores")
+    parser.add_argument('--hours', type=float, default=72, help="Most hours of virtual time to run for")
+    parser.add_argument('--events', help="File to write every recorded event to, one JSON line each")
+    args = parser.parse_args()
+
+    # Set up before the runner's modules are imported, since config reads the environment.
+    os.environ.update(
+        ANTHILL_ARENAS=",".join(str(i) for i in range(1, args.arenas + 1)) if args.arenas > 1 else 'main',
+        ANTHILL_CLIENT_CLOCK='0' if args.server_clock else '1',
+        ANTHILL_STATE_FILE='', ANTHILL_MESSAGE_QUEUE='', ANTHILL_JOURNAL_FILE='', ANTHILL_TRACE_FILE='',
+        ANTHILL_BACKEND='sqlite', ANTHILL_DATA_PATH=':memory:',
+    )
+    load_runner()
+    config.logger.setLevel('WARNING')
+    sheet.logger.setLevel('WARNING')
+
+    sim = Simulation(args.matches, args.teams, args.seed, args.gap, args.setup, args.scoring)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    sim.run(args.hours * 3600)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    failures = check(sim)
+
+    sizes = collections.Counter()
+    counts = collections.Counter()
+    for e in sim.events:
+        counts[e['event']] += 1
+        sizes[e['event']] += len(json.dumps(e['data'], separators=(',', ':')))
+    print(json.dumps(dict(
+        matches=len(sim.runs),
+        virtual_hours=round(sim.clock.now() / 3600, 2),
+        wall_seconds=round(wall, 2),
+        cpu_seconds=round(cpu, 2),
+        cpu_ms_per_match=round(1000 * cpu / max(1, len(sim.runs)), 1),
+        events={name: dict(count=counts[name], bytes=sizes[name]) for name in sorted(counts)},
+    ), indent=1))
+    if args.events:
+        with open(args.events, 'w') as f:
+            for e in sim.events:
+                f.write(json.dumps(e, separators=(',', ':')) + "\n")
+        print(f"Wrote {len(sim.events)} events to {args.events}")
+    for failure in failures:
+        print("FAIL:", failure)
+    print(f"{len(failures)} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# This module computes the standings (the team table) from the match scores, rather than relying on the
+# spreadsheet's formulas.  The standings are up to date as soon as a new score is read from the spreadsheet.
+#
+# Each scored match adds its result to the totals of the two competitors.  When a new snapshot changes only a few
+# matches, just their old results are taken away and their new results added, so a score landing costs almost
+# nothing however many matches there are.  A complete rebuild (on startup, or when the teams change) uses numpy,
+# if it is installed and the event is large enough for that to be worthwhile.
+#
+# A match counts once it has been played, that is once either score is non-zero (see sheet.Match),
+# as long as both scores are numbers.  A score cell holding text (e.g. "DQ") leaves the match out, with a warning.
+
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import config
+import sheet
+
+# Points for a win and a draw.
+WIN_POINTS = 2
+DRAW_POINTS = 1
+
+# Rebuilds with at least this many matches use numpy (if installed).
+VECTORIZE_THRESHOLD = 500
+
+# Positions of each total in a competitor's list of totals.
+PLAYED, WINS, DRAWS, LOSSES, POINTS, SCORED, CONCEDED = range(7)
+N_TOTALS = 7
+
+
+def result_of(match):
+    """Returns the result that a match contributes to the standings, or None if it doesn't count (yet).
+
+    Returns:
+        result: Tuple of red competitors, blue competitors, red score and blue score.
+    """
+    if not match.played or match.red is None or match.blue is None:
+        return None
+    if config.STANDINGS_ROUNDS is not None and match.round not in config.STANDINGS_ROUNDS:
+        return None
+    red_score, blue_score = match.red_score or 0, match.blue_score or 0
+    if not isinstance(red_score, int) or not isinstance(blue_score, int):
+        config.logger.warning("Leaving match %s out of the standings: its scores (%r, %r) aren't both numbers",
+                              match.id, match.red_score, match.blue_score)
+        return None
+    return (match.red, match.blue, red_score, blue_score)
+
+
+def add_result(totals, result, sign=1):
+    """Adds a result (as from result_of()) to the totals of both competitors, or takes it away if sign is -1."""
+    red, blue, red_score, blue_score = result
+    for label, scored, conceded in ((red, red_score, blue_score), (blue, blue_score, red_score)):
+        entry = totals.get(label)
+        if entry is None:
+            entry = totals[label] = [0] * N_TOTALS
+        entry[PLAYED] += sign
+        entry[SCORED] += sign * scored
+        entry[CONCEDED] += sign * conceded
+        if scored > conceded:
+            entry[WINS] += sign
+            entry[POINTS] += sign * WIN_POINTS
+        elif scored == conceded:
+            entry[DRAWS] += sign
+            entry[POINTS] += sign * DRAW_POINTS
+        else:
+            entry[LOSSES] += sign
+
+
+def sum_results(labels, results):
+    """Returns the totals of every competitor from a list of results, using numpy.
+
+    Args:
+        labels: List of competitor labels, including every one in results.
+        results: List of results, as from result_of().
+    """
+    index = {label: i for i, label in enumerate(labels)}
+    red = numpy.fromiter((index[r[0]] for r in results), dtype=numpy.intp, count=len(results))
+    blue = numpy.fromiter((index[r[1]] for r in results), dtype=numpy.intp, count=len(results))
+    red_score = numpy.fromiter((r[2] for r in results), dtype=numpy.int64, count=len(results))
+    blue_score = numpy.fromiter((r[3] for r in results), dtype=numpy.int64, count=len(results))
+
+    totals = numpy.zeros((len(labels), N_TOTALS), dtype=numpy.int64)
+    for side, scored, conceded in ((red, red_score, blue_score), (blue, blue_score, red_score)):
+        won = scored > conceded
+        drawn = scored == conceded
+        numpy.add.at(totals[:, PLAYED], side, 1)
+        numpy.add.at(totals[:, SCORED], side, scored)
+        numpy.add.at(totals[:, CONCEDED], side, conceded)
+        numpy.add.at(totals[:, WINS], side, won)
+        numpy.add.at(totals[:, DRAWS], side, drawn)
+        numpy.add.at(totals[:, LOSSES], side, ~(won | drawn))
+        numpy.add.at(totals[:, POINTS], side, won * WIN_POINTS + drawn * DRAW_POINTS)
+    return {label: [int(x) for x in row] for label, row in zip(labels, totals.tolist())}
+
+
+def sort_key(label, entry):
+    """Tie-breakers, in order: points, wins, score difference, total scored, then label."""
+    return (-entry[POINTS], -entry[WINS], -(entry[SCORED] - entry[CONCEDED]), -entry[SCORED], str(label))
+
+
+class Standings:
+    """The standings for the latest snapshot, updated incrementally as snapshots change.
+    Safe to use from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.teams = {} # Team records by competitor label.
+        self.results = {} # Result counted for each match, by match ID.
+        self.totals = {} # List of totals (see PLAYED etc.) by competitor label.
+        self._ranked = None
+
+    def update(self, snapshot):
+        """Brings the standings up to date with a snapshot."""
+        with self.lock:
+            if snapshot.version == self.version:
+                return
+            if (self.version is not None and snapshot.version == self.version + 1 and not snapshot.changed_teams
+                    and snapshot.changed_matches):
+                self._apply_changes(snapshot)
+            else:
+                self._rebuild(snapshot)
+            self.version = snapshot.version
+            self._ranked = None
+
+    def _rebuild(self, snapshot):
+        self.teams = {team.competitors: team for team in snapshot.teams if team.competitors is not None}
+        self.results = {}
+        for match in snapshot.matches:
+            result = result_of(match)
+            if result is not None:
+                self.results[match.id] = result
+        results = list(self.results.values())
+        if numpy is not None and len(results) >= VECTORIZE_THRESHOLD:
+            labels = list(dict.fromkeys([*self.teams, *(r[0] for r in results), *(r[1] for r in results)]))
+            self.totals = sum_results(labels, results)
+        else:
+            self.totals = {label: [0] * N_TOTALS for label in self.teams}
+            for result in results:
+                add_result(self.totals, result)
+
+    def _apply_changes(self, snapshot):
+        for match_id in snapshot.changed_matches:
+            old = self.results.pop(match_id, None)
+            if old is not None:
+                add_result(self.totals, old, -1)
+            match = snapshot.match(match_id)
+            new = None if match is None else result_of(match)
+            if new is not None:
+                add_result(self.totals, new)
+                self.results[match_id] = new
+
+    def ranked(self, snapshot):
+        """Returns the standings for a snapshot, best first.
+
+        Returns:
+            rows: List of dicts, with the same fields as the teams range, as used by team.html:
+                Rank (equal for competitors tied on every tie-breaker but the label), Team, Competitors,
+                Played, Wins, Draws, Losses, Score (points), and also For and Against (total scores).
+        """
+        self.update(snapshot)
+        with self.lock:
+            if self._ranked is not None:
+                return self._ranked
+            ordered = sorted(self.totals.items(), key=lambda item: sort_key(*item))
+            rows = []
+            previous = None
+            for position, (label, entry) in enumerate(ordered, 1):
+                key = sort_key(label, entry)[:-1]
+                if key != previous:
+                    rank, previous = position, key
+                team = self.teams.get(label)
+                rows.append({
+                    'Rank': rank,
+                    'Team': None if team is None else team.id,
+                    'Competitors': label,
+                    'Played': entry[PLAYED],
+                    'Wins': entry[WINS],
+                    'Draws': entry[DRAWS],
+                    'Losses': entry[LOSSES],
+                    'Score': entry[POINTS],
+                    'For': entry[SCORED],
+                    'Against': entry[CONCEDED],
+                })
+            self._ranked = rows
+            return rows
+
+
+# The one engine, kept up to date as the spreadsheet changes.
+engine = Standings()
+
+
+def ranked(snapshot=None):
+    """Returns the standings for a snapshot (by default the latest), as for Standings.ranked()."""
+    return engine.ranked(snapshot or sheet.get_snapshot())
+
+
+# Update as soon as a new snapshot is published, so the standings are ready before they are next shown.
+sheet.subscribe('matches', lambda snapshot, changed: engine.update(snapshot))
+sheet.subscribe('teams', lambda snapshot, changed: engine.update(snapshot))
@@ -1,6 +1,9 @@
+// The URL parameter "arena" chooses the field to control, when the server runs several (the first if not given).
+const arena = new URLSearchParams(window.location.search).get('arena') || '';
+
 $(document).ready(function() {
     namespace = '/control';
-    var socket = io(namespace);
+    var socket = io(namespace, {query: {arena: arena}});
 
     // When the user clicks on a button, send the associated event to the server.
     function handle_button_click(event, data) {
@@ -8,37 +11,216 @@ $(document).ready(function() {
         //console.log("handle_button_click: " + data);
     }
 
-    // When the server sends a "set_buttons" event, create HTML buttons, optionally clearing the list.
+    // Button elements shown, by key.
+    var button_elements = new Map();
+
+    // Creates the element for a button, as sent by the server.
+    function button_element(item) {
+        var button = document.createElement("button");
+        button.innerHTML = item["label"];
+        button.addEventListener("click", function(event) { handle_button_click(event, item); });
+        return button;
+    }
+
+    // When the server sends a "set_buttons" event (on connection), create HTML buttons, optionally clearing the list.
     // Data is an object with fields:
     //     clear: If true, delete all existing buttons
     //     buttons: Array of objects with fields like:
     //         event: Event string to send to server on click
     //         arg: Argument to send to server
     //         label: String to show to user.
+    //         key: Identifies the button in later "patch_buttons" events.
+    //     arena: Name of the arena these buttons control.
     socket.on('set_buttons', function(data, cb) {
-        //console.log("set_buttons: data=" + data);
         var buttons = $("div#buttons");     
-        //console.log("buttons=" + buttons);
+        if(data['arena'] !== undefined) {
+            // Preview the overlay of the same arena.  Setting the same source again would reload it.
+            var preview = "/overlay.html?role=preview&arena=" + encodeURIComponent(data['arena']);
+            $("#arena").text(data['arena']);
+            if($("iframe").attr("src") !== preview) { $("iframe").attr("src", preview); }
+        }
         if(data['clear']) {
             buttons.empty();
+            button_elements.clear();
         }
         data['buttons'].forEach(function (item, index) {
-            var button = document.createElement("button");
-            button.innerHTML = item["label"];
-            //console.log("Button: " + item["label"]);
-            button.addEventListener("click", function(event) { handle_button_click(event, item); });
+            var button = button_element(item);
+            button_elements.set(item['key'], button);
             buttons.append(button);
         });
         if(cb) { cb(); }
     });
 
-    // When the server sends a "log_message" event, send the argument to console and print on-screen with a timestamp.
-    socket.on('log_message', function(data, cb) {
+    // When the server sends a "patch_buttons" event, change only the buttons that changed.
+    // Data is an object with fields:
+    //     remove: Array of keys of buttons to remove.
+    //     put: Array of buttons to add or replace, as for "set_buttons", each with an "after" field: the key of the
+    //         button it follows, or null to go first.
+    socket.on('patch_buttons', function(data) {
+        var buttons = $("div#buttons");
+        data['remove'].forEach(function (key) {
+            $(button_elements.get(key)).remove();
+            button_elements.delete(key);
+        });
+        data['put'].forEach(function (item) {
+            $(button_elements.get(item['key'])).remove();
+            var button = button_element(item);
+            button_elements.set(item['key'], button);
+            if(item['after'] === null) {
+                buttons.prepend(button);
+            } else {
+                $(button_elements.get(item['after'])).after(button);
+            }
+        });
+    });
+
+    // When the server sends a "matches_changed" event (e.g. because scores were entered), the match browser is
+    // out of date, so fetch the page shown again.  The version makes sure it comes from the new snapshot,
+    // whichever worker we are connected to.
+    socket.on('matches_changed', function(data) {
+        browse_matches(browser_page, data['version']);
+    });
+
+    // Match browser: the filters, and the page shown.
+    var browser_page = 0;
+
+    // Asks the server for a page of matches matching the filters, and shows them.
+    // The server sends back an object with matches (each with id, round, red, blue, red_score, blue_score, played),
+    // page, pages, total, rounds (for the round filter) and next (the next match to play).
+    function browse_matches(page, version) {
+        var query = {status: $("#browse_status").val(), round: $("#browse_round").val(),
+                     team: $("#browse_team").val(), page: page, version: version};
+        socket.emit('browse_matches', query, function(result) {
+            browser_page = result['page'];
+            var round = $("#browse_round");
+            var selected = round.val();
+            round.empty();
+            round.append(new Option("All rounds", ""));
+            result['rounds'].forEach(function (r) { round.append(new Option(r, r)); });
+            round.val(selected);
+
+            var rows = $("table#matches tbody");
+            rows.empty();
+            result['matches'].forEach(function (match) {
+                var row = document.createElement("tr");
+                if(match['id'] === result['next']) { row.className = "next"; }
+                var scores = match['played'] ? match['red_score'] + " - " + match['blue_score'] : "";
+                [match['id'], match['red'], match['blue'], scores].forEach(function (value) {
+                    var cell = document.createElement("td");
+                    cell.textContent = (value == null) ? "" : value;
+                    row.append(cell);
+                });
+                var cell = document.createElement("td");
+                cell.append(button_element({event: "next_match", arg: match['id'], label: "Next match"}));
+                row.append(cell);
+                rows.append(row);
+            });
+            $("#browse_position").text("Page " + (result['page'] + 1) + " of " + result['pages'] +
+                                       " (" + result['total'] + " matches)");
+        });
+    }
+
+    $("#browse_status, #browse_round").change(function() { browse_matches(0); });
+    $("#browse_team").on("input", function() { browse_matches(0); });
+    $("#browse_previous").click(function() { browse_matches(browser_page - 1); });
+    $("#browse_next").click(function() { browse_matches(browser_page + 1); });
+
+    // Log messages shown, by ID, so that a message in both the backlog and a batch is only shown once.
+    var shown_log = new Set();
+    // ID of the oldest message shown, for fetching the page before it.
+    var oldest_log = null;
+    // Batches of messages that arrived while waiting for the latest messages on (re)connection, or null if not
+    // waiting.  They are shown after the latest messages, since they are newer.
+    var pending_log = null;
+
+    // Creates the element for a log message, as sent by the server: object with id, t (seconds since 1970),
+    // level, message and arena (null if not about any one arena).
+    function log_element(entry) {
+        var line = document.createElement("div");
+        line.className = "log-" + entry['level'];
+        line.textContent = new Date(entry['t'] * 1000).toISOString() + " " +
+            (entry['arena'] ? "[" + entry['arena'] + "] " : "") + entry['message'];
+        return line;
+    }
+
+    // Shows messages newer than those already shown, above them.  Entries are oldest first.
+    function show_new_log(entries) {
         var log = $("#log");
-        var now = new Date().toISOString();
-        console.log(now + " " + data);
-        log.prepend(document.createElement("br"));
-        log.prepend(document.createTextNode(now + " " + data));
-    });                    
+        entries.forEach(function (entry) {
+            if(shown_log.has(entry['id'])) { return; }
+            shown_log.add(entry['id']);
+            if(oldest_log === null) { oldest_log = entry['id']; }
+            console.log(entry['message']);
+            log.prepend(log_element(entry));
+        });
+    }
+
+    // When the server sends a "log_messages" event, with a batch of messages, print them on-screen.
+    socket.on('log_messages', function(entries) {
+        if(pending_log !== null) {
+            pending_log.push(...entries);
+            return;
+        }
+        show_new_log(entries);
+    });
+
+    // On (re)connection, fetch the latest messages, including any logged while disconnected.
+    // Data sent back by the server is an object with entries (oldest first) and more (true if there are older ones).
+    // Batches that arrive meanwhile are held until then, so that they are shown above the older messages.
+    // Also refresh the match browser.
+    socket.on('connect', function() {
+        browse_matches(browser_page);
+        pending_log = [];
+        socket.emit('get_log', {}, function(page) {
+            var first_page = oldest_log === null;
+            show_new_log(page['entries']);
+            show_new_log(pending_log.sort((a, b) => a['id'] - b['id']));
+            pending_log = null;
+            if(first_page) { $("#older_log").toggle(page['more']); }
+        });
+    });
+
+    // Fetches the page before the oldest message shown, and shows it below.
+    function show_older_log() {
+        socket.emit('get_log', {before: oldest_log}, function(page) {
+            var log = $("#log");
+            page['entries'].slice().reverse().forEach(function (entry) {
+                if(shown_log.has(entry['id'])) { return; }
+                shown_log.add(entry['id']);
+                log.append(log_element(entry));
+            });
+            if(page['entries'].length > 0) {
+                oldest_log = page['entries'][0]['id'];
+            }
+            $("#older_log").toggle(page['more']);
+        });
+    }
+
+    $("#older_log").click(show_older_log);
+
+    // Overlays connected to each worker, by worker ID.
+    var clients = new Map();
+
+    // When the server sends a "set_clients" event, show the measured latency of each overlay.
+    // Data is an object with fields:
+    //     worker: ID of the server process the overlays are connected to.
+    //     clients: Array of objects with sid, arena, rtt (round trip time), offset (server clock minus overlay clock)
+    //         and delay (added by the overlay), all in seconds, rtt and offset null if not yet measured.
+    socket.on('set_clients', function(data) {
+        clients.set(data['worker'], data['clients']);
+        var ms = x => (x == null) ? "?" : (x * 1000).toFixed(1);
+        var rows = $("table#clients tbody");
+        rows.empty();
+        clients.forEach(function (list, worker) {
+            list.forEach(function (client) {
+                var row = document.createElement("tr");
+                [client['sid'], client['arena'], ms(client['rtt']), ms(client['offset']), client['delay'], worker].forEach(function (value) {
+                    var cell = document.createElement("td");
+                    cell.textContent = value;
+                    row.append(cell);
+                });
+                rows.append(row);
+            });
+        });
+    });
 });
-$(iframe)[0].mute();
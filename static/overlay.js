@@ -1,51 +1,491 @@
 // When combining this overlay with video and audio streams, it is important to synchronize them.
-// To support this, we read the URL parameter "delay" and we sleep for that long (in seconds) 
-// before executing server events.  This allows the client to delay the browser overlay source.
+// To support this, we read the URL parameter "delay" and we apply server events that much later (in seconds).
+// This allows the client to delay the browser overlay source.  We pass the delay to the server, which sends
+// each event shortly before it is due rather than straight away, and on (re)connection sends the state as of
+// delay seconds ago, so we only ever hold the next few events.
+//
+// Every event from the server carries a target display time ("at", in server time).  Events are put on a single
+// queue and applied in order, each at its target time plus the delay.  The server pings us regularly to measure
+// the offset between its clock and ours, so that target times can be converted to our clock.
+//
+// Audio cues are played through Web Audio.  The server sends a manifest of cues when we connect, and we fetch and
+// decode them all in advance, so each cue can be scheduled for the exact time it is due.
+// The URL parameter "role" tells the server what this overlay is for (e.g. "preview" in the control interface,
+// which the server mutes), and "gain" overrides the volume the server asks for (0 to 1).
+// The URL parameter "arena" chooses the field to show, when the server runs several (the first if not given).
+//
+// Tables come either as HTML or, if the server is set to send table data, as rows of data that we fill into a
+// template.  The server sends the URLs of the templates when we connect, and we fetch them once.  When a table
+// of data replaces an earlier version of the same table, the server just sends the rows that changed, and we only
+// touch the cells that changed.
 
 const queryString = window.location.search;
 const urlParams = new URLSearchParams(queryString);
-const delay = urlParams.get('delay', 0);
+const delay = parseFloat(urlParams.get('delay')) || 0;
+const role = urlParams.get('role') || 'overlay';
+const gain_param = urlParams.get('gain');
+const arena = urlParams.get('arena') || '';
 
 $(document).ready(function() {
     namespace = '/overlay';
-    var socket = io(namespace);
+    var socket = io(namespace, {query: {role: role, arena: arena, delay: delay}});
 
-    // When we receive an "update_event" from the server, set the various small text elements.
-    // Data contains id strings, which should be on DIVs containing Ps.
-    socket.on('update_text', async function(data, cb) {
-        // Sleep for "delay" seconds.
-        if(delay > 0) { await new Promise(r => setTimeout(r, delay*1000)); }
-        for(const property in data) {
-            $("#" + property + " p").html(data[property]);
+    // Server time is estimated as local_time() + clock_offset.  All times are in seconds.
+    // Until the server has measured the offset, it is estimated from when events arrive.
+    var clock_offset = 0;
+    var offset_source = null; // null, "arrival" or "measured".
+
+    function local_time() { return performance.now() / 1000; }
+
+    // Returns the server time of the events being shown now, which is behind the server by the delay.
+    function shown_time() { return local_time() + clock_offset - delay; }
+
+    // Estimates the offset from the time an event was sent, if nothing better is known yet.
+    function estimate_offset(server_time) {
+        if(offset_source == null) {
+            clock_offset = server_time - local_time();
+            offset_source = "arrival";
         }
-        if(cb) { cb(); }
+    }
+
+    // The server pings us with its clock.  Acknowledge with ours, and our delay.
+    socket.on('ping_clock', function(data, cb) {
+        if(cb) { cb({time: local_time(), delay: delay}); }
     });
 
-    // When we receive the "show_table" event from the server, 
-    // we display an arbitrary HTML fragment (probably a table).
-    // The data is a raw HTML string or null.
-    // If null, then the element is hidden.
-    socket.on('show_table', async function(data, cb) {
-        // Sleep for "delay" seconds.
-        if(delay > 0) { await new Promise(r => setTimeout(r, delay*1000)); }
+    // The server sends the offset it measured from the pings, with fields offset and rtt (round trip time).
+    socket.on('clock_sync', function(data) {
+        clock_offset = data.offset;
+        offset_source = "measured";
+    });
+
+    // Events waiting to be applied, oldest first.  Each is an object with fields:
+    //     at: Target display time (server time), or null to apply straight away.
+    //     apply: Function that applies the event, which may return a promise.
+    var queue = [];
+    var queue_running = false;
+
+    function enqueue(at, apply) {
+        queue.push({at: at, apply: apply});
+        if(!queue_running) { run_queue(); }
+    }
+
+    // Applies queued events one at a time, in order, each no earlier than its target time.
+    async function run_queue() {
+        queue_running = true;
+        while(queue.length > 0) {
+            var event = queue.shift();
+            var wait = (event.at == null) ? 0 : event.at - shown_time();
+            if(wait > 0) { await new Promise(r => setTimeout(r, wait * 1000)); }
+            await event.apply();
+        }
+        queue_running = false;
+    }
+
+    // Web Audio state.  Decoded cues are kept by URL, so they aren't fetched again when we reconnect.
+    var audio_context = (window.AudioContext || window.webkitAudioContext) ?
+        new (window.AudioContext || window.webkitAudioContext)() : null;
+    var audio_output = null; // GainNode that every cue plays through.
+    var audio_gain = 1;
+    var cue_urls = new Map(); // Cue name to URL.
+    var cue_buffers = new Map(); // URL to decoded AudioBuffer.
+
+    // The server sends an "audio_manifest" event when we connect, with fields:
+    //     cues: Object with a field for each cue name, each an object with field url.
+    //     gain: Volume from 0 (muted) to 1.
+    socket.on('audio_manifest', function(data) {
+        audio_gain = (gain_param != null) ? parseFloat(gain_param) : data.gain;
+        if(audio_context != null) {
+            if(audio_output == null) {
+                audio_output = audio_context.createGain();
+                audio_output.connect(audio_context.destination);
+            }
+            audio_output.gain.value = audio_gain;
+        }
+        for(const name in data.cues) {
+            const url = data.cues[name].url;
+            cue_urls.set(name, url);
+            if(audio_context == null || audio_gain == 0 || cue_buffers.has(url)) { continue; }
+            fetch(url)
+                .then(response => response.arrayBuffer())
+                .then(bytes => new Promise((resolve, reject) => audio_context.decodeAudioData(bytes, resolve, reject)))
+                .then(buffer => cue_buffers.set(url, buffer))
+                .catch(error => console.log("Failed to load cue " + name + ": " + error));
+        }
+    });
+
+    // Browsers may not start audio until the page has been interacted with.
+    $(document).on('click keydown', function() {
+        if(audio_context != null && audio_context.state == "suspended") { audio_context.resume(); }
+    });
+
+    // Schedules a cue to play at a server time (plus our delay), exactly.
+    // Returns the Web Audio source (which can be stopped), or null if the cue isn't decoded (or we are muted).
+    function schedule_cue(name, at) {
+        var buffer = cue_buffers.get(cue_urls.get(name));
+        if(audio_gain == 0 || buffer == null) { return null; }
+        if(audio_context.state == "suspended") { audio_context.resume(); }
+        var source = audio_context.createBufferSource();
+        source.buffer = buffer;
+        source.connect(audio_output);
+        source.start(audio_context.currentTime + Math.max(0, at - shown_time()));
+        return source;
+    }
+
+    // Plays a cue now.  Falls back to an Audio element if it hasn't been decoded.
+    function play_cue(name) {
+        if(audio_gain == 0 || !cue_urls.has(name)) { return; }
+        if(schedule_cue(name, shown_time()) != null) { return; }
+        var element = new Audio(cue_urls.get(name));
+        element.volume = audio_gain;
+        element.play();
+    }
+
+    // Last time text sent by the server.  This is shown instead of the match clock when it isn't running.
+    var server_time_text = "";
+
+    // Set the various small text elements.
+    // Text is an object whose keys are id strings, which should be on DIVs containing Ps.
+    function apply_text(text) {
+        for(const property in text) {
+            if(property == "time") {
+                server_time_text = text[property];
+                if(clock != null) { continue; }
+            }
+            $("#" + property + " p").html(text[property]);
+        }
+    }
+
+    // The match clock is sent once at the start of a match (and occasionally resent to correct drift).
+    // It gives the server time at which each phase starts.  We tick locally on each whole second
+    // after the start (plus the delay), showing the time and playing the audio cues.
+    var clock = null;
+    var clock_timer = null;
+    var tick_lateness = []; // How late each tick was, reported to the server at the end of the match.
+    var scheduled_cues = []; // Cues scheduled for the clock, each an object with second and source.
+
+    // Returns the start of a phase of the match clock, in whole seconds after the start of the match.
+    function phase_second(name) {
+        var phase = clock.phases.find(p => p.name == name);
+        return Math.round(phase.at - clock.start);
+    }
+
+    // Returns the time to show at a whole number of seconds after the start of the match, or null if not yet counting.
+    function clock_text(second) {
+        var countdown = phase_second("countdown"), play = phase_second("play"), end = phase_second("end");
+        if(second < countdown) { return null; }
+        if(second < play) { return play - second; }
+        var remaining = Math.max(end - second, 0);
+        return String(Math.floor(remaining / 60)).padStart(2, "0") + ":" + String(remaining % 60).padStart(2, "0");
+    }
+
+    // Returns the audio cue to play at a whole number of seconds after the start of the match, or null.
+    function clock_cue(second) {
+        if(second == phase_second("end")) { return "end"; }
+        if(second == phase_second("endgame")) { return "warning"; }
+        if(second == phase_second("play")) { return "start"; }
+        if(second >= phase_second("countdown") && second < phase_second("play")) { return "countdown"; }
+        return null;
+    }
+
+    function show_clock(second) {
+        var text = clock_text(second);
+        $("#time p").html(text == null ? server_time_text : text);
+    }
+
+    // Schedule the next tick at the next whole second after the start of the match, until the end.
+    function schedule_tick() {
+        var now = shown_time();
+        var second = Math.floor(now - clock.start + 0.001) + 1;
+        if(second > phase_second("end")) { return; }
+        clock_timer = setTimeout(function() { tick(second); }, (clock.start + second - now) * 1000);
+    }
+
+    function tick(second) {
+        clock_timer = null;
+        tick_lateness.push(shown_time() - (clock.start + second));
+        show_clock(second);
+        var cue = clock_cue(second);
+        if(cue != null && !scheduled_cues.some(c => c.second == second)) { play_cue(cue); }
+        if(second == phase_second("end")) { report_clock_stats(); }
+        schedule_tick();
+    }
+
+    // Schedules the audio cues for every second of the clock still to come, replacing any scheduled before.
+    // Cues already playing are left to finish.
+    function schedule_clock_cues() {
+        var now = shown_time();
+        scheduled_cues.forEach(function (c) {
+            if(clock == null || clock.start + c.second > now) { c.source.stop(); }
+        });
+        scheduled_cues = [];
+        if(clock == null) { return; }
+        var first = Math.floor(now - clock.start + 0.001) + 1;
+        for(var second = first; second <= phase_second("end"); second++) {
+            var cue = clock_cue(second);
+            var source = (cue == null) ? null : schedule_cue(cue, clock.start + second);
+            if(source != null) { scheduled_cues.push({second: second, source: source}); }
+        }
+    }
+
+    // Tell the server how late our ticks were, so it can be compared with sending every second.
+    function report_clock_stats() {
+        if(tick_lateness.length == 0) { return; }
+        var ordered = tick_lateness.slice().sort((a, b) => a - b);
+        var ms = x => Math.round(x * 10000) / 10;
+        socket.emit('clock_stats', {
+            match: clock.match,
+            ticks: ordered.length,
+            mean_ms: ms(ordered.reduce((a, b) => a + b, 0) / ordered.length),
+            p95_ms: ms(ordered[Math.min(ordered.length - 1, Math.floor(ordered.length * 0.95))]),
+            max_ms: ms(ordered[ordered.length - 1]),
+        });
+        tick_lateness = [];
+    }
+
+    // Start, correct or stop the match clock.
+    // Data is null to stop the clock, or an object with fields:
+    //     match: Match ID.
+    //     start: Server time at which the match started.
+    //     now: Server time when this was sent, used to estimate our offset from the server clock.
+    //     phases: Array of objects with name ("countdown", "play", "endgame" or "end") and at (server time).
+    function apply_clock(data) {
+        if(clock_timer != null) {
+            clearTimeout(clock_timer);
+            clock_timer = null;
+        }
         if(data == null) {
-            $("#table")[0].style.display = "none";
+            clock = null;
+            schedule_clock_cues();
+            $("#time p").html(server_time_text);
+            return;
+        }
+        if(clock == null || clock.match != data.match || clock.start != data.start) { tick_lateness = []; }
+        clock = data;
+        estimate_offset(data.now);
+        show_clock(Math.floor(shown_time() - clock.start + 0.001));
+        schedule_clock_cues();
+        schedule_tick();
+    }
+
+    // HTML fragments (or tables of data) received so far, by fragment ID.
+    // The server only sends the HTML for a fragment once, and after that just sends its ID.
+    var fragments = new Map();
+    const max_fragments = 64;
+
+    function remember_fragment(id, html) {
+        fragments.set(id, html);
+        if(fragments.size > max_fragments) { fragments.delete(fragments.keys().next().value); }
+    }
+
+    // Returns the HTML (or data) for a fragment, asking the server for it if we don't have it (e.g. we connected late).
+    async function get_fragment(id) {
+        if(!fragments.has(id)) {
+            var html = await new Promise(r => socket.emit('get_fragment', id, r));
+            if(html == null) { return null; }
+            remember_fragment(id, html);
+        }
+        return fragments.get(id);
+    }
+
+    // Templates for tables of data, by name.  Each is a promise of the template's table element.
+    var table_templates = new Map();
+
+    // The server sends a "table_templates" event when we connect, if it sends tables as data.
+    // Data is an object with a field for each template name, each an object with field url.
+    // The URL changes whenever the template does, so a template is only fetched again if its URL has changed.
+    socket.on('table_templates', function(data) {
+        for(const name in data) {
+            const url = data[name].url;
+            if(table_templates.has(name) && table_templates.get(name).url == url) { continue; }
+            var template = fetch(url)
+                .then(response => response.text())
+                .then(function(html) {
+                    var holder = document.createElement('div');
+                    holder.innerHTML = html;
+                    return holder.querySelector('table');
+                })
+                .catch(function(error) {
+                    console.log("Failed to load table template " + name + ": " + error);
+                    return null;
+                });
+            template.url = url;
+            table_templates.set(name, template);
+        }
+    });
+
+    // Returns a table of data with a diff from the server applied to it.
+    // A table of data is an object with fields:
+    //     template: Name of its template.
+    //     key: Identifies the table.  Later versions of the same table have the same key.
+    //     fields: Names of the fields in each row.
+    //     rows: Array of rows, each an array of the row's ID and then the value of each field.
+    // A diff is an object with fields:
+    //     put: Rows that are new or have changed.
+    //     remove: IDs of rows that are no longer in the table.
+    //     order: Optional IDs of every row, in order.  If omitted, the old rows (less those removed) come first,
+    //         followed by the new rows.
+    function apply_diff(base, diff) {
+        var rows = new Map(base.rows.map(row => [String(row[0]), row]));
+        diff.remove.forEach(id => rows.delete(String(id)));
+        diff.put.forEach(row => rows.set(String(row[0]), row));
+        var order = (diff.order != null) ? diff.order.map(String) : Array.from(rows.keys());
+        return {template: base.template, key: base.key, fields: base.fields, rows: order.map(id => rows.get(id))};
+    }
+
+    // The table of data being shown, or null if the table is HTML (or hidden).
+    var shown_data = null;
+
+    // Returns a value of a table of data as it is shown in a cell.
+    function cell_html(value) { return (value == null) ? "" : String(value); }
+
+    // Fills in the cells of a row's copy of the template (a tbody) that have changed since it was last filled in.
+    function fill_row(body, fields, values) {
+        var old = body.row_values;
+        fields.forEach(function(field, i) {
+            var value = values[i + 1];
+            if(old != null && old[i + 1] === value) { return; }
+            body.querySelectorAll('[data-field]').forEach(function(cell) {
+                if(cell.dataset.field == field) { cell.innerHTML = cell_html(value); }
+            });
+            body.querySelectorAll('[data-class]').forEach(function(cell) {
+                if(cell.dataset.class != field) { return; }
+                if(old != null && old[i + 1]) { cell.classList.remove(old[i + 1]); }
+                if(value) { cell.classList.add(value); }
+            });
+        });
+        body.row_values = values;
+    }
+
+    // Shows a table of data.  If the same table is already showing, only the rows and cells that changed are
+    // touched.  Otherwise, the table is built from its template.  Returns false if the template isn't available.
+    async function show_data(data) {
+        var template = await (table_templates.get(data.template) || null);
+        if(template == null) { return false; }
+        var element = $("#table")[0];
+        var table = element.firstElementChild;
+        if(shown_data == null || table == null || shown_data.template != data.template || shown_data.key != data.key
+                || shown_data.fields.join("\n") != data.fields.join("\n")) {
+            table = template.cloneNode(true);
+            table.querySelectorAll('[data-row]').forEach(row => row.remove());
+            $("#table").empty().append(table);
+        }
+        var prototype = template.querySelector('[data-row]');
+        var bodies = new Map();
+        table.querySelectorAll('tbody[data-id]').forEach(body => bodies.set(body.dataset.id, body));
+        // Each row is moved into place only if it isn't already there.
+        var next = table.querySelector('tbody[data-id]');
+        data.rows.forEach(function(values) {
+            var id = String(values[0]);
+            var body = bodies.get(id);
+            bodies.delete(id);
+            if(body == null) {
+                body = prototype.cloneNode(true);
+                body.removeAttribute('data-row');
+                body.dataset.id = id;
+            }
+            fill_row(body, data.fields, values);
+            if(body === next) {
+                next = body.nextElementSibling;
+            } else {
+                table.insertBefore(body, next);
+            }
+        });
+        bodies.forEach(body => body.remove());
+        shown_data = data;
+        return true;
+    }
+
+    // Display an arbitrary HTML fragment (probably a table), or a table of data.
+    // The table is null or an object with fields:
+    //     id: Fragment ID.
+    //     html: HTML string.  Omitted if the server has sent this fragment before.
+    //     data: Table of data, as for apply_diff(), instead of html.
+    //     base, diff: Instead of data, the fragment ID of an earlier version of the same table, and the diff from
+    //         it, as for apply_diff().  If we don't have the earlier version, we ask the server for the whole table.
+    // If null, then the element is hidden.
+    async function apply_table(table) {
+        if(table != null && table.html != null) { remember_fragment(table.id, table.html); }
+        if(table != null && table.data != null) { remember_fragment(table.id, table.data); }
+        if(table != null && table.diff != null && fragments.has(table.base)) {
+            remember_fragment(table.id, apply_diff(fragments.get(table.base), table.diff));
+        }
+        var content = (table == null) ? null : await get_fragment(table.id);
+        if(content != null && typeof content == "object") {
+            // If its template couldn't be fetched, the table is hidden rather than shown without it.
+            if(!await show_data(content)) { content = null; }
         } else {
-            $("#table").html(data);
-            $("#table")[0].style.display = "block";
+            shown_data = null;
+            if(content != null) { $("#table").html(content); }
         }
+        $("#table")[0].style.display = (content == null) ? "none" : "block";
+    }
+
+    // Sequence number of the last patch or snapshot received, and whether we are waiting for a resync.
+    var seq = null;
+    var resyncing = false;
+
+    // Apply a complete snapshot of the overlay state, with fields:
+    //     seq: Sequence number of the last patch included.
+    //     text: Object with every text area.
+    //     table: As for apply_table().
+    // The snapshot is applied straight away, after any events already queued.
+    function apply_snapshot(data) {
+        seq = data.seq;
+        resyncing = false;
+        enqueue(null, async function() {
+            apply_clock(data.clock);
+            apply_text(data.text);
+            await apply_table(data.table);
+        });
+    }
+
+    // The server sends a "snapshot" event when we connect.
+    socket.on('snapshot', function(data, cb) {
+        apply_snapshot(data);
         if(cb) { cb(); }
     });
 
-    // When we receive the "play_audio" event from the server,
-    // we invoke the play() method on the element with the indicated id.
-    // TODO: Support volume?
-    socket.on('play_audio', async function(data, cb) {
-        // Sleep for "delay" seconds.
-        if(delay > 0) { await new Promise(r => setTimeout(r, delay*1000)); }
-        var obj = $("audio#" + data)[0];
-        //obj.volume = 0.1; // Doesn't seem to work.
-        obj.play();
+    // When we receive a "patch" event from the server, apply the parts of the state that changed.
+    // Data is an object with fields:
+    //     seq: Sequence number, one more than the previous patch.
+    //     ts: Server time when sent.
+    //     at: Server time at which to apply the patch (plus our delay).
+    //     text: Optional object with text areas that changed, as for apply_text().
+    //     table: Optional table, as for apply_table().  Present but null to hide the table.
+    //     clock: Optional match clock, as for apply_clock().  Present but null to stop the clock.
+    // If we missed a patch, we ask the server for a snapshot instead.
+    // Patches that arrive before the snapshot are already included in it, so are dropped.
+    socket.on('patch', function(data, cb) {
+        if(resyncing || (seq != null && data.seq <= seq)) {
+            if(cb) { cb(); }
+            return;
+        }
+        if(seq != null && data.seq != seq + 1) {
+            console.log("Missed patch " + (seq + 1) + ", got " + data.seq + ", resyncing");
+            resyncing = true;
+            socket.emit('resync', apply_snapshot);
+            if(cb) { cb(); }
+            return;
+        }
+        seq = data.seq;
+        estimate_offset(data.ts);
+        enqueue(data.at, async function() {
+            if('clock' in data) { apply_clock(data.clock); }
+            if('text' in data) { apply_text(data.text); }
+            if('table' in data) { await apply_table(data.table); }
+        });
+        if(cb) { cb(); }
+    });
+
+    // When we receive the "play_audio" event from the server, play the named cue at its target time.
+    // Data is an object with fields name, ts and at, as for a patch.
+    // If the cue isn't decoded yet, it is played from the queue instead, in order with the other events.
+    socket.on('play_audio', function(data, cb) {
+        estimate_offset(data.ts);
+        if(schedule_cue(data.name, data.at) == null) {
+            enqueue(data.at, function() { play_cue(data.name); });
+        }
         if(cb) { cb(); }
     });                   
 });
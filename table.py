@@ -1,34 +1,254 @@
 #!/usr/bin/env python3
 
 # This module provides the methods that build complex HTML fragments.
+#
+# Rendered fragments are cached against the version of the sheet snapshot they were built from,
+# so rotating through the same tables only renders each one once per change to the spreadsheet.
+# The cache is shared by every arena, so several fields showing the same table render it once between them.
+#
+# If config.TABLE_DATA is set, each table is built as data instead: a dict with fields
+#     template: Name of the overlay's template for the table, e.g. "match" (see static/tables).
+#     key: Identifies the table, e.g. "match:0" for the first screen of matches.  A later version of the table has the
+#         same key, so overlays can be sent just the rows that changed (see overlay.show_table()).
+#     fields: Names of the fields in each row.
+#     rows: List of rows, each a list of the row's ID (e.g. the match ID) followed by the value of each field.
+# The overlays fetch the templates once, when they connect, and fill in the rows themselves.  As with the HTML,
+# each template URL includes a hash of the file's content, so the templates can be cached indefinitely.
 
+import json
+import os
+import time
+
+import assets
 import config
+import metrics
 import sheet
 import overlay
+import standings
 
-def show_matches():
-    """ Build and show the table for all qualifying matches """
-    # Only show qualifying rounds, not final playoffs.
-    n_qualifying_rounds = 10 # TODO: Don't hard-code this!
-    matches = sheet.get_matches(flush=True)[:n_qualifying_rounds]
-    text = config.env.get_template('match.html').render(matches=matches)
-    config.logger.info(f"Match table: {text}")
-    overlay.show_table("Matches", text)
+# Templates are compiled once, at import, rather than looked up on every render.
+TEMPLATES = {name: config.env.get_template(name) for name in ('match.html', 'team.html', 'match_score.html')}
+
+# Rendered fragments for the current snapshot version, keyed on (template name, key).
+_cache = {}
+_cache_version = None
+
+# Overlay templates for table data.
+CLIENT_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'tables')
+
+# Fields of the rows of each table of data, by template name.
+MATCH_FIELDS = ('Red Competitors', 'Red Score', 'Match', 'Blue Score', 'Blue Competitors')
+TEAM_FIELDS = ('Rank', 'Competitors', 'Played', 'Wins', 'Draws', 'Losses', 'Score')
+MATCH_SCORE_FIELDS = ('Match', 'Red Competitors', 'Blue Competitors', 'Red Common Balls', 'Blue Common Balls',
+                      'Red Special Balls', 'Blue Special Balls', 'Red Parking', 'Blue Parking', 'Fouls by Blue',
+                      'Fouls by Red', 'Red Score', 'Blue Score', 'Result', 'Winner')
+
+RENDER_SECONDS = metrics.histogram('render_seconds', "Time to render a template", ('template',))
+RENDER_CACHE_HITS = metrics.counter('render_cache_hits_total', "Renders served from the cache", ('template',))
 
-    
-def show_teams():
-    """ Build and show the table for all teams """
-    teams = sheet.get_teams(flush=True)
-    teams = sorted(teams, key=lambda t: (t['Rank'], t['Team']))
-    config.logger.info(f"Sorted teams: {teams}")
-    text = config.env.get_template('team.html').render(teams=teams)
-    config.logger.info(f"Team table: {text}")
-    overlay.show_table("Teams", text)
 
+def _check_version(snapshot):
+    """Empties the cache if the snapshot is a different version from the one that the cached fragments came from."""
+    global _cache_version
+    if snapshot.version != _cache_version:
+        _cache.clear()
+        _cache_version = snapshot.version
+
+
+def render(template_name, snapshot, key=None, context=dict):
+    """Renders a template, reusing the previous result if the snapshot hasn't changed since.
     
-def show_match(match_id):
-    """ Build and show the detailed results table for one match """
-    match = sheet.get_match(match_id, flush=True)
-    text = config.env.get_template('match_score.html').render(match=match)
-    config.logger.info(f"Match score table: {text}")
-    overlay.show_table("Match", text)
\ No newline at end of file
+    Args:
+        template_name: Name of template file, e.g. "match.html".
+        snapshot: Sheet snapshot that the template's data comes from.
+        key: Distinguishes different renders of the same template, e.g. the match ID.
+        context: Function returning the template variables.  Only called if the fragment isn't cached.
+        
+    Returns:
+        fragment: Tuple of fragment ID (a hash of the content) and HTML text.
+    """
+    _check_version(snapshot)
+        
+    cache_key = (template_name, key)
+    fragment = _cache.get(cache_key)
+    if fragment is None:
+        start = time.perf_counter()
+        text = TEMPLATES[template_name].render(**context())
+        elapsed = time.perf_counter() - start
+        RENDER_SECONDS.observe(elapsed, template_name)
+        metrics.trace('render', template=template_name, key=key, seconds=round(elapsed, 6), size=len(text))
+        fragment = (overlay.hash_fragment(text), text)
+        _cache[cache_key] = fragment
+        config.logger.debug("Rendered %s %s for %r: %d characters", template_name, key or "", snapshot, len(text))
+    else:
+        RENDER_CACHE_HITS.inc(template_name)
+    return fragment
+
+
+def render_data(template_name, snapshot, key, fields, rows):
+    """Builds the data for a table, reusing the previous result if the snapshot hasn't changed since.
+    Cached alongside the rendered HTML.
+
+    Args:
+        template_name: Name of the overlay's template, e.g. "match".
+        snapshot: Sheet snapshot that the rows come from.
+        key: Distinguishes different tables with the same template, e.g. the screen number.
+        fields: Names of the fields in each row.
+        rows: Function returning the rows, each a list of the row's ID and then the fields' values.
+            Only called if the data isn't cached.
+
+    Returns:
+        fragment: Tuple of fragment ID (a hash of the data) and the data, as described above.
+    """
+    _check_version(snapshot)
+
+    cache_key = ('data:' + template_name, key)
+    fragment = _cache.get(cache_key)
+    if fragment is None:
+        start = time.perf_counter()
+        data = dict(template=template_name, key=f"{template_name}:{key}", fields=list(fields), rows=rows())
+        text = json.dumps(data, separators=(',', ':'))
+        elapsed = time.perf_counter() - start
+        RENDER_SECONDS.observe(elapsed, cache_key[0])
+        metrics.trace('render', template=cache_key[0], key=key, seconds=round(elapsed, 6), size=len(text))
+        fragment = (overlay.hash_fragment(text), data)
+        _cache[cache_key] = fragment
+    else:
+        RENDER_CACHE_HITS.inc(cache_key[0])
+    return fragment
+
+
+def build_client_templates():
+    """Returns the overlay templates for table data, as a dict of dicts with field url, by template name."""
+    urls = assets.static_manifest(CLIENT_TEMPLATE_DIR, '/tables')
+    return {os.path.splitext(filename)[0]: dict(url=url)
+            for filename, url in urls.items() if filename.endswith('.html')}
+
+
+# Client templates are read once, at import.
+client_templates = build_client_templates()
+
+
+@config.app.route('/tables/<path:filename>')
+def serve_client_template(filename):
+    """Serves an overlay template, with an ETag and headers allowing it to be cached for a long time."""
+    return assets.cached_file(CLIENT_TEMPLATE_DIR, filename)
+
+
+def match_row(match):
+    """Returns the row of data for a match in the table of matches.
+    As in match.html, the scores are left blank until the match has been played."""
+    return [match.id] + [None if field.endswith(' Score') and not match.played else match.get(field)
+                         for field in MATCH_FIELDS]
+
+
+def team_row(team):
+    """Returns the row of data for a team (from standings.ranked()) in the table of teams."""
+    return [team['Competitors']] + [team[field] for field in TEAM_FIELDS]
+
+
+def match_score_row(match):
+    """Returns the row of data for the detailed results of a match, with the result as in match_score.html.
+    A score cell holding text (e.g. "DQ") gives no result."""
+    red, blue = match.get('Red Score') or 0, match.get('Blue Score') or 0
+    if not isinstance(red, int) or not isinstance(blue, int):
+        outcome = dict(Result=None, Winner='')
+    elif red > blue:
+        outcome = dict(Result="Red Wins!", Winner='red')
+    elif blue > red:
+        outcome = dict(Result="Blue Wins!", Winner='blue')
+    else:
+        outcome = dict(Result="It's a Tie!", Winner='')
+    return [match.id] + [outcome[field] if field in outcome else match.get(field) for field in MATCH_SCORE_FIELDS]
+
+
+def n_screens(n_rows, rows_per_screen):
+    """Returns the number of screens needed to show a table, at least one."""
+    return max(1, -(-n_rows // rows_per_screen))
+
+
+def show_matches(arena, screen=0):
+    """ Build and show one screen of the table of matches.
+
+    Args:
+        arena: Name of the arena to show it in.
+        screen: Screen number, from 0.  Each holds config.MATCHES_PER_SCREEN matches, in spreadsheet order.
+    """
+    fragment_id, content = match_fragment(sheet.get_snapshot(), screen)
+    overlay.show_table(arena, f"Matches {screen + 1}", content, fragment_id)
+
+
+def match_fragment(snapshot, screen=0):
+    """Renders one screen of the table of matches.
+
+    Returns:
+        fragment: Tuple of fragment ID and HTML text, as for render(), or of ID and data, as for render_data()
+            if config.TABLE_DATA is set.
+    """
+    start = screen * config.MATCHES_PER_SCREEN
+    if config.TABLE_DATA:
+        return render_data('match', snapshot, screen, MATCH_FIELDS, lambda: [
+            match_row(match) for match in snapshot.matches[start:start + config.MATCHES_PER_SCREEN]])
+    return render('match.html', snapshot, key=screen,
+                  context=lambda: dict(matches=snapshot.matches[start:start + config.MATCHES_PER_SCREEN]))
+
+
+def team_fragment(snapshot, screen=0):
+    """Renders one screen of the table of teams, with the standings computed from the match scores.
+
+    Returns:
+        fragment: Tuple of fragment ID and content, as for match_fragment().
+    """
+    start = screen * config.TEAMS_PER_SCREEN
+    if config.TABLE_DATA:
+        return render_data('team', snapshot, screen, TEAM_FIELDS, lambda: [
+            team_row(team) for team in standings.ranked(snapshot)[start:start + config.TEAMS_PER_SCREEN]])
+    return render('team.html', snapshot, key=screen, context=lambda: dict(
+        teams=standings.ranked(snapshot)[start:start + config.TEAMS_PER_SCREEN]))
+
+
+def show_teams(arena, screen=0):
+    """ Build and show one screen of the table of teams, with the standings computed from the match scores
+
+    Args:
+        arena: Name of the arena to show it in.
+        screen: Screen number, from 0.  Each holds config.TEAMS_PER_SCREEN teams, best first.
+    """
+    fragment_id, content = team_fragment(sheet.get_snapshot(), screen)
+    overlay.show_table(arena, f"Teams {screen + 1}", content, fragment_id)
+
+
+def match_score_fragment(snapshot, match_id):
+    """Renders the detailed results table for one match.
+
+    Returns:
+        fragment: Tuple of fragment ID and content, as for match_fragment().
+    """
+    if config.TABLE_DATA:
+        match = snapshot.match(match_id)
+        return render_data('match_score', snapshot, match_id, MATCH_SCORE_FIELDS,
+                           lambda: [] if match is None else [match_score_row(match)])
+    return render('match_score.html', snapshot, key=match_id, context=lambda: dict(match=snapshot.match(match_id)))
+
+
+def prerender_scores(match_id):
+    """Renders the results table for a match and every screen of the standings from the latest snapshot,
+    so that showing them straight afterwards (with flush=False) costs nothing.  See watcher.py."""
+    snapshot = sheet.get_snapshot()
+    match_score_fragment(snapshot, match_id)
+    for screen in range(n_screens(len(standings.ranked(snapshot)), config.TEAMS_PER_SCREEN)):
+        team_fragment(snapshot, screen)
+
+
+def show_match(arena, match_id, flush=True):
+    """ Build and show the detailed results table for one match in an arena.
+
+    Args:
+        arena: Name of the arena to show it in.
+        match_id: Identifier like "R1".
+        flush: If true, the spreadsheet is read first, since the scores have probably just been entered.
+            False if they are known to be up to date already, e.g. because the score watcher has seen them.
+    """
+    snapshot = sheet.refresh() if flush else sheet.get_snapshot()
+    fragment_id, content = match_score_fragment(snapshot, match_id)
+    overlay.show_table(arena, "Match", content, fragment_id)
@@ -0,0 +1,8 @@
+# Tests for the match runner.  Run them from the top directory with:  python -m unittest
+#
+# Importing the server's modules sets up the Flask app, so the tests don't save state or collect metrics.
+
+import os
+
+os.environ.setdefault('ANTHILL_STATE_FILE', '')
+os.environ.setdefault('ANTHILL_METRICS', '0')
@@ -0,0 +1,67 @@
+# Local stand-in for the Sheets API values.batchGet, for tests/test_sheetsapi.py and bench.py.  Run as:
+#     python tests/sheets_standin.py PORT [--matches N]
+# It runs in its own process, since the server's modules monkey patch the test process for eventlet.
+#
+# The matches range has the header "Red Total" instead of "Red Score", to test config.SHEET_HEADERS.
+# GET /requests returns the requests so far, each as [path, client port], so reused connections can be seen.
+# Requests under /slow/ are answered after a second, to test timeouts.
+# With --matches, it serves a generated event of that many matches instead, with the usual headers and no scores.
+
+import argparse
+import json
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MATCHES = [['Match', 'Red Competitors', 'Blue Competitors', 'Red Total', 'Blue Score'],
+           ['R1', 'Team 1', 'Team 2', '7', '3']]
+TEAMS = [['Rank', 'Team', 'Competitors', 'Played', 'Wins', 'Draws', 'Losses', 'Score'],
+         ['1', '1', 'Team 1', '1', '1', '0', '0', '2']]
+
+requests = []
+
+
+def generate_event(n_matches, n_teams=8):
+    """Returns the matches and teams ranges for an event in which every team plays in turn."""
+    matches = [['Match', 'Red Competitors', 'Blue Competitors', 'Red Score', 'Blue Score']]
+    matches += [[f'R{i + 1}', f'Team {i % n_teams + 1}', f'Team {(i + 1) % n_teams + 1}', '0', '0']
+                for i in range(n_matches)]
+    teams = [['Rank', 'Team', 'Competitors', 'Played', 'Wins', 'Draws', 'Losses', 'Score']]
+    teams += [[str(i + 1), str(i + 1), f'Team {i + 1}', '0', '0', '0', '0', '0'] for i in range(n_teams)]
+    return matches, teams
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/requests':
+            self.reply(requests)
+            return
+        requests.append([self.path, self.client_address[1]])
+        if self.path.startswith('/slow/'):
+            time.sleep(1)
+        ranges = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('ranges', [])
+        self.reply(dict(valueRanges=[dict(range=r, values=MATCHES if r.startswith('Matches') else TEAMS)
+                                     for r in ranges]))
+
+    def reply(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stand-in for the Sheets API")
+    parser.add_argument('port', type=int)
+    parser.add_argument('--matches', type=int, help="Serve a generated event with this many matches")
+    args = parser.parse_args()
+    if args.matches is not None:
+        MATCHES, TEAMS = generate_event(args.matches)
+    ThreadingHTTPServer(('127.0.0.1', args.port), StandIn).serve_forever()
@@ -0,0 +1,60 @@
+import random
+import unittest
+
+import control
+
+
+def apply_patch(keys, patch):
+    """Applies a button patch to a list of button keys, as patch_buttons does in static/control.js."""
+    keys = [k for k in keys if k not in patch['remove']]
+    for button in patch['put']:
+        if button['key'] in keys:
+            keys.remove(button['key'])
+        position = 0 if button['after'] is None else keys.index(button['after']) + 1
+        keys.insert(position, button['key'])
+    return keys
+
+
+def buttons(keys, label=""):
+    return [dict(event='e', arg=k, label=f"{k}{label}", key=k) for k in keys]
+
+
+class DiffButtonsTest(unittest.TestCase):
+
+    def check(self, old, new):
+        patch = control.diff_buttons(old, new)
+        self.assertEqual(apply_patch([b['key'] for b in old], patch), [b['key'] for b in new])
+        # Every button that changed is sent.
+        old_buttons = {b['key']: b for b in old}
+        put = {b['key'] for b in patch['put']}
+        self.assertTrue(all(b['key'] in put for b in new if old_buttons.get(b['key']) != b))
+        return patch
+
+    def test_unchanged(self):
+        patch = self.check(buttons("abcd"), buttons("abcd"))
+        self.assertEqual(patch, dict(remove=[], put=[]))
+
+    def test_append(self):
+        patch = self.check(buttons("abc"), buttons("abcd"))
+        self.assertEqual([b['key'] for b in patch['put']], ["d"])
+
+    def test_relabel(self):
+        patch = self.check(buttons("abcd"), buttons("ab") + buttons("c", " (ready)") + buttons("d"))
+        self.assertEqual([b['key'] for b in patch['put']], ["c"])
+
+    def test_rotate(self):
+        self.check(buttons("abcd"), buttons("cdab"))
+
+    def test_random(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            old = buttons(rng.sample("abcdefgh", rng.randint(0, 8)))
+            new = buttons(rng.sample("abcdefgh", rng.randint(0, 8)))
+            for b in new:
+                if rng.random() < 0.2:
+                    b['label'] += " (ready)"
+            self.check(old, new)
+
+
+if __name__ == '__main__':
+    unittest.main()
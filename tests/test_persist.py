@@ -0,0 +1,52 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import config
+import persist
+import sheet
+
+
+class PersistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state.json.gz")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def test_sheet_file(self):
+        self.assertEqual(persist.sheet_file(self.path), os.path.join(self.directory.name, "state.sheet.json.gz"))
+
+    def test_write_file(self):
+        persist.write_file(self.path, dict(a=[1, 2]))
+        self.assertEqual(self.read(self.path), dict(a=[1, 2]))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_snapshot_saved_only_when_changed(self):
+        sheet_path = persist.sheet_file(self.path)
+        with mock.patch.object(config, 'STATE_FILE', self.path), \
+                mock.patch.object(sheet, 'snapshot', sheet.Snapshot(1, [], [])), \
+                mock.patch.object(persist, '_sheet_version', None):
+            persist.save()
+            self.assertEqual(self.read(sheet_path)['sheet']['version'], 1)
+            os.remove(sheet_path)
+            persist.save()
+            self.assertTrue(os.path.exists(self.path))
+            self.assertFalse(os.path.exists(sheet_path))
+            sheet.snapshot = sheet.Snapshot(2, [], [])
+            persist.save()
+            self.assertEqual(self.read(sheet_path)['sheet']['version'], 2)
+            self.assertEqual(persist.load()['sheet']['version'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
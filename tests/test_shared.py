@@ -0,0 +1,155 @@
+import threading
+import unittest
+from unittest import mock
+
+import sheet
+import shared
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class MemoryStoreTest(unittest.TestCase):
+
+    def test_values(self):
+        store = shared.MemoryStore()
+        self.assertEqual(store.get('a', 1), 1)
+        store.set('a', [2])
+        self.assertEqual(store.get('a'), [2])
+        self.assertEqual(store.increment('n'), 1)
+        self.assertEqual(store.increment('n', 2), 3)
+
+    def test_list(self):
+        store = shared.MemoryStore()
+        self.assertEqual(store.slice('log', 0), [])
+        store.append('log', [1, 2, 3], 4)
+        store.append('log', [4, 5], 4)
+        self.assertEqual(store.slice('log', 0), [2, 3, 4, 5])
+        self.assertEqual(store.slice('log', -2), [4, 5])
+        self.assertEqual(store.slice('log', 0, 0), [])
+
+    def test_always_leader(self):
+        store = shared.MemoryStore()
+        self.assertTrue(store.acquire_lease('scheduler', "a", 10))
+        self.assertEqual(store.lease_owner('scheduler'), shared.worker_id)
+
+
+class CommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def set_colour(arena, colour):
+            self.calls.append((arena, colour))
+        self.command = shared.leader_command(set_colour)
+
+    def test_single_process_runs_command(self):
+        with mock.patch.object(shared, 'store', shared.MemoryStore()):
+            self.command("main", "red")
+        self.assertEqual(self.calls, [("main", "red")])
+
+    def test_run_command(self):
+        with mock.patch.object(shared, '_leader', True), \
+                mock.patch.object(shared, 'store', mock.Mock(shared=True)):
+            shared._run_command(dict(name='set_colour', args=["main", "blue"]))
+            with self.assertLogs('config', 'WARNING'):
+                shared._run_command(dict(name='no_such_command', args=[]))
+        self.assertEqual(self.calls, [("main", "blue")])
+
+    def test_follower_ignores_command(self):
+        with mock.patch.object(shared, '_leader', False), \
+                mock.patch.object(shared, 'store', mock.Mock(shared=True)):
+            shared._run_command(dict(name='set_colour', args=["main", "blue"]))
+        self.assertEqual(self.calls, [])
+
+    @unittest.skipIf(fakeredis is None, "needs fakeredis")
+    def test_forwarded_to_leader(self):
+        server = fakeredis.FakeServer()
+        follower = shared.RedisStore(None, client=fakeredis.FakeRedis(server=server))
+        leader = shared.RedisStore(None, client=fakeredis.FakeRedis(server=server))
+        received = []
+        delivered = threading.Event()
+
+        def on_command(message):
+            received.append(message)
+            delivered.set()
+        leader.subscribe('commands', on_command)
+
+        with mock.patch.object(shared, '_leader', False), mock.patch.object(shared, 'store', follower):
+            self.command("main", "green")
+            # Nothing runs on the follower itself.
+            self.assertEqual(self.calls, [])
+        self.assertTrue(delivered.wait(5))
+        self.assertEqual(received, [dict(name='set_colour', args=["main", "green"])])
+        # The leader runs what it receives, as its own subscriber to the commands would.
+        with mock.patch.object(shared, '_leader', True), mock.patch.object(shared, 'store', leader):
+            shared._run_command(received[0])
+        self.assertEqual(self.calls, [("main", "green")])
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis (with lupa, for scripts)")
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = shared.RedisStore(None, client=fakeredis.FakeRedis())
+        self.key = self.store.prefix + "lease:scheduler"
+
+    def test_take_and_renew(self):
+        self.assertTrue(self.store.acquire_lease('scheduler', "a", 10))
+        self.assertFalse(self.store.acquire_lease('scheduler', "b", 10))
+        self.store.redis.pexpire(self.key, 100)
+        self.assertTrue(self.store.acquire_lease('scheduler', "a", 10))
+        self.assertGreater(self.store.redis.pttl(self.key), 5000)
+        self.assertEqual(self.store.lease_owner('scheduler'), "a")
+
+    def test_expired_lease_is_not_renewed_for_another_owner(self):
+        self.assertTrue(self.store.acquire_lease('scheduler', "a", 10))
+        # The lease expires, and another worker takes it.
+        self.store.redis.delete(self.key)
+        self.assertTrue(self.store.acquire_lease('scheduler', "b", 1))
+        self.assertFalse(self.store.acquire_lease('scheduler', "a", 10))
+        self.assertEqual(self.store.lease_owner('scheduler'), "b")
+        self.assertLessEqual(self.store.redis.pttl(self.key), 1000)
+
+    def test_lease_renewed_while_leader_starts(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def on_elected():
+            started.set()
+            release.wait(5)
+        try:
+            with mock.patch.object(shared, 'store', self.store), mock.patch.object(shared, '_leader', False):
+                self.assertEqual(shared._campaign_round(on_elected), shared.LEASE_RENEW)
+                self.assertTrue(started.wait(5))
+                self.assertTrue(shared.is_leader())
+                # The next round renews the lease, although on_elected() hasn't returned.
+                self.store.redis.pexpire(self.key, 100)
+                shared._campaign_round(on_elected)
+                self.assertGreater(self.store.redis.pttl(self.key), 5000)
+        finally:
+            release.set()
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class SheetShareTest(unittest.TestCase):
+
+    def test_follower_loads_shared_snapshot(self):
+        columns = {'Match': 0, 'Red Score': 1, 'Blue Score': 2}
+        shared_snapshot = sheet.Snapshot(5, [sheet.Match.from_row(columns, ["R1", "3", "1"])], [])
+        with mock.patch.object(shared, 'store', shared.RedisStore(None, client=fakeredis.FakeRedis())), \
+                mock.patch.object(sheet, 'snapshot', shared_snapshot):
+            with mock.patch.object(shared, '_leader', True):
+                sheet._share()
+            sheet.snapshot = sheet.Snapshot(1, [sheet.Match.from_row(columns, ["R1", "", ""])], [])
+            # Nothing is read while we have the version asked for.
+            self.assertEqual(sheet.get_snapshot(1).version, 1)
+            snapshot = sheet.get_snapshot(5)
+            self.assertEqual(snapshot.version, 5)
+            self.assertEqual(snapshot.match("R1").red_score, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+import urllib.parse
+import urllib.request
+from unittest import mock
+
+import backends
+import config
+import sheet
+import sheetsapi
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class SheetsClientTest(unittest.TestCase):
+    """Tests the Sheets client and backend against a local stand-in (see sheets_standin.py)."""
+
+    @classmethod
+    def setUpClass(cls):
+        port = free_port()
+        cls.endpoint = f"http://127.0.0.1:{port}"
+        cls.server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'sheets_standin.py'),
+                                       str(port)])
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.client = sheetsapi.SheetsClient(self.endpoint, timeout=2)
+        self.first = len(self.requests())
+
+    def tearDown(self):
+        self.client.close()
+
+    def requests(self):
+        """Returns the requests the stand-in has had since the test started, each as [path, client port]."""
+        with urllib.request.urlopen(self.endpoint + "/requests") as response:
+            return json.load(response)[getattr(self, 'first', 0):]
+
+    def test_one_batch_get_per_refresh(self):
+        with mock.patch.object(sheet, 'backend', backends.SheetsBackend(self.client)), \
+                mock.patch.object(sheet, 'snapshot', None), \
+                mock.patch.dict(config.SHEET_HEADERS, matches={'Red Score': 'Red Total'}):
+            snapshot = sheet.refresh()
+            requests = self.requests()
+            self.assertEqual(len(requests), 1)
+            path = requests[0][0]
+            self.assertIn('values:batchGet', path)
+            self.assertEqual(urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)['ranges'],
+                             [config.SHEET_RANGES['matches'], config.SHEET_RANGES['teams']])
+            # The header in the spreadsheet is mapped to the name used in the code.
+            self.assertEqual(snapshot.match('R1')['Red Score'], 7)
+            self.assertEqual(snapshot.match('R1')['Blue Score'], 3)
+            sheet.refresh()
+            self.assertEqual(len(self.requests()), 2)
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            self.client.batch_get(config.SPREADSHEET_ID, ['Matches!A1:Z'])
+        self.assertEqual(len({port for path, port in self.requests()}), 1)
+
+    def test_timeout(self):
+        client = sheetsapi.SheetsClient(self.endpoint + "/slow", timeout=0.2)
+        start = time.monotonic()
+        with self.assertRaises(OSError):
+            client.batch_get(config.SPREADSHEET_ID, ['Matches!A1:Z'])
+        self.assertLess(time.monotonic() - start, 0.9)
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
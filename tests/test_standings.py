@@ -0,0 +1,37 @@
+import unittest
+
+import sheet
+import standings
+
+MATCH_COLUMNS = {header: i for i, header in
+                 enumerate(('Match', 'Red Competitors', 'Red Score', 'Blue Score', 'Blue Competitors'))}
+TEAM_COLUMNS = {header: i for i, header in enumerate(('Team', 'Competitors'))}
+
+
+def snapshot(version, *rows, changed_matches=frozenset()):
+    """Returns a snapshot of two teams, A and B, and matches between them from rows of strings, as in the sheet."""
+    matches = [sheet.Match.from_row(MATCH_COLUMNS, row) for row in rows]
+    teams = [sheet.Team.from_row(TEAM_COLUMNS, row) for row in (["1", "A"], ["2", "B"])]
+    return sheet.Snapshot(version, matches, teams, changed_matches=changed_matches)
+
+
+class StandingsTest(unittest.TestCase):
+
+    def test_ranked(self):
+        rows = standings.Standings().ranked(snapshot(1, ["R1", "A", "3", "1", "B"], ["R2", "B", "2", "2", "A"]))
+        self.assertEqual([(row['Competitors'], row['Rank'], row['Played'], row['Score']) for row in rows],
+                         [("A", 1, 2, 3), ("B", 2, 2, 1)])
+
+    def test_text_score_not_counted(self):
+        engine = standings.Standings()
+        with self.assertLogs('config', 'WARNING'):
+            rows = engine.ranked(snapshot(1, ["R1", "A", "DQ", "5", "B"], ["R2", "B", "2", "1", "A"]))
+        self.assertEqual([(row['Competitors'], row['Played'], row['Wins']) for row in rows], [("B", 1, 1), ("A", 1, 0)])
+        # The incremental update handles a score changing to and from text too.
+        rows = engine.ranked(snapshot(2, ["R1", "A", "4", "5", "B"], ["R2", "B", "x", "1", "A"],
+                                      changed_matches={"R1", "R2"}))
+        self.assertEqual([(row['Competitors'], row['Played'], row['Wins']) for row in rows], [("B", 1, 1), ("A", 1, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+
+import config
+import sheet
+import table
+
+COLUMNS = {header: i for i, header in
+           enumerate(('Match', 'Red Competitors', 'Red Score', 'Blue Score', 'Blue Competitors'))}
+
+
+class MatchScoreTest(unittest.TestCase):
+
+    def snapshot(self, red_score, blue_score):
+        return sheet.Snapshot(1, [sheet.Match.from_row(COLUMNS, ["R1", "A", red_score, blue_score, "B"])], [])
+
+    def result(self, red_score, blue_score, table_data):
+        table._cache.clear()
+        with mock.patch.object(config, 'TABLE_DATA', table_data):
+            return table.match_score_fragment(self.snapshot(red_score, blue_score), "R1")[1]
+
+    def test_parse_int(self):
+        self.assertEqual([sheet.parse_int(cell) for cell in ("", " 12 ", "3.0", "DQ", "1e999", "inf")],
+                         [None, 12, 3, "DQ", "1e999", "inf"])
+
+    def test_data(self):
+        fields = list(table.MATCH_SCORE_FIELDS)
+        def outcome(red_score, blue_score):
+            row = self.result(red_score, blue_score, True)['rows'][0]
+            return row[1 + fields.index('Result')], row[1 + fields.index('Winner')]
+        self.assertEqual(outcome("5", "3"), ("Red Wins!", 'red'))
+        self.assertEqual(outcome("", "3"), ("Blue Wins!", 'blue'))
+        self.assertEqual(outcome("2", "2"), ("It's a Tie!", ''))
+        self.assertEqual(outcome("DQ", "5"), (None, ''))
+
+    def test_html(self):
+        self.assertIn("Red Wins!", self.result("5", "3", False))
+        text = self.result("DQ", "5", False)
+        self.assertIn("DQ", text)
+        self.assertNotIn("Wins!", text)
+        self.assertNotIn("Tie", text)
+
+
+if __name__ == '__main__':
+    unittest.main()
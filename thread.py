@@ -1,209 +1,588 @@
 #!/usr/bin/env python3
 
 # This module handles long-running tasks.
+#
+# The overlay is driven by a state machine: at any time, exactly one State (DefaultState, MatchState,
+# MatchScoreState) is current, or none.  States never sleep or poll.  Instead, they schedule timers on a
+# Scheduler, which runs each callback at its deadline on one greenthread.  Leaving a state cancels all of its
+# timers at once, so an abort takes effect immediately and the old state can never overlap the new one.
+#
+# Each field (Arena, see config.ARENAS) has its own state machine and scheduler, so fields run their matches
+# and table rotations independently.  They share the sheet snapshot and rendered tables.
 
-import threading
+import functools
+import heapq
+import itertools
 import math
+import threading
 
 import eventlet
-eventlet.monkey_patch() # Changes the behaviour of "import time"
-import time
+eventlet.monkey_patch() # Makes threading (and the clocks' timing) use greenthreads
 
+import clocks
 import config
 import sheet
 import control
 import overlay
 import table
+import persist
+import shared
+import metrics
+import standings
+import watcher
 
-# Pointer to the current thread object so it can be stopped.
-current_thread = None 
+class Timer:
+    """A callback scheduled to run at a deadline.  Returned by Scheduler.call_at()."""
+    __slots__ = ('deadline', 'order', 'callback', 'args', 'cancelled')
 
-class StoppedException(Exception):
-    pass
+    def __init__(self, deadline, order, callback, args):
+        self.deadline = deadline
+        self.order = order
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
 
+    def __lt__(self, other):
+        return (self.deadline, self.order) < (other.deadline, other.order)
 
-class Thread(threading.Thread):
-    """
-    This is an abstract parent class for the various threads that we might run to update the overlay.
-    It mainly exists to support stopping.  Clients should check "is_stopped" and use the provided "sleep" method.
+    def cancel(self):
+        """Stops the timer from firing.  Safe to call more than once, or after it has fired."""
+        self.cancelled = True
+
+    def __repr__(self):
+        return f"<Timer {getattr(self.callback, '__qualname__', self.callback)}{self.args} at {self.deadline:.3f}>"
+
+
+class Scheduler:
+    """Runs callbacks at deadlines, in deadline order, on a single greenthread.
+    Pending timers are kept in a heap.  The scheduler sleeps until the earliest deadline, and is woken early
+    when a new timer is added.
+
+    Callbacks run while holding the scheduler's lock, as do state transitions (see set_state()),
+    so a callback never runs concurrently with a transition or another callback.
+
+    Under a virtual clock (see clocks.py), the greenthread isn't started, and a simulation calls run_due() instead.
     """
-        
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.stop_event = threading.Event()
-        
-    def stop(self):
-        """Set flag to say stopped.  Thread-safe."""
-        config.logger.info(f"Stopping thread {self.name}")
-        self.stop_event.set()
-        
-    def is_stopped(self):
-        """Check stopped flag.  Thread-safe."""
-        return self.stop_event.is_set()
-        
-    def sleep(self, sleep_time):
-        """Like time.sleep(), except checks "is_stopped" and raises Exception.
-        If called with times longer than one second, will check "is_stopped" every second."""
-        if self.is_stopped():
-            raise StoppedException(f"Thread {self.name} stopped")
-        start = time.time()
+
+    def __init__(self, clock=clocks.now, name="Scheduler"):
+        """
+        Args:
+            clock: Function returning the current time in seconds.  By default, the server time from clocks.py.
+            name: Name of the greenthread, for debugging.
+        """
+        self.clock = clock
+        self.name = name
+        self.lock = threading.RLock()
+        self._heap = []
+        self._order = itertools.count()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts running timers, if not already started."""
+        if self._thread is not None or clocks.clock.virtual: return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def call_at(self, deadline, callback, *args):
+        """Schedules callback(*args) to run at a deadline.
+
+        Args:
+            deadline: Time, as returned by the scheduler's clock.
+
+        Returns:
+            timer: Timer that can be cancelled.
+        """
+        timer = Timer(deadline, next(self._order), callback, args)
+        with self.lock:
+            heapq.heappush(self._heap, timer)
+        self._wakeup.set()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Schedules callback(*args) to run after delay seconds.  Returns Timer."""
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def pending(self):
+        """Returns list of timers that have not yet fired or been cancelled, earliest first."""
+        with self.lock:
+            return sorted(t for t in self._heap if not t.cancelled)
+
+    def _next_timer(self):
+        """Pops the next due timer, or returns None and the number of seconds until one is due (None if none)."""
+        with self.lock:
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None, None
+            wait = self._heap[0].deadline - self.clock()
+            if wait > 0:
+                return None, wait
+            return heapq.heappop(self._heap), 0
+
+    def next_deadline(self):
+        """Returns the deadline of the earliest pending timer, or None if there are none."""
+        with self.lock:
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+            return self._heap[0].deadline if self._heap else None
+
+    def run_due(self):
+        """Runs every timer that is due, in deadline order, including any they schedule that are due too.
+
+        Returns:
+            wait: Seconds until the next timer is due, or None if there are none.
+        """
         while True:
-            sleep_remaining = sleep_time + start - time.time()
-            if sleep_remaining <= 0: break
-            time.sleep(min(sleep_remaining, 1))
-            if self.is_stopped():
-                raise StoppedException(f"Thread {self.name} stopped")
-                
-    def run(self):
-        try:
-            self.exec()
-        except StoppedException:
-            return
-                
-        
-class MatchThread(Thread):
+            timer, wait = self._next_timer()
+            if timer is None:
+                return wait
+            self.fire(timer)
+
+    def fire(self, timer):
+        """Runs a timer's callback, unless it has been cancelled."""
+        with self.lock:
+            if timer.cancelled: return
+            timer.cancelled = True
+            TIMER_LATENESS.observe(max(0, self.clock() - timer.deadline))
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                config.logger.exception(f"Error in {timer}")
+
+    def _run(self):
+        while True:
+            # Clear before looking at the heap, so a timer added meanwhile still wakes us.
+            self._wakeup.clear()
+            clocks.wait(self._wakeup, self.run_due())
+
+
+TIMER_LATENESS = metrics.histogram('scheduler_lateness_seconds', "How late timers fire after their deadline")
+TICK_LATENESS = metrics.histogram('match_tick_lateness_seconds', "How late the server sends each second of the match clock")
+
+
+class Arena:
+    """A field, with its own current state and the scheduler that drives it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.scheduler = Scheduler(name=f"Scheduler {name}")
+        self.current_state = None # The current state, or None.
+
+    def match_id(self):
+        """Returns the ID of the match called, being run or shown, or None."""
+        return getattr(self.current_state, 'match_id', None)
+
+
+# Every arena, by name.
+arenas = {name: Arena(name) for name in config.ARENAS}
+
+# Scheduler for work that isn't part of any arena, such as saving the state (see persist.py).
+scheduler = Scheduler()
+
+
+class State:
+    """
+    This is an abstract parent class for the various states that the overlay might be in.
+    Subclasses set up the overlay in "enter", and schedule any later work with "call_later" or "call_at".
+    Those timers belong to the state, and are cancelled when the state is left.
+    A state is entered in one arena (see set_state()), which it finds in its arena and scheduler attributes.
+    """
+    name = "state"
+
+    def __init__(self):
+        self.timers = set()
+        self.entered = None
+        self.arena = None # Name of the arena, once entered.
+        self.scheduler = None # Scheduler of the arena, once entered.
+
+    def call_at(self, deadline, callback, *args):
+        """Schedules callback(*args) on the arena's scheduler at deadline, for as long as this state is current."""
+        # Forget timers that have already fired, so a long-running state doesn't accumulate them.
+        self.timers = {t for t in self.timers if not t.cancelled}
+        timer = self.scheduler.call_at(deadline, callback, *args)
+        self.timers.add(timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Schedules callback(*args) on the arena's scheduler after delay seconds, while this state is current."""
+        return self.call_at(self.scheduler.clock() + delay, callback, *args)
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+
+    def enter(self):
+        """Called when this becomes the current state."""
+        pass
+
+    def exit(self):
+        """Called when another state replaces this one, after its timers have been cancelled."""
+        pass
+
+    def describe(self):
+        """Returns dict describing the state, for inspection."""
+        return dict(name=self.name, arena=self.arena, entered=self.entered)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+
+def jitter_summary(samples):
+    """Summarises how late a series of ticks were.
+
+    Args:
+        samples: List of lateness of each tick, in seconds.
+
+    Returns:
+        summary: dict with ticks (number of samples) and mean_ms, p95_ms and max_ms, rounded to 0.1ms.
+    """
+    if not samples:
+        return dict(ticks=0, mean_ms=0, p95_ms=0, max_ms=0)
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return dict(ticks=len(samples),
+                mean_ms=round(1000 * sum(samples) / len(samples), 1),
+                p95_ms=round(1000 * p95, 1),
+                max_ms=round(1000 * ordered[-1], 1))
+
+
+class NextMatchState(State):
+    """Announces the next match, until it is started or cancelled."""
+
+    def __init__(self, match_id):
+        """
+        Args:
+            match_id: Identifier like "R1".
+        """
+        super().__init__()
+        self.name = "Next match " + match_id
+        self.match_id = match_id
+        self.match = sheet.get_match(match_id)
+
+    def enter(self):
+        overlay.update_text(
+            self.arena,
+            redteam=self.match["Red Competitors"],
+            blueteam=self.match["Blue Competitors"],
+            middle=f"Next match<br/>{self.match_id}<br/>Starting soon")
+        control.set_buttons(self.arena, [
+            dict(event="start_match", arg=self.match_id, label=f"Start match {self.match_id}"),
+            dict(event="abort_match", arg="", label=f"Cancel next match {self.match_id}"),
+        ])
+
+
+class MatchState(State):
     """Run a match from countdown to "scoring in progress".
+    If config.client_clock is set, the overlays are sent the match clock once and run it themselves.
+    Otherwise, the time and audio cues are sent every second.
+    The state remains current after the match (phase "scoring") until the scores are shown or the match is abandoned.
+    Meanwhile, a ScoreWatcher reads the scores as they are entered, so they can be shown without waiting.
     """
     # These constants control the timing of the game.  All are in seconds.
     match_length = 10 if config.impatient else 120 # Length of match play
     count_down = 3 # Number of beeps before match play
     count_down_delay = 2 # delay between pushing button and countdown starting
     end_game = 5 if config.impatient else 10 # When to sound warning during match play
-    
-    def __init__(self, match_id):
-        super().__init__(name="Match " + match_id)
+    clock_correction = 10 # How often to resend the match clock to overlays, to correct any drift
+
+    def __init__(self, match_id, start=None):
+        """
+        Args:
+            match_id: Identifier like "R1".
+            start: Server time when the match was started, to resume a match that is already in progress
+                (e.g. after a restart).  None to start the match now.
+        """
+        super().__init__()
+        self.name = "Match " + match_id
         self.match_id = match_id
         self.match = sheet.get_match(match_id)
-    
-    def exec(self):
+        self.phase = "starting"
+        self.start = start
+        self.lateness = [] # How late each second was sent, when the server runs the clock.
+        self.watcher = None # Watches for the scores, once the match is over.
+        self.scores_ready = False # True once the watcher has seen the scores and rendered them.
+
+    def phases(self, start):
+        """Returns the phases of the match, as for overlay.set_clock().
+
+        Args:
+            start: Server time when the match was started.
+        """
+        countdown = start + self.count_down_delay
+        play = countdown + self.count_down
+        end = play + self.match_length
+        return [
+            dict(name='countdown', at=countdown, seconds=self.count_down),
+            dict(name='play', at=play, seconds=self.match_length),
+            dict(name='endgame', at=end - self.end_game),
+            dict(name='end', at=end),
+        ]
+
+    def total_seconds(self):
+        return self.count_down_delay + self.count_down + self.match_length
+
+    def enter(self):
         overlay.update_text(
+            self.arena,
             redteam=self.match["Red Competitors"],
             blueteam=self.match["Blue Competitors"],
             match=self.match_id,
             time="Starting",
         )
-        
-        control.set_buttons([dict(event='abort_match', arg=self.match_id, label=f"Abort match {self.match_id}")])
-
-        old_seconds = self.match_length + self.count_down + self.count_down_delay
-        now = time.time()
-        end_time = now + old_seconds
-        config.logger.info(f"Running match {self.match_id} from {now} to {end_time}")
-        
-        while not self.is_stopped():
-            current_time = time.time()
-            seconds = math.ceil(end_time - current_time)
-            
-            if seconds != old_seconds:
-                config.logger.info(f"Match {self.match_id}, seconds={seconds}")
-                old_seconds = seconds
-                
-                if seconds < 0: # Game over
-                    overlay.update_text(middle="Game Over!<br/><br/>Scoring in Progress", clear=False)
-                    control.set_buttons([
-                        dict(event='show_match_scores', arg=self.match_id,
-                             label=f"Show scores for match {self.match_id}"),
-                        dict(event='abort_match', arg=self.match_id,
-                             label=f"Abandon match {self.match_id}"),
-                    ])
-                    break
-                else:
-                    # Set time field
-                    if seconds <= self.match_length: 
-                        # During match
-                        overlay.update_text(time="{min:02d}:{sec:02d}".format(min=seconds // 60, sec=seconds % 60), clear=False)
-                    elif seconds > self.match_length and seconds <= self.match_length + self.count_down:
-                        # Countdown
-                        overlay.update_text(time=(seconds - self.match_length), clear=False)
-                        
-                    # Play sound
-                    if seconds == 0:
-                        overlay.play_audio('end')
-                    elif seconds == self.end_game:
-                        overlay.play_audio('warning')
-                    elif seconds == self.match_length:
-                        overlay.play_audio('start')
-                    elif seconds > self.match_length and seconds <= self.match_length + self.count_down:
-                        overlay.play_audio('countdown')
-            self.sleep(0.25) # avoid skipping seconds because of oversleeping
-
-            
-class DefaultThread(Thread):
-    """This thread runs by default if we're not showing anything special.
-    It alternates between a table of teams, and a table of matches.
+
+        control.set_buttons(self.arena,
+                            [dict(event='abort_match', arg=self.match_id, label=f"Abort match {self.match_id}")])
+
+        now = overlay.server_time()
+        if self.start is None:
+            self.start = now
+        elapsed = math.floor(now - self.start)
+        game_over = self.start + self.total_seconds() + 1
+        config.logger.info(f"Running match {self.match_id} in {self.arena} from {self.start} to {game_over - 1}")
+        if config.client_clock:
+            self.clock = dict(match=self.match_id, start=self.start, phases=self.phases(self.start))
+            overlay.set_clock(self.arena, self.clock)
+            for at in range(self.clock_correction, self.total_seconds(), self.clock_correction):
+                if at > elapsed:
+                    self.call_at(self.start + at, overlay.set_clock, self.arena, self.clock)
+        elif elapsed < self.total_seconds():
+            self.call_at(self.start + elapsed + 1, self.tick, elapsed + 1)
+        # If resuming after the end of the match, this fires straight away.
+        self.call_at(game_over, self.game_over)
+
+    def exit(self):
+        overlay.set_clock(self.arena, None)
+        if self.watcher is not None:
+            self.watcher.cancel()
+
+    def tick(self, elapsed):
+        """Sends the time and audio cues to the overlays, when the server runs the clock.
+        Records how late each second was sent, for comparison with the overlay clocks.
+
+        Args:
+            elapsed: Whole number of seconds since the start of the match.
+        """
+        lateness = self.scheduler.clock() - (self.start + elapsed)
+        self.lateness.append(lateness)
+        TICK_LATENESS.observe(max(0, lateness))
+        metrics.trace('tick', arena=self.arena, match=self.match_id, elapsed=elapsed, lateness=round(lateness, 6))
+        seconds = self.total_seconds() - elapsed
+        config.logger.info(f"Match {self.match_id}, seconds={seconds}")
+
+        # Set time field
+        if seconds <= self.match_length:
+            # During match
+            self.phase = "play"
+            overlay.update_text(self.arena, time="{min:02d}:{sec:02d}".format(min=seconds // 60, sec=seconds % 60),
+                                clear=False)
+        elif seconds > self.match_length and seconds <= self.match_length + self.count_down:
+            # Countdown
+            self.phase = "countdown"
+            overlay.update_text(self.arena, time=(seconds - self.match_length), clear=False)
+
+        # Play sound
+        if seconds == 0:
+            overlay.play_audio(self.arena, 'end')
+        elif seconds == self.end_game:
+            overlay.play_audio(self.arena, 'warning')
+        elif seconds == self.match_length:
+            overlay.play_audio(self.arena, 'start')
+        elif seconds > self.match_length and seconds <= self.match_length + self.count_down:
+            overlay.play_audio(self.arena, 'countdown')
+
+        if seconds > 0:
+            self.call_at(self.start + elapsed + 1, self.tick, elapsed + 1)
+
+    def game_over(self):
+        self.phase = "scoring"
+        overlay.set_clock(self.arena, None)
+        overlay.update_text(self.arena, middle="Game Over!<br/><br/>Scoring in Progress", time="00:00", clear=False)
+        self.set_scoring_buttons()
+        # The watcher's callback runs on its own greenthread, so hands over to the scheduler.
+        self.watcher = watcher.ScoreWatcher(self.match_id, lambda: self.call_later(0, self.scores_in))
+        self.watcher.start()
+        if self.lateness:
+            stats = jitter_summary(self.lateness)
+            control.log_message(f"Server tick jitter for match {self.match_id}: n={stats['ticks']}, "
+                                f"mean={stats['mean_ms']}ms, p95={stats['p95_ms']}ms, max={stats['max_ms']}ms",
+                                arena=self.arena)
+
+    def set_scoring_buttons(self):
+        ready = " (ready)" if self.scores_ready else ""
+        control.set_buttons(self.arena, [
+            dict(event='show_match_scores', arg=self.match_id,
+                 label=f"Show scores for match {self.match_id}{ready}"),
+            dict(event='abort_match', arg=self.match_id,
+                 label=f"Abandon match {self.match_id}"),
+        ])
+
+    def scores_in(self):
+        """Called when the watcher has seen the scores, and rendered the tables that show them."""
+        if self.watcher.cancelled:
+            # The state was left while the watcher was handing over.
+            return
+        self.scores_ready = True
+        control.log_message(f"Scores for match {self.match_id} are in", arena=self.arena)
+        if config.AUTO_SHOW_SCORES:
+            set_state(self.arena, MatchScoreState(self.match_id, flush=False))
+        else:
+            self.set_scoring_buttons()
+
+    def describe(self):
+        return dict(super().describe(), match=self.match_id, phase=self.phase, start=self.start,
+                    scores_ready=self.scores_ready)
+
+
+class DefaultState(State):
+    """This state is current by default if we're not showing anything special.
+    It rotates through a few screens of matches, starting with the next match to play, then every screen of teams,
+    with a blank screen after each table.  The rotation is worked out afresh each time round, as scores come in.
     Note: This ought to change behaviour for finals.
     """
-    sleep_time = 5 if config.impatient else 10 
-    
+    name = "Default"
+    sleep_time = 5 if config.impatient else 10
+
     def __init__(self):
-        super().__init__(name="Default")
-        #methods = [self.show_matches, self.show_team]
-        
-    def exec(self):
-        # Create buttons for starting every possible match.
-        # Note: We could program this only to offer the next match, but then we could not choose to play out of order.
-        # Note: We could hide complete matches, but then we could not choose to replay a match.
-        # TODO: Colour buttons by whether the matches already have scores
-        buttons = [dict(event="next_match", arg=match['Match'], label=f"Next match {match['Match']}") 
-                   for match in sheet.get_matches()]
-        control.set_buttons(buttons)
-
-        try:
-            while not self.is_stopped():
-                self.sleep(self.sleep_time)
-                table.show_matches()
- 
-                self.sleep(self.sleep_time)   
-                overlay.show_table()
-
-                self.sleep(self.sleep_time)                   
-                table.show_teams()
-
-                self.sleep(self.sleep_time)   
-                overlay.show_table()
-        finally:
-            overlay.show_table()
-            
-
-class MatchScoreThread(Thread):
-    """Show the results of a single match.  
+        super().__init__()
+        self.steps = []
+
+    def enter(self):
+        self.steps = self.plan()
+        self.call_later(self.sleep_time, self.step, 0)
+
+    def offer_next_match(self, snapshot=None):
+        """Offers a button for the next match in a snapshot (by default the latest), and returns it (or None).
+        Only the next match gets a button, however many matches there are.  Others are chosen in the match browser.
+        Matches taken by other arenas are skipped."""
+        snapshot = snapshot or sheet.get_snapshot()
+        next_match = snapshot.next_match(exclude=busy_matches(self.arena))
+        control.set_buttons(self.arena, [] if next_match is None else
+                            [dict(event="next_match", arg=next_match.id, label=f"Next match {next_match.id}")])
+        return next_match
+
+    def plan(self):
+        """Offers a button for the next match, and returns the list of steps for one rotation."""
+        snapshot = sheet.get_snapshot()
+        next_match = self.offer_next_match(snapshot)
+
+        # Start with the screen holding the next match, or the last screen once every match has been played.
+        n_match_screens = table.n_screens(len(snapshot.matches), config.MATCHES_PER_SCREEN)
+        if next_match is None:
+            first = n_match_screens - 1
+        else:
+            first = next(i for i, m in enumerate(snapshot.matches) if m is next_match) // config.MATCHES_PER_SCREEN
+        n_team_screens = table.n_screens(len(standings.ranked(snapshot)), config.TEAMS_PER_SCREEN)
+        return ([functools.partial(table.show_matches, self.arena, screen)
+                 for screen in range(first, min(first + config.MATCH_SCREENS, n_match_screens))]
+                + [functools.partial(overlay.show_table, self.arena)]
+                + [functools.partial(table.show_teams, self.arena, screen) for screen in range(n_team_screens)]
+                + [functools.partial(overlay.show_table, self.arena)])
+
+    def step(self, i):
+        self.steps[i]()
+        i += 1
+        if i == len(self.steps):
+            self.steps = self.plan()
+            i = 0
+        self.call_later(self.sleep_time, self.step, i)
+
+    def exit(self):
+        overlay.show_table(self.arena)
+
+
+class MatchScoreState(State):
+    """Show the results of a single match.
     Only available after completing a match, and automatically ends after 30 seconds."""
     sleep_time = 5 if config.impatient else 30
-    
-    def __init__(self, match_id):
-        super().__init__(name="Match " + match_id)
+
+    def __init__(self, match_id, flush=True):
+        """
+        Args:
+            match_id: Identifier like "R1".
+            flush: As for table.show_match().
+        """
+        super().__init__()
+        self.name = "Match score " + match_id
         self.match_id = match_id
         self.match = sheet.get_match(match_id)
-        
-    def exec(self):
-        try:
-            overlay.update_text()
-            table.show_match(self.match_id)
-            control.set_buttons([dict(event='abort_match', arg=self.match_id,
-                                label=f"Abandon match {self.match_id}")]);
-            self.sleep(self.sleep_time)
-        finally:
-            overlay.show_table("", None)
-
-        cycle()
-
-        
-def set_thread(thread=None):
-    """Stops the current thread (if any) and launches a new thread (if not None)."""
-    config.logger.info(f"set thread {thread}", exc_info=True)
-    global current_thread
-    if None != current_thread:
-        current_thread.stop()
-    current_thread = thread
-    if None != thread:
-        thread.start()
-        
-        
-def cycle():
-    """This invokes the default thread to cycle between interesting tables.
+        self.flush = flush
+
+    def enter(self):
+        overlay.update_text(self.arena)
+        table.show_match(self.arena, self.match_id, flush=self.flush)
+        control.set_buttons(self.arena, [dict(event='abort_match', arg=self.match_id,
+                            label=f"Abandon match {self.match_id}")]);
+        self.call_later(self.sleep_time, cycle, self.arena)
+
+    def exit(self):
+        overlay.show_table(self.arena, "", None)
+
+
+def set_state(arena, state=None):
+    """Leaves an arena's current state (if any) and enters a new state (if not None).
+    The old state's timers are cancelled before it exits, so none of them can fire after this returns.
+
+    Args:
+        arena: Name of the arena.
+        state: New State, not yet entered.
     """
-    overlay.update_text();
-    buttons = [dict(event="next_match", arg=match['Match'], label=f"Next match {match['Match']}") 
-               for match in sheet.get_matches()]
-    control.set_buttons(buttons)
-    set_thread(DefaultThread())
\ No newline at end of file
+    config.logger.info(f"set state {state} in {arena}")
+    arena = arenas[arena]
+    with arena.scheduler.lock:
+        old, arena.current_state = arena.current_state, state
+        if None != old:
+            old.cancel_timers()
+            old.exit()
+        if None != state:
+            state.arena = arena.name
+            state.scheduler = arena.scheduler
+            state.entered = clocks.wall()
+            arena.scheduler.start()
+            state.enter()
+    persist.mark_dirty()
+    if getattr(state, 'match_id', None) is not None:
+        # Arenas offering this match as their next one offer another instead.  Each does so on its own scheduler,
+        # since taking another arena's lock while holding this one's could deadlock.
+        for other in arenas.values():
+            other_state = other.current_state
+            if other is not arena and isinstance(other_state, DefaultState):
+                other_state.call_later(0, other_state.offer_next_match)
+
+
+def busy_matches(arena):
+    """Returns the set of IDs of the matches called, being run or shown in arenas other than this one."""
+    return {other.match_id() for other in arenas.values() if other.name != arena} - {None}
+
+
+def describe_arena(arena):
+    """Returns dict describing an arena's current state and pending timers."""
+    now = arena.scheduler.clock()
+    with arena.scheduler.lock:
+        state = arena.current_state
+        return dict(
+            state=None if state is None else state.describe(),
+            timers=[dict(timer=repr(t), due_in=round(t.deadline - now, 3)) for t in arena.scheduler.pending()],
+        )
+
+
+def describe():
+    """Returns dict describing the state and pending timers of every arena, and the worker, for inspection."""
+    return dict(
+        arenas={name: describe_arena(arena) for name, arena in arenas.items()},
+        worker=shared.describe(),
+    )
+
+
+def cycle(arena):
+    """This enters the default state in an arena, to cycle between interesting tables.
+    """
+    overlay.update_text(arena);
+    set_state(arena, DefaultState())
+
+
+@config.app.route('/status')
+def status():
+    """Shows the current state and pending timers as JSON."""
+    return describe()
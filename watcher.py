@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# This module watches the spreadsheet for the scores of a match that has just finished, while the overlays show
+# "Scoring in Progress", so that the scores can be shown the moment they are asked for.
+#
+# A ScoreWatcher reads only the match's own row (see sheet.refresh_match()), on its own greenthread, so a slow
+# request never holds up the arena's scheduler.  It reads often while the row is changing, as the scorers type,
+# and backs off while it isn't.  The scores are taken to be complete once every column in config.SCORE_COLUMNS
+# holds a number, the match counts as played, and the row hasn't changed since the previous read.
+# Then the results table and the standings are rendered into the cache (see table.prerender_scores()), and the
+# watcher's callback is called.
+
+import threading
+
+import clocks
+import config
+import metrics
+import sheet
+import table
+
+# Seconds between reads of the match's row: the first, and after each read that changed it.
+MIN_INTERVAL = 2
+# Each read that changes nothing doubles the interval, up to this (the sync interval of the Sheets backend).
+MAX_INTERVAL = 15
+# Seconds after which the watcher gives up, leaving the scores to be read when they are shown.
+TIMEOUT = 30 * 60
+
+SCORES_WAIT_SECONDS = metrics.histogram('score_watch_seconds', "Time from the end of a match until its scores are in",
+                                        buckets=(5, 10, 20, 30, 60, 90, 120, 180, 300, 600, 1200))
+
+
+def scores_complete(match):
+    """Returns True if a match's scores look fully entered."""
+    return (match is not None and match.played
+            and all(isinstance(match.get(column), int) for column in config.SCORE_COLUMNS if column in match))
+
+
+class ScoreWatcher:
+    """Watches one match's row until its scores are complete, then pre-renders the tables that show them."""
+
+    def __init__(self, match_id, on_complete):
+        """
+        Args:
+            match_id: Identifier like "R1".
+            on_complete: Called with no arguments, on the watcher's greenthread, once the scores are complete and
+                rendered.  Not called if the watcher is cancelled first.
+        """
+        self.match_id = match_id
+        self.on_complete = on_complete
+        self.cancelled = False
+        self.complete = False
+        self._wakeup = threading.Event()
+
+    def start(self):
+        # It polls in real time, so can't run under a virtual clock.  A simulation enters and shows the scores itself.
+        if clocks.clock.virtual:
+            return
+        threading.Thread(target=self._run, name=f"Score watcher {self.match_id}", daemon=True).start()
+
+    def cancel(self):
+        """Stops watching.  Safe to call more than once, or after the scores are complete."""
+        self.cancelled = True
+        self._wakeup.set()
+
+    def _run(self):
+        started = clocks.now()
+        interval = MIN_INTERVAL
+        previous = None
+        while not self.cancelled and clocks.now() - started < TIMEOUT:
+            clocks.wait(self._wakeup, interval)
+            if self.cancelled:
+                return
+            try:
+                match = sheet.refresh_match(self.match_id)
+            except Exception:
+                config.logger.exception(f"Error reading the scores for match {self.match_id}")
+                interval = min(interval * 2, MAX_INTERVAL)
+                continue
+            if match is not None and match == previous and scores_complete(match):
+                break
+            interval = MIN_INTERVAL if match != previous else min(interval * 2, MAX_INTERVAL)
+            previous = match
+        else:
+            if not self.cancelled:
+                config.logger.info(f"Stopped watching for the scores of match {self.match_id}")
+            return
+
+        table.prerender_scores(self.match_id)
+        elapsed = clocks.now() - started
+        SCORES_WAIT_SECONDS.observe(elapsed)
+        metrics.trace('scores_in', match=self.match_id, seconds=round(elapsed, 3))
+        config.logger.info(f"Scores for match {self.match_id} are in after {elapsed:.1f}s")
+        # Checked again, since the state may have been left while rendering.
+        if not self.cancelled:
+            self.complete = True
+            self.on_complete()